@@ -0,0 +1,103 @@
+"""
+Load test ``gurtel serve``, comparing throughput by number of workers.
+
+Run with ``python benchmarks/serve_load.py``. Starts the server for a small
+CPU-bound app with 1, 2, ... up to one worker per CPU, and reports requests
+per second made by as many client processes, each over one keep-alive
+connection.
+
+"""
+import httplib
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Response
+
+from gurtel.app import GurtelApp
+from gurtel.dispatch import MapDispatcher
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PORT = 8765
+
+
+def handle_work(request):
+    return Response(str(sum(i * i for i in range(20000))))
+
+
+def make_app(config):
+    config.update({'app.secret_key': 'benchmark-secret'})
+    dispatcher = MapDispatcher(
+        Map([Rule('/', endpoint='work')]), {'work': handle_work})
+    return GurtelApp(config, HERE, dispatcher)
+
+
+def client(seconds, results):
+    connection = httplib.HTTPConnection('127.0.0.1', PORT)
+    count = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        connection.request('GET', '/')
+        connection.getresponse().read()
+        count += 1
+    results.put(count)
+
+
+def run(workers, clients, seconds):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([HERE] + sys.path))
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'gurtel.server', 'serve',
+            'serve_load.make_app',
+            '--bind', '127.0.0.1:%s' % PORT,
+            '--workers', str(workers),
+            '--threaded',
+            ],
+        env=env,
+        stderr=open(os.devnull, 'w'),
+        )
+    try:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', PORT)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+        # Let all workers start.
+        time.sleep(1)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=client, args=(seconds, results))
+            for i in range(clients)
+            ]
+        for process in processes:
+            process.start()
+        total = sum(results.get() for process in processes)
+        for process in processes:
+            process.join()
+        return total / float(seconds)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+def main(seconds=5):
+    cpus = multiprocessing.cpu_count()
+    print '%8s %12s' % ('workers', 'requests/s')
+    workers = 1
+    while True:
+        print '%8d %12.1f' % (workers, run(workers, cpus, seconds))
+        if workers >= cpus:
+            break
+        workers = min(workers * 2, cpus)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare session cookie size and encode/decode time across formats.
+
+Run with ``python benchmarks/session_formats.py``.
+
+"""
+import timeit
+
+from gurtel import session
+
+
+SECRET = 'benchmark-secret'
+
+SESSIONS = {
+    'small': {'user_id': 1234, 'csrf': 'a' * 32},
+    'flash': {
+        'user_id': 1234,
+        'flash': [
+            {'level': 'info', 'message': "Your changes were saved."},
+            {'level': 'warning', 'message': "Your trial ends in 3 days."},
+            ],
+        },
+    'large': {
+        'user_id': 1234,
+        'recent': [
+            {'id': i, 'title': u'Item number %s' % i, 'seen': True}
+            for i in range(40)
+            ],
+        },
+    }
+
+FORMATS = [
+    ('legacy', session.get_cookie_class()),
+    ('json', session.get_cookie_class('json', None)),
+    ('json+zlib', session.get_cookie_class('json', 256)),
+    ('marshal', session.get_cookie_class('marshal', None)),
+    ('marshal+zlib', session.get_cookie_class('marshal', 256)),
+    ]
+
+
+def main(number=2000):
+    print '%-8s %-14s %8s %12s %12s' % (
+        'session', 'format', 'bytes', 'encode (us)', 'decode (us)')
+    for session_name, data in sorted(SESSIONS.items()):
+        for format_name, cls in FORMATS:
+            cookie = cls(data, secret_key=SECRET)
+            serialized = cookie.serialize()
+            assert cls.unserialize(serialized, SECRET) == data
+            encode = timeit.timeit(cookie.serialize, number=number)
+            decode = timeit.timeit(
+                lambda: cls.unserialize(serialized, SECRET), number=number)
+            print '%-8s %-14s %8d %12.1f %12.1f' % (
+                session_name,
+                format_name,
+                len(serialized),
+                encode / number * 1e6,
+                decode / number * 1e6,
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Component micro-benchmarks.
+
+Run with ``py.test benchmarks --gurtel-bench``; add ``--gurtel-bench-save``
+to store the results as the baseline later runs are compared with.
+
+"""
+import subprocess
+import sys
+
+import pytest
+from werkzeug.contrib.sessions import ModificationTrackingDict
+from werkzeug.routing import Map, Rule
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response
+
+from gurtel import flash, session
+from gurtel.app import GurtelApp
+from gurtel.config import Config
+from gurtel.dispatch import MapDispatcher
+
+
+def handle_thing(request, thing_id):
+    return Response("thing id: %s" % thing_id)
+
+
+def handle_page(request, page_id):
+    return request.app.tpl.render(request, 'page.html', {'page_id': page_id})
+
+
+@pytest.fixture
+def dispatcher():
+    url_map = Map(
+        [Rule('/thing/<int:thing_id>/', endpoint='thing')] +
+        [Rule('/other/%s/<int:id>/' % i, endpoint='other%s' % i)
+         for i in range(50)] +
+        [Rule('/page/<int:page_id>/', endpoint='page')]
+        )
+    return MapDispatcher(
+        url_map, {'thing': handle_thing, 'page': handle_page})
+
+
+@pytest.fixture
+def app(tmpdir, dispatcher):
+    tmpdir.mkdir('templates').join('page.html').write(
+        '{% for message in flash %}{{ message.message }}{% endfor %}'
+        '<h1>Page {{ page_id }}</h1>'
+        '<ul>{% for i in range(20) %}<li>{{ i }}</li>{% endfor %}</ul>'
+        )
+    config = Config({'app.secret_key': 'secret'})
+    return GurtelApp(config, str(tmpdir), dispatcher)
+
+
+def make_request(app, path='/', **kwargs):
+    request = app.request_class(EnvironBuilder(path, **kwargs).get_environ())
+    request.app = app
+    request.settings = app.settings
+    return request
+
+
+def test_dispatch(gurtel_bench, dispatcher):
+    environ = EnvironBuilder('/thing/3/').get_environ()
+    gurtel_bench('dispatch', lambda: dispatcher.dispatch(environ))
+
+
+def test_url_for(gurtel_bench, dispatcher):
+    gurtel_bench(
+        'url_for',
+        lambda: dispatcher.url_for('localhost', 'thing', thing_id=3),
+        )
+
+
+def test_session_round_trip(gurtel_bench, app):
+    cookie = session.JSONSecureCookie(
+        {'user_id': 1234}, secret_key=app.secret_key).serialize()
+
+    def handler(request):
+        request.session['count'] = request.session.get('count', 0) + 1
+        return Response()
+
+    def round_trip():
+        request = make_request(
+            app, headers={'Cookie': 'session=%s' % cookie})
+        session.session_middleware(request, handler)
+
+    gurtel_bench('session_round_trip', round_trip)
+
+
+def test_flash_send_drain(gurtel_bench):
+    def send_drain():
+        f = flash.Flash(ModificationTrackingDict())
+        f.info("Saved.")
+        f.info("Saved.")
+        f.warning("Trial ends soon.")
+        list(f.get_and_clear())
+
+    gurtel_bench('flash_send_drain', send_drain)
+
+
+def test_render(gurtel_bench, app):
+    request = make_request(app)
+    request.session = {}
+    gurtel_bench(
+        'render', lambda: app.tpl.render(request, 'page.html', {'page_id': 1}))
+
+
+def test_config_getbool(gurtel_bench):
+    config = Config({'app.debug': 'true'})
+    gurtel_bench('config_getbool', lambda: config.getbool('app.debug'))
+
+
+def test_settings_lookup(gurtel_bench, app):
+    settings = app.settings
+    gurtel_bench(
+        'settings_lookup', lambda: settings['session.expiry_minutes'])
+
+
+def test_app_request(gurtel_bench, app):
+    environ = EnvironBuilder('/page/1/').get_environ()
+
+    def start_response(status, headers):
+        pass
+
+    def request():
+        ''.join(app(dict(environ), start_response))
+
+    gurtel_bench('app_request', request)
+
+
+@pytest.mark.parametrize('name,settings', [
+    ('app_request_thing', {}),
+    ('app_request_metrics', {'app.metrics': 'true'}),
+    ('app_request_metrics_stages', {
+        'app.metrics': 'true', 'app.metrics_stages': 'true'}),
+    ])
+def test_app_request_metrics(gurtel_bench, tmpdir, dispatcher, name,
+                             settings):
+    """A trivial request, with and without metrics (compare them)."""
+    config = Config({'app.secret_key': 'secret'})
+    config.update(settings)
+    app = GurtelApp(config, str(tmpdir), dispatcher)
+    environ = EnvironBuilder('/thing/3/').get_environ()
+
+    def start_response(status, headers):
+        pass
+
+    def request():
+        ''.join(app(dict(environ), start_response))
+
+    gurtel_bench(name, request)
+
+
+def test_import_app(gurtel_bench):
+    command = [sys.executable, '-c', 'import gurtel.app']
+    gurtel_bench('import_app', lambda: subprocess.check_call(command))
+
+
+def test_startup_and_warmup(gurtel_bench, tmpdir, dispatcher):
+    config = Config({'app.secret_key': 'secret'})
+    base_dir = str(tmpdir)
+    tmpdir.mkdir('templates').join('page.html').write('<h1>{{ page_id }}</h1>')
+
+    def startup():
+        GurtelApp(config, base_dir, dispatcher).warmup()
+
+    gurtel_bench('startup_and_warmup', startup)
@@ -1,9 +1,17 @@
-from functools import wraps, partial
+from functools import wraps
 import os
+from timeit import default_timer as timer
 import urlparse
 
-from gurtel import dispatch, flash, session, templates
-from werkzeug.debug import DebuggedApplication
+from gurtel import (
+    dispatch,
+    flash,
+    metrics,
+    middleware,
+    session,
+    templates,
+    )
+from gurtel.cache import LRUCache
 from werkzeug.exceptions import HTTPException
 from werkzeug.utils import cached_property, redirect
 from werkzeug.wrappers import Request as WerkzeugRequest
@@ -36,48 +44,267 @@ def redirect_if(request_test, redirect_to):
     return _decorator
 
 
+#: Typed config settings read by Gurtel; see ``Config.snapshot``.
+SETTINGS = {
+    'app.access_log': ('bool', False),
+    'app.base_url': ('str', 'http://localhost'),
+    'app.compress': ('bool', False),
+    'app.conditional_get': ('bool', False),
+    'app.config_reload': ('bool', False),
+    'app.config_reload_interval': ('float', 1.0),
+    'app.debugger': ('bool', False),
+    'app.metrics': ('bool', False),
+    'app.metrics_stages': ('bool', False),
+    'app.url_cache_size': ('int', 1024),
+    'assets.dir': ('path', None),
+    'assets.url_prefix': ('str', '/static/'),
+    'compress.cache_max_size': ('int', 1024 * 1024),
+    'compress.cache_size': ('int', 256),
+    'compress.min_size': ('int', 500),
+    'flash.max_messages': ('int', 20),
+    'profile.dir': ('path', None),
+    'profile.endpoints': ('list', None),
+    'profile.interval': ('float', 60.0),
+    'profile.sample_rate': ('float', 0.0),
+    'server.bind': ('str', '127.0.0.1:8000'),
+    'server.graceful_timeout': ('float', 30.0),
+    'server.keepalive': ('float', 5.0),
+    'server.threaded': ('bool', False),
+    'server.workers': ('int', 0),
+    'session.compress_threshold': ('int', 1024),
+    'session.expiry_minutes': ('int', 0),
+    'session.serializer': ('str', None),
+    'templates.bytecode_cache_dir': ('path', None),
+    'templates.cache_size': ('int', None),
+    'templates.precompile': ('bool', False),
+    'templates.production': ('bool', False),
+    'templates.stream_buffer_size': ('int', 5),
+    }
+
+
 class Request(WerkzeugRequest, flash.FlashRequestMixin):
     pass
 
 
 class GurtelApp(object):
-    """A Gurtel WSGI application."""
+    """
+    A Gurtel WSGI application.
+
+    ``settings`` is a snapshot of the config settings in ``settings_schema``
+    (by default ``SETTINGS``), parsed and validated on creation; code on the
+    request path should read those from ``request.settings`` (the app's
+    settings when the request began) rather than ``config``.
+
+    ``reload_config()`` re-reads config files and swaps in new ``config`` and
+    ``settings``. If the ``app.config_reload`` setting is on, a
+    ``gurtel.watch.FileWatcher`` does so whenever a config file changes
+    (until ``close()``). Only settings read per request take effect without a
+    restart; under ``gurtel.server.Arbiter`` a change reloads the whole app.
+
+    """
+    settings_schema = SETTINGS
+
+    #: Settings read per request (from ``request.settings``), which take
+    #: effect when swapped in by ``set_config``; the rest are used on creation.
+    request_settings = frozenset([
+        'flash.max_messages',
+        'session.compress_threshold',
+        'session.expiry_minutes',
+        'session.serializer',
+        ])
+
     def __init__(self, config, base_dir, dispatcher=None,
                  request_class=Request, middlewares=None,
                  context_processors=None):
         self.config = config
+        self.settings = settings = config.snapshot(self.settings_schema)
         self.base_dir = base_dir
         self.request_class = request_class
-        self.middlewares = list(
-            middlewares or []) + [session.session_middleware]
+        self.session_store = None
+        if config.get('session.store'):
+            from gurtel import session_store
+            self.session_store = session_store.store_from_config(config)
+        if self.session_store is None:
+            session_middleware = session.session_middleware
+        else:
+            session_middleware = session.store_session_middleware
+        self.middlewares = list(middlewares or [])
+        self.compressor = None
+        if settings['app.compress']:
+            from gurtel import compress
+            self.compressor = compress.compressor_from_config(settings)
+            self.middlewares.insert(0, self.compressor.compress_middleware)
+        if settings['app.access_log']:
+            from gurtel import log
+            self.middlewares.insert(0, log.access_log_middleware)
+        self.profiler = None
+        if settings['profile.sample_rate']:
+            # Rarely used modules are only imported if needed.
+            from gurtel import profiling
+            self.profiler = profiling.profiler_from_config(settings)
+        if self.profiler is not None:
+            self.middlewares.insert(0, self.profiler.profile_middleware)
+        if settings['app.conditional_get']:
+            from gurtel import conditional
+            self.middlewares.append(conditional.conditional_middleware)
+        self.middlewares.append(session_middleware)
+
+        self.metrics = None
+        if settings['app.metrics']:
+            self.metrics = metrics.Metrics(
+                timed_stages=settings['app.metrics_stages'])
+            self.wsgi_app = self.timed_wsgi_app
 
         self.dispatcher = dispatcher or dispatch.NullDispatcher()
-        response_callable = self.dispatcher.dispatch
-        for middleware in reversed(self.middlewares):
-            response_callable = partial(
-                middleware, response_callable=response_callable)
-        self.dispatch = response_callable
+        self._chain_inner = self.dispatcher.dispatch
+        if self.metrics is not None and self.metrics.timed_stages:
+            if not getattr(self.dispatcher, 'records_timings', False):
+                self._chain_inner = metrics.instrument_inner(
+                    self._chain_inner)
+        self._chains = {}
 
-        self.base_url = config.get('app.base_url', 'http://localhost')
+        self.base_url = settings['app.base_url']
         bits = urlparse.urlparse(self.base_url)
         self.server_scheme = bits.scheme
         self.server_host = bits.netloc
+        self._absolute_urls = LRUCache(settings['app.url_cache_size'])
 
         self.secret_key = config['app.secret_key']
 
+        self.assets = None
+        if settings['assets.dir']:
+            from gurtel import assets
+            self.assets = assets.handler_from_config(settings)
+
+        fragments = None
+        if config.get('templates.fragment_cache'):
+            from gurtel import fragment_cache
+            fragments = fragment_cache.cache_from_config(config)
+
         context_processors = list(
             context_processors or []) + [flash.context_processor]
         self.tpl = templates.TemplateRenderer(
             template_dir=os.path.join(base_dir, 'templates'),
             context_processors=context_processors,
+            bytecode_cache_dir=settings['templates.bytecode_cache_dir'],
+            production=settings['templates.production'],
+            stream_buffer_size=settings['templates.stream_buffer_size'],
+            fragment_cache=fragments,
+            cache_size=settings['templates.cache_size'],
+            asset_handler=self.assets,
             )
+        if settings['templates.precompile']:
+            self.tpl.precompile()
+
+        if self.assets is not None:
+            # Assets are served without creating a request, or middlewares.
+            self.wsgi_app = self.assets.wrap(self.wsgi_app)
 
-        if config.getbool('app.debugger', False):
+        if settings['app.debugger']:
+            from werkzeug.debug import DebuggedApplication
             self.wsgi_app = DebuggedApplication(self.wsgi_app, evalex=True)
 
+        self.config_watcher = None
+        if settings['app.config_reload'] and config.files:
+            from gurtel import watch
+            self.config_watcher = watch.FileWatcher(
+                config.files,
+                self.reload_config,
+                settings['app.config_reload_interval'],
+                ).start()
+
+    def close(self):
+        """Stop watching config files, if the app does."""
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
+
+    def reload_config(self):
+        """
+        Re-read config files, and swap in the new ``config`` and ``settings``.
+
+        The new settings are parsed and validated before anything is swapped;
+        if they are invalid the current config stays in place, and the error is
+        raised. Requests already in progress keep their ``request.settings``.
+
+        """
+        self.set_config(self.config.reloaded())
+
+    def set_config(self, config):
+        """
+        Swap in ``config``, and new ``settings`` parsed from it.
+
+        Settings are validated before anything is swapped. Only settings read
+        per request (see ``request_settings``) take effect; the rest were used
+        on creation.
+
+        """
+        settings = config.snapshot(self.settings_schema)
+        self.config = config
+        self.settings = settings
+
+    def warmup(self):
+        """
+        Do the work otherwise left to the first requests; return timings.
+
+        Compiles all templates (and finds the variables each uses), compiles
+        the URL map, imports handlers given as dotted paths, and compiles the
+        middleware chains. A pre-fork server should call this in its master
+        process, so that workers share the results copy-on-write.
+
+        Returns a dictionary of the seconds taken by each step.
+
+        """
+        timings = {}
+        start = timer()
+        for name in self.tpl.precompile(processes=1):
+            self.tpl.template_variables(name)
+        timings['templates'] = timer() - start
+
+        start = timer()
+        warmup = getattr(self.dispatcher, 'warmup', None)
+        if warmup is not None:
+            warmup(self.server_host)
+        handlers = set(getattr(self.dispatcher, 'handler_map', {}).values())
+        for handler in handlers:
+            self._chain_for(middleware.selection_key(handler))
+        self._chain_for(None)
+        timings['dispatch'] = timer() - start
+
+        timings['total'] = sum(timings.values())
+        return timings
+
+    def dispatch(self, request):
+        """
+        Dispatch ``request`` through middlewares to its handler.
+
+        Middlewares the handler opts out of (see ``gurtel.middleware``) are
+        skipped, if the dispatcher can tell the handler (``handler_for``). The
+        middleware chain for each distinct opt-out is compiled once and reused.
+
+        """
+        handler_for = getattr(self.dispatcher, 'handler_for', None)
+        if handler_for is None:
+            return self._chain_for(None)(request)
+        key = middleware.selection_key(handler_for(request))
+        return self._chain_for(key)(request)
+
+    def _chain_for(self, key):
+        chain = self._chains.get(key)
+        if chain is None:
+            selected = middleware.select(self.middlewares, key)
+            if self.metrics is not None and self.metrics.timed_stages:
+                selected = [metrics.instrument_middleware(m) for m in selected]
+            chain = self._chains[key] = middleware.compile_chain(
+                selected, self._chain_inner)
+        return chain
+
     def make_absolute_url(self, url):
         """Make a relative URL absolute by prepending ``self.base_url``."""
-        return urlparse.urljoin(self.base_url, url)
+        absolute = self._absolute_urls.get(url)
+        if absolute is None:
+            absolute = urlparse.urljoin(self.base_url, url)
+            self._absolute_urls.set(url, absolute)
+        return absolute
 
     def redirect_to(self, url_or_endpoint, **kwargs):
         """
@@ -107,10 +334,41 @@ class GurtelApp(object):
         """WSGI entry point."""
         request = self.request_class(environ)
         request.app = self
+        request.settings = self.settings
+        try:
+            response = self.dispatch(request)
+        except HTTPException as e:
+            response = e
+        return response(environ, start_response)
+
+    def timed_wsgi_app(self, environ, start_response):
+        """
+        WSGI entry point recording request metrics in ``self.metrics``.
+
+        Times are measured until the response object is returned; streaming
+        the response body isn't included. Requests raising an unhandled
+        exception are recorded with status 500. Stages are only timed if the
+        ``app.metrics_stages`` setting is on.
+
+        """
+        start = metrics.timer()
+        timings = metrics.RequestTimings(self.metrics.timed_stages)
+        request = self.request_class(environ)
+        request.app = self
+        request.settings = self.settings
+        request.timings = timings
+        if timings.stages is not None:
+            timings.stages.append(('request', metrics.timer() - start))
         try:
             response = self.dispatch(request)
         except HTTPException as e:
             response = e
+        except Exception:
+            self.metrics.observe(timings, 500, metrics.timer() - start)
+            raise
+        status = getattr(response, 'status_code', None) or getattr(
+            response, 'code', None)
+        self.metrics.observe(timings, status, metrics.timer() - start)
         return response(environ, start_response)
 
     def __call__(self, environ, start_response):
@@ -0,0 +1,268 @@
+"""Fingerprinted static assets: a build step, URLs and efficient serving."""
+import errno
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import tempfile
+
+from werkzeug.http import (
+    http_date, parse_etags, parse_range_header, quote_etag)
+from werkzeug.wsgi import get_path_info
+
+from .compress import is_compressible
+
+
+#: Name of the manifest file written to the build directory.
+MANIFEST = 'manifest.json'
+
+#: Cache lifetime of fingerprinted assets; they never change.
+MAX_AGE = 365 * 24 * 60 * 60
+
+BLOCK_SIZE = 64 * 1024
+
+
+class AssetNotFound(LookupError):
+    """No asset of the given name is in the manifest."""
+
+
+def content_type(name):
+    """Return the content type for a file ``name``."""
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def _atomic_write(path, write):
+    """Call ``write`` with a temporary file, then rename it to ``path``."""
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def fingerprint(path, name):
+    """Return ``name`` with a hash of the contents of file ``path`` in it."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), ''):
+            digest.update(block)
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, digest.hexdigest()[:12], ext)
+
+
+def build(source_dir, build_dir, compress_min_size=256):
+    """
+    Build the assets in ``source_dir`` into ``build_dir``; return manifest.
+
+    Each file is copied to a fingerprinted name, with a hash of its contents
+    (e.g. ``css/site.css`` becomes ``css/site.0123456789ab.css``), so that it
+    never changes and can be cached forever. Text files of at least
+    ``compress_min_size`` bytes also get a gzipped ``.gz`` variant, if that is
+    smaller. The manifest maps asset names to fingerprinted names; it is
+    written to ``manifest.json`` in ``build_dir``.
+
+    Files already built (with the same contents) are left alone, so builds
+    are incremental, and old versions remain for clients still using them.
+
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, source_dir).replace(os.path.sep, '/')
+            built_name = manifest[name] = fingerprint(path, name)
+            built_path = os.path.join(build_dir, *built_name.split('/'))
+            if os.path.exists(built_path):
+                continue
+            _atomic_write(built_path, lambda f: _copy(path, f))
+            if (is_compressible(content_type(name)) and
+                    os.path.getsize(path) >= compress_min_size):
+                _atomic_write(built_path + '.gz', lambda f: _gzip(path, f))
+                if os.path.getsize(built_path + '.gz') >= os.path.getsize(
+                        path):
+                    os.unlink(built_path + '.gz')
+
+    def _write_manifest(f):
+        json.dump(
+            manifest, f, indent=2, separators=(',', ': '), sort_keys=True)
+        f.write('\n')
+
+    _atomic_write(os.path.join(build_dir, MANIFEST), _write_manifest)
+    return manifest
+
+
+def _copy(path, f):
+    with open(path, 'rb') as source:
+        shutil.copyfileobj(source, f, BLOCK_SIZE)
+
+
+def _gzip(path, f):
+    # A fixed mtime makes builds reproducible.
+    with open(path, 'rb') as source:
+        gz = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0)
+        try:
+            shutil.copyfileobj(source, gz, BLOCK_SIZE)
+        finally:
+            gz.close()
+
+
+class _File(object):
+    """A built asset file, as indexed by ``AssetHandler``."""
+    __slots__ = ['path', 'size', 'gzip_size', 'etag', 'headers']
+
+    def __init__(self, path, built_name):
+        st = os.stat(path)
+        self.path = path
+        self.size = st.st_size
+        self.gzip_size = None
+        if os.path.exists(path + '.gz'):
+            self.gzip_size = os.path.getsize(path + '.gz')
+        # The built name includes a hash of the contents.
+        self.etag = quote_etag(built_name)
+        self.headers = [
+            ('Content-Type', content_type(built_name)),
+            ('Cache-Control', 'public, max-age=%d, immutable' % MAX_AGE),
+            ('Last-Modified', http_date(st.st_mtime)),
+            ('Accept-Ranges', 'bytes'),
+            ]
+        if self.gzip_size is not None:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+
+
+class AssetHandler(object):
+    """
+    Serves and resolves URLs of assets built by ``build`` into ``build_dir``.
+
+    The manifest and built files are indexed once, on creation; thereafter the
+    filesystem is only touched to open a file being served. ``url(name)``
+    returns the URL of asset ``name`` under ``url_prefix``; it is available to
+    templates as ``asset_url`` (see ``TemplateRenderer``).
+
+    The handler is a WSGI app serving the built files, with far-future cache
+    headers. The gzipped variant is served to clients that accept it, and
+    single byte ranges are supported. Files are sent with the server's
+    ``wsgi.file_wrapper`` (which may use ``sendfile``), or else read a block
+    at a time; they are never read into memory whole. ``wrap(app)`` returns a
+    WSGI app serving requests under ``url_prefix`` this way, and passing all
+    others to ``app``.
+
+    """
+    def __init__(self, build_dir, url_prefix='/static/'):
+        self.build_dir = build_dir
+        self.url_prefix = url_prefix.rstrip('/') + '/'
+        with open(os.path.join(build_dir, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.files = {}
+        for built_name in self.manifest.values():
+            self.files[built_name] = _File(
+                os.path.join(build_dir, *built_name.split('/')), built_name)
+
+    def url(self, name):
+        """Return URL of asset ``name``; raise ``AssetNotFound`` if none."""
+        try:
+            return self.url_prefix + self.manifest[name]
+        except KeyError:
+            raise AssetNotFound(name)
+
+    def wrap(self, app):
+        """Return a WSGI app serving assets, and passing other requests on."""
+        prefix = self.url_prefix
+
+        def _wsgi_app(environ, start_response):
+            if environ.get('PATH_INFO', '').startswith(prefix):
+                return self(environ, start_response)
+            return app(environ, start_response)
+
+        return _wsgi_app
+
+    def __call__(self, environ, start_response):
+        built_name = get_path_info(environ)[len(self.url_prefix):]
+        asset = self.files.get(built_name)
+        method = environ['REQUEST_METHOD']
+        if asset is None or method not in ('GET', 'HEAD'):
+            status = '404 Not Found' if asset is None else (
+                '405 Method Not Allowed')
+            start_response(status, [('Content-Type', 'text/plain')])
+            return [status]
+        headers = list(asset.headers)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            for tag in (built_name, built_name + '.gz'):
+                if etags.contains(tag):
+                    headers.append(('ETag', quote_etag(tag)))
+                    start_response('304 Not Modified', headers)
+                    return []
+
+        path, etag, start, length = asset.path, asset.etag, 0, asset.size
+        status = '200 OK'
+        byte_range = None
+        if environ.get('HTTP_IF_RANGE', etag) == etag:
+            byte_range = parse_range_header(environ.get('HTTP_RANGE'))
+        if byte_range is not None and len(byte_range.ranges) == 1:
+            # Requests for several ranges get the whole file.
+            bounds = byte_range.range_for_length(asset.size)
+            if bounds is None:
+                headers.append(('Content-Range', 'bytes */%d' % asset.size))
+                start_response('416 Requested Range Not Satisfiable', headers)
+                return []
+            start, stop = bounds
+            length = stop - start
+            status = '206 Partial Content'
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+                start, stop - 1, asset.size)))
+        elif asset.gzip_size is not None and 'gzip' in environ.get(
+                'HTTP_ACCEPT_ENCODING', ''):
+            path, length = path + '.gz', asset.gzip_size
+            etag = quote_etag(built_name + '.gz')
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('ETag', etag))
+        headers.append(('Content-Length', str(length)))
+        start_response(status, headers)
+        if method == 'HEAD':
+            return []
+
+        f = open(path, 'rb')
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if status == '200 OK' and file_wrapper is not None:
+            return file_wrapper(f, BLOCK_SIZE)
+        return _read_blocks(f, start, length)
+
+
+def _read_blocks(f, start, length):
+    """Yield ``length`` bytes of file ``f`` from ``start``, and close it."""
+    try:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        f.close()
+
+
+def handler_from_config(settings):
+    """
+    Return the ``AssetHandler`` configured in ``settings``, or ``None``.
+
+    Assets are served if ``assets.dir`` (the build directory) is set, under
+    ``assets.url_prefix`` (default ``/static/``).
+
+    """
+    if not settings['assets.dir']:
+        return None
+    return AssetHandler(settings['assets.dir'], settings['assets.url_prefix'])
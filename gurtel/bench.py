@@ -0,0 +1,93 @@
+"""Micro-benchmarks with stored JSON baselines."""
+import json
+import os
+import timeit
+
+
+class BenchmarkRegression(AssertionError):
+    """A benchmark ran slower than its baseline allows."""
+
+
+def measure(func, min_time=0.1, repeat=5):
+    """
+    Return best time per call of ``func``, in seconds.
+
+    ``func`` is called in batches sized so each batch takes at least
+    ``min_time`` seconds; the fastest of ``repeat`` batches is used.
+
+    """
+    number = 1
+    while timeit.timeit(func, number=number) < min_time:
+        number *= 10
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def load_baseline(path):
+    """Return benchmark results stored at ``path`` (empty if no file)."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    """Store benchmark ``results`` (names to seconds) at ``path``."""
+    with open(path, 'w') as f:
+        json.dump(
+            results, f, indent=2, separators=(',', ': '), sort_keys=True)
+        f.write('\n')
+
+
+class BenchmarkSession(object):
+    """
+    Runs benchmarks and compares them with a stored baseline.
+
+    Calling the session with a name and a function measures it; if the
+    baseline at ``baseline_path`` has a time for that name and the function is
+    more than ``threshold`` (a fraction) slower, raises
+    ``BenchmarkRegression``. Benchmarks with no baseline time can't regress;
+    ``missing()`` lists them. ``finish()`` stores all results (merged into the
+    existing baseline) if ``save`` is true.
+
+    """
+    def __init__(self, baseline_path, threshold=0.25, save=False,
+                 min_time=0.1):
+        self.baseline_path = baseline_path
+        self.threshold = threshold
+        self.save = save
+        self.min_time = min_time
+        self.baseline = load_baseline(baseline_path)
+        self.results = {}
+
+    def __call__(self, name, func):
+        seconds = self.results[name] = measure(func, self.min_time)
+        baseline = self.baseline.get(name)
+        if baseline is not None and not self.save and (
+                seconds > baseline * (1 + self.threshold)):
+            raise BenchmarkRegression(
+                "Benchmark %r took %.2fus, more than %d%% slower than the "
+                "baseline %.2fus." % (
+                    name, seconds * 1e6, self.threshold * 100, baseline * 1e6))
+        return seconds
+
+    def report(self):
+        """Return list of report lines comparing results with the baseline."""
+        lines = []
+        for name, seconds in sorted(self.results.items()):
+            baseline = self.baseline.get(name)
+            change = 'no baseline'
+            if baseline:
+                change = '%+.1f%%' % ((seconds / baseline - 1) * 100)
+            lines.append('%-32s %12.2fus %11s' % (name, seconds * 1e6, change))
+        return lines
+
+    def missing(self):
+        """Return sorted names of results with no baseline to compare with."""
+        return sorted(
+            name for name in self.results if not self.baseline.get(name))
+
+    def finish(self):
+        if self.save and self.results:
+            results = dict(self.baseline)
+            results.update(self.results)
+            save_baseline(self.baseline_path, results)
@@ -0,0 +1,144 @@
+"""Small in-process caches."""
+from collections import OrderedDict
+import binascii
+import errno
+import os
+import threading
+import time
+
+from werkzeug.contrib import cache
+
+
+NOT_FOUND = object()
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded least-recently-used mapping.
+
+    Counts ``hits`` and ``misses`` of ``get``. A ``maxsize`` of ``None`` means
+    the cache is unbounded.
+
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return cached value for ``key`` (marking it recently used)."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache ``value`` under ``key``, evicting the oldest if full."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove ``key`` from the cache, if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Empty the cache (hit and miss counts are kept)."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return a dictionary of cache statistics."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryCache(cache.BaseCache):
+    """
+    In-process Werkzeug cache backend; an ``LRUCache`` with expiry.
+
+    Holds at most ``maxsize`` values; a timeout of 0 means never expire.
+
+    """
+    def __init__(self, maxsize=1024, default_timeout=300):
+        cache.BaseCache.__init__(self, default_timeout)
+        self._cache = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires < time.time():
+            self._cache.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else None
+        self._cache.set(key, (expires, value))
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self.get(key) is not None:
+                return False
+            self.set(key, value, timeout)
+            return True
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """Return underlying ``LRUCache`` statistics."""
+        return self._cache.stats()
+
+
+class FileSystemCache(cache.FileSystemCache):
+    """
+    Werkzeug ``FileSystemCache`` with an atomic ``add``.
+
+    Can be shared between processes, and ``add`` used as a lock.
+
+    """
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        tmp_key = '%s.%s' % (key, binascii.hexlify(os.urandom(16)))
+        self.set(tmp_key, value, timeout)
+        tmp_filename = self._get_filename(tmp_key)
+        try:
+            os.link(tmp_filename, self._get_filename(key))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        finally:
+            os.remove(tmp_filename)
+        return True
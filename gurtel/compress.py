@@ -0,0 +1,223 @@
+"""Response compression middleware, with a cache of compressed bodies."""
+import hashlib
+import zlib
+
+from werkzeug.wrappers import BaseResponse
+
+from .cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+#: Content types (besides ``text/*``) worth compressing.
+COMPRESSIBLE = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    ])
+
+#: Compression levels by encoding: ``(max body size, level)`` pairs, the last
+#: with no maximum. Small bodies are cheap to compress hard; large ones get
+#: faster levels.
+LEVELS = {
+    'br': ((16 * 1024, 7), (256 * 1024, 5), (None, 4)),
+    'gzip': ((16 * 1024, 9), (256 * 1024, 6), (None, 4)),
+    'deflate': ((16 * 1024, 9), (256 * 1024, 6), (None, 4)),
+    }
+
+
+def is_compressible(mimetype):
+    """Return ``True`` if content of ``mimetype`` is worth compressing."""
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE or (
+        mimetype.endswith(('+json', '+xml')))
+
+
+def level_for_size(encoding, size):
+    """Return compression level for a body of ``size`` (``None``: unknown)."""
+    levels = LEVELS[encoding]
+    if size is None:
+        return levels[1][1]
+    for max_size, level in levels:
+        if max_size is None or size <= max_size:
+            return level
+
+
+class _ZlibEncoder(object):
+    def __init__(self, encoding, level):
+        wbits = zlib.MAX_WBITS
+        if encoding == 'gzip':
+            wbits += 16
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._compressobj.compress(data)
+
+    def flush(self):
+        return self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressobj.flush()
+
+
+class _BrotliEncoder(object):
+    def __init__(self, encoding, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def encoder(encoding, level):
+    """
+    Return an incremental encoder for ``encoding`` at ``level``.
+
+    It has methods ``compress(data)``, ``flush()`` (to emit everything passed
+    in so far) and ``finish()``, each returning compressed bytes.
+
+    """
+    if encoding == 'br':
+        return _BrotliEncoder(encoding, level)
+    return _ZlibEncoder(encoding, level)
+
+
+def compress(data, encoding, level=None):
+    """Return ``data`` compressed with ``encoding`` (level by size)."""
+    if level is None:
+        level = level_for_size(encoding, len(data))
+    e = encoder(encoding, level)
+    return e.compress(data) + e.finish()
+
+
+def _compress_stream(iterable, encoding, charset):
+    e = encoder(encoding, level_for_size(encoding, None))
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(charset)
+            # Flushed per chunk, so the response still streams.
+            data = e.compress(chunk) + e.flush()
+            if data:
+                yield data
+        yield e.finish()
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compressor(object):
+    """
+    Compresses responses with the best encoding the client accepts.
+
+    ``compress_middleware`` compresses successful responses of compressible
+    content types (see ``is_compressible``) with brotli (if the ``brotli``
+    package is installed), gzip or deflate, with a level chosen by body size
+    (see ``LEVELS``). Bodies smaller than ``min_size`` bytes, and responses
+    that already have a Content-Encoding, are left alone. Streamed responses
+    are compressed incrementally as they are sent.
+
+    Compressed bodies of responses with a strong ETag (such as those added by
+    ``gurtel.conditional.conditional_middleware``) are cached, keyed on a
+    digest of the body as well, up to ``cache_size`` of them, each of at most
+    ``cache_max_size`` bytes uncompressed; so hot pages are compressed only
+    once. The encoding is
+    appended to the ETag of compressed responses (and stripped from the
+    client's If-None-Match), so they remain valid for conditional requests.
+
+    """
+    def __init__(self, min_size=500, cache_size=256,
+                 cache_max_size=1024 * 1024):
+        self.min_size = min_size
+        self.encodings = ['gzip', 'deflate']
+        if brotli is not None:
+            self.encodings.insert(0, 'br')
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.cache_max_size = cache_max_size
+
+    def compress_middleware(self, request, response_callable):
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response_callable(request)
+        if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            request.environ['HTTP_IF_NONE_MATCH'] = if_none_match.replace(
+                '-%s"' % encoding, '"')
+
+        response = response_callable(request)
+        if not isinstance(response, BaseResponse) or (
+                'Content-Encoding' in response.headers):
+            return response
+        if response.status_code == 304:
+            # Has no Content-Type; the ETag matched one with the encoding.
+            response.vary.add('Accept-Encoding')
+            _set_etag(response, encoding)
+            return response
+        if not is_compressible(response.mimetype):
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200:
+            return response
+
+        if response.is_streamed:
+            response.response = _compress_stream(
+                response.response, encoding, response.charset)
+            del response.headers['Content-Length']
+        else:
+            data = response.data
+            if len(data) < self.min_size:
+                return response
+            response.data = self._compress(response, data, encoding)
+        response.headers['Content-Encoding'] = encoding
+        _set_etag(response, encoding)
+        return response
+
+    compress_middleware.middleware_name = 'compress'
+
+    def _compress(self, response, data, encoding):
+        etag, weak = response.get_etag()
+        if (self.cache is None or etag is None or weak or
+                len(data) > self.cache_max_size):
+            return compress(data, encoding)
+        # ETags declared from version keys (``conditional(etag=...)``) needn't
+        # cover per-user content; only the body itself identifies it.
+        key = (etag, encoding, hashlib.sha1(data).digest())
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = compress(data, encoding)
+            self.cache.set(key, compressed)
+        return compressed
+
+
+def _set_etag(response, encoding):
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag('%s-%s' % (etag, encoding), weak)
+
+
+def compressor_from_config(settings):
+    """
+    Return the ``Compressor`` configured in ``settings``, or ``None``.
+
+    Compression is on if ``app.compress`` is set. Bodies under
+    ``compress.min_size`` bytes aren't compressed; up to
+    ``compress.cache_size`` compressed bodies (of at most
+    ``compress.cache_max_size`` bytes uncompressed) are cached.
+
+    """
+    if not settings['app.compress']:
+        return None
+    return Compressor(
+        settings['compress.min_size'],
+        settings['compress.cache_size'],
+        settings['compress.cache_max_size'],
+        )
@@ -0,0 +1,91 @@
+"""Conditional GET support: ETags, Last-Modified and 304 responses."""
+from functools import wraps
+import hashlib
+
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+from werkzeug.wrappers import BaseResponse, Response
+
+
+def etag_for(*version_keys):
+    """Return an ETag value from any number of (repr-able) version keys."""
+    return hashlib.sha1(repr(version_keys)).hexdigest()
+
+
+def conditional(etag=None, last_modified=None, weak=False):
+    """
+    Decorator for request handlers answering conditional GET/HEAD cheaply.
+
+    ``etag`` and ``last_modified`` should be callables taking the same
+    arguments as the handler and returning, respectively, an ETag value (see
+    ``etag_for``) and a ``datetime``. They are called before the handler; if
+    the client's ``If-None-Match`` or ``If-Modified-Since`` headers show it
+    already has the resource, a 304 response is returned without calling the
+    handler at all. Otherwise the ETag and Last-Modified headers are set on the
+    handler's response; meanwhile they are available to the handler as
+    ``request.validators`` (so template renders for HEAD requests can be
+    skipped; see ``TemplateRenderer.render``).
+
+    """
+    def _decorator(func):
+        @wraps(func)
+        def _inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(request, *args, **kwargs)
+            headers = {}
+            if etag is not None:
+                headers['ETag'] = quote_etag(
+                    etag(request, *args, **kwargs), weak)
+            if last_modified is not None:
+                headers['Last-Modified'] = http_date(
+                    last_modified(request, *args, **kwargs))
+            if not is_resource_modified(
+                    request.environ,
+                    headers.get('ETag'),
+                    last_modified=headers.get('Last-Modified'),
+                    ):
+                return Response(status=304, headers=headers)
+            request.validators = headers
+            response = func(request, *args, **kwargs)
+            if isinstance(response, BaseResponse):
+                for k, v in headers.items():
+                    response.headers.setdefault(k, v)
+            return response
+
+        return _inner
+
+    return _decorator
+
+
+def conditional_middleware(request, response_callable):
+    """
+    Conditional GET middleware.
+
+    Adds an ETag (hashed from the body) to successful GET and HEAD responses
+    that don't have one, except streamed responses. Answers requests whose
+    ``If-None-Match`` or ``If-Modified-Since`` headers match the response with
+    a bodiless 304.
+
+    Streamed responses (including template renders for HEAD requests to
+    ``conditional`` handlers) are never buffered: they are only compared by the ETag and Last-Modified
+    headers they already have (such as those set by ``conditional``).
+
+    """
+    response = response_callable(request)
+    if request.method not in ('GET', 'HEAD') or not isinstance(
+            response, BaseResponse) or response.status_code != 200:
+        return response
+    if not response.is_streamed:
+        response.add_etag()
+        return response.make_conditional(request)
+    headers = {}
+    for key in ('ETag', 'Last-Modified'):
+        if key in response.headers:
+            headers[key] = response.headers[key]
+    if headers and not is_resource_modified(
+            request.environ,
+            headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'),
+            ):
+        response.close()
+        return Response(status=304, headers=headers)
+    return response
@@ -5,6 +5,64 @@ import os
 NOT_PROVIDED = object()
 
 
+# Maps absolute config file paths to (stat stamp, parsed items).
+_parsed_files = {}
+
+
+def file_stamp(path):
+    """Return a stamp that changes when file ``path`` changes (or ``None``)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def parse_file(conf_file):
+    """
+    Return list of ``(key, value)`` pairs from an ini-style config file.
+
+    Parse results are cached until the file's modification time, size or inode
+    changes.
+
+    """
+    path = os.path.abspath(conf_file)
+    stamp = file_stamp(path)
+    cached = _parsed_files.get(path)
+    if cached is not None and stamp is not None and cached[0] == stamp:
+        return cached[1]
+
+    parser = RawConfigParser()
+    with open(conf_file) as f:
+        parser.readfp(f)
+
+    items = []
+    for section in parser.sections():
+        for k, v in parser.items(section):
+            items.append(('.'.join([section, k]), v))
+
+    _parsed_files[path] = (stamp, items)
+    return items
+
+
+class ConfigSnapshot(dict):
+    """
+    Immutable dictionary of parsed, typed config values.
+
+    Created by ``Config.snapshot``; raises ``TypeError`` on any attempt to
+    modify it.
+
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Config snapshots are immutable.")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
 class Config(object):
     """Dictionary-like configuration holder."""
     def __init__(self, data=None):
@@ -13,6 +71,8 @@ class Config(object):
             self.data.update(data)
         # Maps keys to their source file (if any)
         self.sourcemap = {}
+        # Config files read, in order
+        self.files = []
 
     def read_from_file(self, conf_file):
         """
@@ -27,18 +87,32 @@ class Config(object):
         results in a config key ``section.foo`` with value ``"bar"``.
 
         """
-        parser = RawConfigParser()
-        with open(conf_file) as f:
-            parser.readfp(f)
-
-        for section in parser.sections():
-            for k, v in parser.items(section):
-                key = '.'.join([section, k])
-                self.data[key] = v
-                self.sourcemap[key] = conf_file
+        for key, v in parse_file(conf_file):
+            self.data[key] = v
+            self.sourcemap[key] = conf_file
+        if conf_file not in self.files:
+            self.files.append(conf_file)
 
         return self
 
+    def reloaded(self):
+        """
+        Return a new config with values re-read from this config's files.
+
+        Values that didn't come from a file (from the environment or
+        ``update``) are kept as they are.
+
+        """
+        c = self.__class__()
+        for conf_file in self.files:
+            c.read_from_file(conf_file)
+        for k, v in self.data.items():
+            if self.sourcemap.get(k) is None:
+                c.data[k] = v
+                c.sourcemap[k] = None
+
+        return c
+
     def read_from_env(self, prefix, env=None):
         """
         Read config from given env dict (``os.environ`` by default).
@@ -70,6 +144,7 @@ class Config(object):
         """Return a copy of this config."""
         c = self.__class__(self.data)
         c.sourcemap = self.sourcemap.copy()
+        c.files = list(self.files)
 
         return c
 
@@ -139,3 +214,83 @@ class Config(object):
             val = os.path.join(os.path.dirname(source), val)
 
         return val
+
+    def getint(self, key, default=NOT_PROVIDED):
+        """Get an integer config value; raise ``ValueError`` if not one."""
+        return self._getnumber(int, 'an integer', key, default)
+
+    def getfloat(self, key, default=NOT_PROVIDED):
+        """Get a float config value; raise ``ValueError`` if not one."""
+        return self._getnumber(float, 'a number', key, default)
+
+    def _getnumber(self, type_, description, key, default):
+        try:
+            val = self[key]
+        except KeyError:
+            if default is NOT_PROVIDED:
+                raise
+            return default
+
+        try:
+            return type_(val)
+        except (TypeError, ValueError):
+            raise ValueError(
+                "Value %r for config key %r is not %s."
+                % (val, key, description)
+                )
+
+    def _getstr(self, key, default=NOT_PROVIDED):
+        if default is NOT_PROVIDED:
+            return self[key]
+        return self.get(key, default)
+
+    def getlist(self, key, default=NOT_PROVIDED):
+        """
+        Get a list config value.
+
+        The value is split on commas and newlines; items are stripped of
+        whitespace, and empty items dropped.
+
+        """
+        try:
+            val = self[key]
+        except KeyError:
+            if default is NOT_PROVIDED:
+                raise
+            return default
+
+        items = val.replace('\n', ',').split(',')
+        return [item.strip() for item in items if item.strip()]
+
+    getters = {
+        'str': '_getstr',
+        'bool': 'getbool',
+        'int': 'getint',
+        'float': 'getfloat',
+        'path': 'getpath',
+        'list': 'getlist',
+        }
+
+    def snapshot(self, schema):
+        """
+        Return a ``ConfigSnapshot`` of typed values for the keys in ``schema``.
+
+        ``schema`` maps each config key to its type, or to a ``(type,
+        default)`` pair. Types are ``str``, ``bool``, ``int``, ``float``,
+        ``path`` and ``list`` (parsed as by ``getbool``, ``getpath`` etc). All
+        values are parsed and validated up front, so reading the snapshot is a
+        plain dictionary lookup.
+
+        A key missing from the config takes its default (which isn't parsed);
+        if it has none, raises ``KeyError``. Raises ``ValueError`` for values
+        that don't parse as their type.
+
+        """
+        data = {}
+        for key, spec in schema.items():
+            if isinstance(spec, tuple):
+                type_, default = spec
+            else:
+                type_, default = spec, NOT_PROVIDED
+            data[key] = getattr(self, self.getters[type_])(key, default)
+        return ConfigSnapshot(data)
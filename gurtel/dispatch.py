@@ -1,5 +1,30 @@
-from werkzeug.exceptions import NotFound
+from timeit import default_timer as timer
+
+from werkzeug.exceptions import HTTPException, NotFound
 from werkzeug.routing import BuildError
+from werkzeug.wsgi import get_path_info
+
+from .cache import LRUCache, NOT_FOUND
+from .imp import import_from_dotted_path
+
+
+def build_cache_key(*parts):
+    """
+    Return a hashable cache key for URL-building ``parts``.
+
+    A trailing dictionary of URL arguments is made order-independent, and each
+    value's type is part of the key (so ``1`` and ``True`` don't collide).
+    Returns ``None`` if any argument value is unhashable.
+
+    """
+    head, kwargs = parts[:-1], parts[-1]
+    key = head + (
+        tuple(sorted((k, type(v), v) for k, v in kwargs.items())),)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
 
 class NullDispatcher(object):
@@ -10,23 +35,191 @@ class NullDispatcher(object):
     def dispatch(self, request):
         raise NotFound()
 
+    def handler_for(self, request):
+        return None
+
+    def warmup(self, server_host=None):
+        pass
+
 
 class MapDispatcher(object):
-    """Dispatcher that accepts a Map and a mapping of endpoints to handlers."""
-    def __init__(self, url_map, handler_map):
+    """
+    Dispatcher that accepts a Map and a mapping of endpoints to handlers.
+
+    Bound ``MapAdapter`` instances are reused per (host, scheme, script name),
+    up to ``adapter_cache_size`` of them (the host comes from the client, so
+    they are bounded like the match cache), and successful matches are kept in an LRU cache (of ``match_cache_size``
+    entries) keyed on (method, host, path), so repeated requests for the same
+    path skip URL matching entirely. Both caches are dropped automatically if
+    rules are added to the map (or the map is replaced), or explicitly via
+    ``invalidate()``.
+
+    Likewise ``url_for`` reuses one build adapter per server host and keeps
+    built URLs in an LRU cache (of ``build_cache_size`` entries) keyed on
+    host, endpoint and arguments.
+
+    Handlers may be given as dotted paths (e.g. ``'myapp.views.index'``), to
+    be imported on first use (or by ``warmup()``).
+
+    """
+    #: ``dispatch`` records its own time in request timings.
+    records_timings = True
+
+    def __init__(self, url_map, handler_map, match_cache_size=1024,
+                 build_cache_size=1024, adapter_cache_size=64):
         self.url_map = url_map
         self.handler_map = handler_map
+        self.match_cache = LRUCache(match_cache_size)
+        self.build_cache = LRUCache(build_cache_size)
+        self._adapters = LRUCache(adapter_cache_size)
+        self._build_adapters = LRUCache(adapter_cache_size)
+        self._map_state = None
 
     def url_for(self, server_host, endpoint, **kwargs):
         """Build and return URL for given server host, endpoint and kwargs."""
-        adapter = self.url_map.bind(server_host)
-        return adapter.build(endpoint, kwargs)
+        self._check_map()
+        key = build_cache_key(server_host, endpoint, kwargs)
+        if key is None:
+            return self._build(server_host, endpoint, kwargs)
+        url = self.build_cache.get(key)
+        if url is None:
+            url = self._build(server_host, endpoint, kwargs)
+            self.build_cache.set(key, url)
+        return url
 
     def dispatch(self, request):
-        """Dispatch ``request`` and return a ``Response``."""
-        adapter = self.url_map.bind_to_environ(request)
-        endpoint, kwargs = adapter.match()
+        """
+        Dispatch ``request`` and return a ``Response``.
+
+        If the request is being timed (see ``gurtel.metrics``), records its
+        endpoint; and if timing stages, the time taken by URL matching and by
+        the handler (adding the total to ``timings.inner``, so it isn't counted
+        against middlewares; see ``records_timings``).
+
+        """
+        timings = getattr(request, 'timings', None)
+        if timings is None or timings.stages is None:
+            endpoint, kwargs = self.match(request)
+            if timings is not None:
+                timings.endpoint = endpoint
+            handler = self.get_handler(endpoint)
+            if handler is None:
+                raise NotFound()
+            return handler(request, **kwargs)
+        start = timer()
+        handler = None
+        try:
+            endpoint, kwargs = self.match(request)
+            handler = self.get_handler(endpoint)
+            timings.endpoint = endpoint
+            dispatched = timer()
+            timings.stages.append(('dispatch', dispatched - start))
+            if handler is None:
+                raise NotFound()
+            return handler(request, **kwargs)
+        finally:
+            end = timer()
+            if handler is not None:
+                timings.stages.append(('handler', end - dispatched))
+            timings.inner += end - start
+
+    def handler_for(self, request):
+        """
+        Return the handler ``request`` would be dispatched to, or ``None``.
+
+        Uses the match cache, so a following ``dispatch`` matches cheaply.
+
+        """
+        try:
+            endpoint, kwargs = self.match(request)
+        except HTTPException:
+            return None
+        return self.get_handler(endpoint)
+
+    def get_handler(self, endpoint):
+        """Return handler for ``endpoint`` or ``None``, importing if needed."""
         handler = self.handler_map.get(endpoint)
-        if handler is None:
-            raise NotFound()
-        return handler(request, **kwargs)
+        if isinstance(handler, basestring):
+            handler = self.handler_map[endpoint] = import_from_dotted_path(
+                handler)
+        return handler
+
+    def warmup(self, server_host=None):
+        """
+        Do the work otherwise done on first dispatch and URL build.
+
+        Sorts the map's rules, binds a build adapter for ``server_host`` (if
+        given), and imports handlers given as dotted paths.
+
+        """
+        self._check_map()
+        self.url_map.update()
+        if server_host is not None and (
+                server_host not in self._build_adapters):
+            self._build_adapters.set(
+                server_host, self.url_map.bind(server_host))
+        for endpoint in list(self.handler_map):
+            self.get_handler(endpoint)
+
+    def match(self, request):
+        """Return ``(endpoint, kwargs)`` for ``request`` (or WSGI environ)."""
+        self._check_map()
+        environ = getattr(request, 'environ', request)
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME')
+        path = get_path_info(environ, charset=self.url_map.charset)
+        method = environ['REQUEST_METHOD']
+        key = (method, host, path)
+        cached = self.match_cache.get(key, NOT_FOUND)
+        if cached is not NOT_FOUND:
+            endpoint, kwargs = cached
+            return endpoint, dict(kwargs)
+        endpoint, kwargs = self._get_adapter(environ).match(
+            path, method, query_args=environ.get('QUERY_STRING', ''))
+        self.match_cache.set(key, (endpoint, kwargs))
+        return endpoint, dict(kwargs)
+
+    def invalidate(self):
+        """Drop all cached adapters and match results."""
+        self._adapters.clear()
+        self._build_adapters.clear()
+        self.match_cache.clear()
+        self.build_cache.clear()
+
+    def cache_stats(self):
+        """Return match cache statistics (hits, misses, size, maxsize)."""
+        stats = self.match_cache.stats()
+        stats['adapters'] = len(self._adapters)
+        return stats
+
+    def build_cache_stats(self):
+        """Return URL build cache statistics (hits, misses, size, maxsize)."""
+        return self.build_cache.stats()
+
+    def _build(self, server_host, endpoint, kwargs):
+        adapter = self._build_adapters.get(server_host)
+        if adapter is None:
+            adapter = self.url_map.bind(server_host)
+            self._build_adapters.set(server_host, adapter)
+        return adapter.build(endpoint, kwargs)
+
+    def _get_adapter(self, environ):
+        key = (
+            environ.get('HTTP_HOST'),
+            environ.get('SERVER_NAME'),
+            environ.get('SERVER_PORT'),
+            environ.get('wsgi.url_scheme'),
+            environ.get('SCRIPT_NAME'),
+            )
+        adapter = self._adapters.get(key)
+        if adapter is None:
+            adapter = self.url_map.bind_to_environ(environ)
+            self._adapters.set(key, adapter)
+        return adapter
+
+    def _check_map(self):
+        # Werkzeug maps only ever grow (via ``Map.add``), so the identity of
+        # the map plus its rule count is enough to notice a change.
+        state = (id(self.url_map), len(self.url_map._rules))
+        if state != self._map_state:
+            self.invalidate()
+            self._map_state = state
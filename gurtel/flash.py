@@ -1,7 +1,10 @@
 """Session-based flash messaging."""
 from werkzeug.utils import cached_property
 
+from .templates import provides
 
+
+@provides('flash')
 def context_processor(request):
     return {'flash': request.flash.get_and_clear()}
 
@@ -11,12 +14,16 @@ class FlashRequestMixin(object):
     Request mixin that provides ``request.flash`` property.
 
     Requires request object to have a ``self.session`` property that is a
-    dictionary-like object.
+    dictionary-like object. The ``flash.max_messages`` setting (from
+    ``self.settings``, if present) bounds the number of queued messages.
 
     """
     @cached_property
     def flash(self):
-        return Flash(self.session)
+        settings = getattr(self, 'settings', None)
+        if settings is None:
+            return Flash(self.session)
+        return Flash(self.session, max_messages=settings['flash.max_messages'])
 
 
 class Flash(object):
@@ -26,20 +33,47 @@ class Flash(object):
     Instantiate with a session (any dictionary-like object) and a key to use in
     the session (defaults to 'flash').
 
+    Messages are queued in the session, oldest first, in the compact form
+    ``[level, message]`` (or ``[level, message, count]``). Sending the same
+    message as the most recently queued one just increments its count. At most
+    ``max_messages`` messages are kept; the oldest are dropped beyond that.
+
+    Reading messages never modifies the session unless there are messages.
+
     """
-    def __init__(self, session, key='flash'):
+    def __init__(self, session, key='flash', max_messages=20):
         self.session = session
         self.key = key
+        self.max_messages = max_messages
 
-    @cached_property
+    @property
     def messages(self):
-        return self.session.setdefault(self.key, [])
+        """List of queued messages (as dicts), oldest first."""
+        return [_expand(m) for m in self._queue()]
+
+    def _queue(self):
+        queue = self.session.get(self.key)
+        if queue and isinstance(queue[0], dict):
+            # Legacy format: list of dicts, newest first.
+            queue = [[m['level'], m['message']] for m in reversed(queue)]
+            self.session[self.key] = queue
+        return queue or []
 
     def send(self, level, message):
         """Send a flash message."""
-        # We iterate through messages in reverse order due to the use of pop(),
-        # so inserting at the beginning preserves FIFO.
-        self.messages.insert(0, {'level': level, 'message': message})
+        queue = self._queue()
+        if not queue:
+            queue = self.session[self.key] = []
+        if queue and queue[-1][0] == level and queue[-1][1] == message:
+            last = queue[-1]
+            if len(last) == 2:
+                last.append(2)
+            else:
+                last[2] += 1
+        else:
+            queue.append([level, message])
+            if len(queue) > self.max_messages:
+                del queue[:len(queue) - self.max_messages]
         self.session.modified = True
 
     def success(self, message):
@@ -59,7 +93,25 @@ class Flash(object):
         self.send('error', message)
 
     def get_and_clear(self):
-        while self.messages:
-            msg = self.messages.pop()
+        """
+        Generate queued messages (as dicts), oldest first, clearing them.
+
+        Each message is removed from the session as it is generated, so
+        messages not iterated through remain queued.
+
+        """
+        queue = self._queue()
+        while queue:
+            item = queue.pop(0)
+            if not queue:
+                del self.session[self.key]
             self.session.modified = True
-            yield msg
+            yield _expand(item)
+
+
+def _expand(item):
+    return {
+        'level': item[0],
+        'message': item[1],
+        'count': item[2] if len(item) > 2 else 1,
+        }
@@ -0,0 +1,183 @@
+"""Caching of rendered template fragments."""
+from collections import Counter
+import hashlib
+import threading
+import time
+
+from jinja2 import Markup, nodes
+from jinja2.ext import Extension
+
+from .cache import FileSystemCache, MemoryCache
+
+
+class FragmentCache(object):
+    """
+    Cache of rendered fragments, in any Werkzeug cache ``backend``.
+
+    Only one thread per process renders a given missing fragment at a time;
+    others wait for its result. If ``shared`` (the default for backends other
+    than ``MemoryCache``), a lock in the backend also stops other processes
+    rendering the same fragment concurrently, for up to ``lock_timeout``
+    seconds.
+
+    """
+    def __init__(self, backend=None, default_ttl=300, shared=None,
+                 lock_timeout=10, key_prefix='fragment:'):
+        self.backend = backend if backend is not None else MemoryCache()
+        self.default_ttl = default_ttl
+        if shared is None:
+            shared = not isinstance(self.backend, MemoryCache)
+        self.shared = shared
+        self.lock_timeout = lock_timeout
+        self.key_prefix = key_prefix
+        self.stats = Counter()
+        # Maps keys being rendered to [lock, number of threads using it].
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def make_key(self, name, vary_on=()):
+        """Return cache key for fragment ``name`` varying on given values."""
+        digest = hashlib.sha1(repr(tuple(vary_on))).hexdigest()
+        return '%s%s:%s' % (self.key_prefix, name, digest)
+
+    def get_or_render(self, name, vary_on, render, ttl=None):
+        """
+        Return cached fragment ``name`` for ``vary_on`` values.
+
+        If not cached, call ``render`` to render it, and cache the result for
+        ``ttl`` seconds (or ``default_ttl``).
+
+        """
+        key = self.make_key(name, vary_on)
+        value = self.backend.get(key)
+        if value is not None:
+            self.stats['hits'] += 1
+            return value
+        lock = self._acquire(key)
+        try:
+            value = self.backend.get(key)
+            if value is not None:
+                self.stats['hits'] += 1
+                return value
+            self.stats['misses'] += 1
+            if self.shared:
+                return self._render_shared(key, render, ttl)
+            value = render()
+            self.backend.set(key, value, self._ttl(ttl))
+            return value
+        finally:
+            self._release(key, lock)
+
+    def _acquire(self, key):
+        with self._locks_lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        return entry
+
+    def _release(self, key, entry):
+        entry[0].release()
+        with self._locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def _render_shared(self, key, render, ttl):
+        lock_key = key + ':lock'
+        locked = self.backend.add(lock_key, 1, self.lock_timeout)
+        if not locked:
+            # Another process is rendering; wait for its result.
+            self.stats['waits'] += 1
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.05)
+                value = self.backend.get(key)
+                if value is not None:
+                    return value
+        try:
+            value = render()
+            self.backend.set(key, value, self._ttl(ttl))
+        finally:
+            if locked:
+                self.backend.delete(lock_key)
+        return value
+
+    def _ttl(self, ttl):
+        return self.default_ttl if ttl is None else ttl
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Jinja extension adding a ``cache`` tag::
+
+        {% cache "sidebar", user.id, ttl=60 %}
+          ...
+        {% endcache %}
+
+    The first argument names the fragment; the rest are values the cached
+    fragment varies on. ``ttl`` is optional. The environment's
+    ``fragment_cache`` is used; if it is ``None`` the tag has no effect.
+
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = parser.stream.next().lineno
+        name = parser.parse_expression()
+        vary_on = []
+        ttl = nodes.Const(None)
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.test('name:ttl') and (
+                    parser.stream.look().test('assign')):
+                parser.stream.skip(2)
+                ttl = parser.parse_expression()
+            else:
+                vary_on.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method(
+            '_cache', [name, nodes.List(vary_on), ttl])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, name, vary_on, ttl, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+
+        def render():
+            rendered = caller()
+            return (isinstance(rendered, Markup), unicode(rendered))
+
+        is_markup, value = cache.get_or_render(name, vary_on, render, ttl)
+        return Markup(value) if is_markup else value
+
+
+def cache_from_config(config):
+    """
+    Return the fragment cache configured in ``config``, or ``None``.
+
+    The ``templates.fragment_cache`` config setting selects the backend:
+    ``memory`` (holding up to ``templates.fragment_cache_size`` fragments) or
+    ``filesystem`` (in directory ``templates.fragment_cache_dir``, shared by
+    all processes using it). ``templates.fragment_cache_ttl`` is the default
+    TTL in seconds.
+
+    """
+    kind = config.get('templates.fragment_cache')
+    if not kind:
+        return None
+    ttl = int(config.get('templates.fragment_cache_ttl', 300))
+    if kind == 'memory':
+        backend = MemoryCache(
+            int(config.get('templates.fragment_cache_size', 1024)), ttl)
+    elif kind == 'filesystem':
+        backend = FileSystemCache(
+            config.getpath('templates.fragment_cache_dir'),
+            default_timeout=ttl,
+            )
+    else:
+        raise ValueError("Unknown fragment cache %r." % kind)
+    return FragmentCache(backend, ttl)
@@ -1,5 +1,28 @@
+"""Logging setup, off-thread log handling, and a structured access log."""
+import copy
 import logging
 import logging.config
+import os
+import Queue
+import threading
+from timeit import default_timer as timer
+import uuid
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import BaseResponse
+
+from .metrics import UNMATCHED
+
+
+#: Logger for access log records (see ``access_log_middleware``).
+access_logger = logging.getLogger('gurtel.access')
+
+#: Request header giving the request ID, if set by a proxy; also sent back.
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+_STOP = object()
+
+_formatter = logging.Formatter()
 
 
 def configure_logging(config, disable_existing=False):
@@ -9,8 +32,290 @@ def configure_logging(config, disable_existing=False):
     Look for 'logging' key in [app] config section, which should be the path to
     a logging config file in the format expected by logging.config.fileConfig.
 
+    If ``app.logging_queue`` is set, the configured handlers are then moved
+    behind ``QueueHandler`` s (see ``queue_handlers``), holding up to
+    ``app.logging_queue_size`` records each. ``app.logging_rate_limits`` is a
+    list of ``logger: rate`` items, limiting the named loggers to ``rate``
+    records per second (see ``RateLimitFilter``).
+
     """
     logging_config = config.getpath('app.logging', None)
     if logging_config is not None:
         logging.config.fileConfig(
             logging_config, disable_existing_loggers=disable_existing)
+    for item in config.getlist('app.logging_rate_limits', []):
+        name, rate = item.rsplit(':', 1)
+        logger = logging.getLogger(name.strip())
+        for f in logger.filters[:]:
+            if isinstance(f, RateLimitFilter):
+                logger.removeFilter(f)
+        logger.addFilter(RateLimitFilter(float(rate)))
+    if config.getbool('app.logging_queue', False):
+        queue_handlers(config.getint('app.logging_queue_size', 10000))
+
+
+class QueueHandler(logging.Handler):
+    """
+    Passes records to ``handlers`` on a background thread.
+
+    Logging then never waits on the handlers' file or socket I/O: records are
+    put on a queue of up to ``maxsize`` records and handled by a listener
+    thread (started on first use, and again in forked worker processes, which
+    don't inherit threads). If the queue is full, records are dropped (and
+    counted in ``dropped``) rather than blocking.
+
+    Messages are formatted (and exception tracebacks rendered) before being
+    queued, so handlers format records as they would have synchronously.
+    Closing the handler (as ``logging.shutdown()`` does) handles queued
+    records and stops the thread; records logged after that are handled
+    synchronously.
+
+    """
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._thread_lock = threading.Lock()
+
+    def createLock(self):
+        # The queue is thread-safe; with no lock, a lock held by another
+        # thread when a worker process forks can't deadlock it.
+        self.lock = None
+
+    def emit(self, record):
+        try:
+            if self.closed:
+                self._handle(record)
+                return
+            self._ensure_thread()
+            self._queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        """Return a copy of ``record`` safe to handle on another thread."""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _ensure_thread(self):
+        if self._pid != os.getpid():
+            with self._thread_lock:
+                if self._pid != os.getpid():
+                    if self._pid is not None:
+                        # In a forked process, the listener thread may have
+                        # held handler locks when it stopped existing.
+                        for handler in self.handlers:
+                            handler.createLock()
+                    self._pid = os.getpid()
+                    self._queue = Queue.Queue(self.maxsize)
+                    self._thread = threading.Thread(
+                        target=self._run, args=(self._queue,),
+                        name='QueueHandler')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self, queue):
+        while True:
+            record = queue.get()
+            if record is _STOP:
+                return
+            self._handle(record)
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self._pid == os.getpid() and self._thread.is_alive():
+                self._queue.put(_STOP)
+                self._thread.join()
+        logging.Handler.close(self)
+
+
+def queue_handlers(maxsize=10000):
+    """
+    Move the handlers of all loggers behind ``QueueHandler`` s.
+
+    Each logger (including the root logger) with handlers gets a single
+    ``QueueHandler`` passing records to its previous handlers. Returns the
+    list of new ``QueueHandler`` s.
+
+    """
+    loggers = [logging.getLogger()] + [
+        logger for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+        ]
+    queued = []
+    for logger in loggers:
+        handlers = [
+            h for h in logger.handlers if not isinstance(h, QueueHandler)]
+        if not handlers:
+            continue
+        handler = QueueHandler(handlers, maxsize)
+        for h in handlers:
+            logger.removeHandler(h)
+        logger.addHandler(handler)
+        queued.append(handler)
+    return queued
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Passes at most ``rate`` records per second, in bursts of up to ``burst``.
+
+    For noisy loggers: added to a logger, it applies to records logged there
+    (not those propagated from child loggers). Records over the limit are
+    dropped, and counted in ``dropped``; the next record passed has the number
+    dropped before it as its ``dropped`` attribute.
+
+    """
+    def __init__(self, rate, burst=None):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.dropped = 0
+        self._tokens = self.burst
+        self._last = timer()
+        self._unreported = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        with self._lock:
+            now = timer()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self.dropped += 1
+                self._unreported += 1
+                return False
+            self._tokens -= 1
+            record.dropped = self._unreported
+            self._unreported = 0
+            return True
+
+
+def access_log_middleware(request, response_callable):
+    """
+    Middleware logging a structured record of each request.
+
+    Records are logged (at INFO) to ``access_logger``, once the response body
+    has been sent, with attributes ``method``, ``path``, ``endpoint``,
+    ``status``, ``bytes`` (body bytes sent, or the Content-Length of
+    responses to HEAD requests), ``latency`` (seconds) and ``request_id``,
+    for use in formats or by structured handlers.
+
+    The request ID is taken from the ``X-Request-ID`` request header if a
+    proxy set one, otherwise generated; it is available as
+    ``request.request_id``, and sent back in the same response header.
+
+    """
+    start = timer()
+    request_id = request.headers.get(REQUEST_ID_HEADER)
+    if not request_id or len(request_id) > 200:
+        request_id = uuid.uuid4().hex
+    request.request_id = request_id
+    try:
+        response = response_callable(request)
+    except HTTPException as e:
+        _log_access(request, e.code, None, start)
+        raise
+    except Exception:
+        _log_access(request, 500, None, start)
+        raise
+    if not isinstance(response, BaseResponse):
+        _log_access(request, getattr(response, 'code', None), None, start)
+        return response
+    response.headers[REQUEST_ID_HEADER] = request_id
+    if response.is_streamed and request.method != 'HEAD':
+        response.response = _CountingIterable(
+            response.response,
+            response.charset,
+            lambda sent: _log_access(
+                request, response.status_code, sent, start),
+            )
+    else:
+        _log_access(
+            request, response.status_code, response.content_length, start)
+    return response
+
+access_log_middleware.middleware_name = 'access_log'
+
+
+class _CountingIterable(object):
+    """Response iterable counting bytes sent, calling ``done`` on close."""
+    def __init__(self, iterable, charset, done):
+        self.iterable = iterable
+        self.charset = charset
+        self.done = done
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(self.charset)
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.done(self.sent)
+
+
+def _log_access(request, status, sent, start):
+    if not access_logger.isEnabledFor(logging.INFO):
+        return
+    latency = timer() - start
+    endpoint = _endpoint(request)
+    access_logger.info(
+        '%s %s %s %s %.1fms',
+        request.method,
+        request.path,
+        status,
+        '-' if sent is None else sent,
+        latency * 1000,
+        extra={
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': status,
+            'bytes': sent,
+            'latency': latency,
+            'request_id': request.request_id,
+            },
+        )
+
+
+def _endpoint(request):
+    timings = getattr(request, 'timings', None)
+    if timings is not None:
+        return timings.endpoint or UNMATCHED
+    match = getattr(request.app.dispatcher, 'match', None)
+    if match is None:
+        return UNMATCHED
+    try:
+        return match(request)[0]
+    except HTTPException:
+        return UNMATCHED
@@ -0,0 +1,269 @@
+"""In-process request metrics, exportable in Prometheus text format."""
+from bisect import bisect_left
+from collections import Counter, deque
+import logging
+import os
+import threading
+import time
+from timeit import default_timer as timer
+
+from werkzeug.wrappers import Response
+
+
+logger = logging.getLogger(__name__)
+
+#: Default histogram bucket upper bounds, in seconds.
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0)
+
+#: Endpoint label for requests that didn't match any endpoint.
+UNMATCHED = '<unmatched>'
+
+
+class Histogram(object):
+    """Counts of observed values in buckets, plus their sum and count."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One extra bucket for values above the largest bound.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return list of ``(upper bound, cumulative count)`` pairs."""
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class RequestTimings(object):
+    """
+    Timings of the stages of a single request.
+
+    If not timing ``stages``, only the endpoint is recorded (and ``stages`` is
+    ``None``). ``inner`` is the time taken by calls made by instrumented
+    middlewares that were themselves timed (see ``instrument_middleware``).
+
+    """
+    __slots__ = ['endpoint', 'stages', 'inner']
+
+    def __init__(self, stages=True):
+        self.endpoint = None
+        self.stages = [] if stages else None
+        self.inner = 0.0
+
+    def add(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+
+def record(request, stage, seconds):
+    """Record time taken by a stage of ``request``, if it is being timed."""
+    timings = getattr(request, 'timings', None)
+    if timings is not None and timings.stages is not None:
+        timings.add(stage, seconds)
+
+
+class Metrics(object):
+    """
+    Aggregated request metrics for an app.
+
+    Keeps a latency histogram per endpoint and counts of responses by
+    endpoint and status code; and, if ``timed_stages``, a latency histogram
+    per request stage (which costs a few clock reads per stage, and a wrapper
+    per middleware; see ``instrument_middleware``).
+
+    ``observe`` only queues a request's timings, so the request path doesn't
+    pay for aggregating them: a background thread (started on first use, and
+    again in forked worker processes, which don't inherit threads) merges
+    queued timings every ``interval`` seconds, as do ``merge()`` and
+    ``render()``.
+
+    """
+    def __init__(self, buckets=BUCKETS, interval=1.0, timed_stages=False):
+        self.buckets = buckets
+        self.interval = interval
+        self.timed_stages = timed_stages
+        self.requests = {}
+        self.stages = {}
+        self.responses = Counter()
+        self._pending = deque()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def observe(self, timings, status, seconds):
+        """Queue a finished request's ``RequestTimings``, status and time."""
+        if self._pid != os.getpid():
+            self._ensure_thread()
+        self._pending.append((timings, status, seconds))
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                # Timings queued in the parent process are counted there.
+                self._pending.clear()
+                thread = threading.Thread(target=self._run, name='Metrics')
+                thread.daemon = True
+                thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.merge()
+            except Exception:
+                logger.exception("Error merging metrics.")
+
+    def merge(self):
+        """Merge queued request timings into the histograms and counters."""
+        buckets, bisect = self.buckets, bisect_left
+        requests, stages, responses = self.requests, self.stages, (
+            self.responses)
+        popleft = self._pending.popleft
+        with self._lock:
+            while True:
+                try:
+                    timings, status, seconds = popleft()
+                except IndexError:
+                    return
+                endpoint = timings.endpoint or UNMATCHED
+                histogram = requests.get(endpoint)
+                if histogram is None:
+                    histogram = requests[endpoint] = Histogram(buckets)
+                histogram.counts[bisect(buckets, seconds)] += 1
+                histogram.sum += seconds
+                for stage, stage_seconds in timings.stages or ():
+                    histogram = stages.get(stage)
+                    if histogram is None:
+                        histogram = stages[stage] = Histogram(buckets)
+                    histogram.counts[bisect(buckets, stage_seconds)] += 1
+                    histogram.sum += stage_seconds
+                responses[(endpoint, status)] += 1
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+        self.merge()
+        with self._lock:
+            lines = []
+            _render_histograms(
+                lines,
+                'gurtel_request_duration_seconds',
+                'Request latency by endpoint.',
+                'endpoint',
+                self.requests,
+                )
+            _render_histograms(
+                lines,
+                'gurtel_stage_duration_seconds',
+                'Request stage latency by stage.',
+                'stage',
+                self.stages,
+                )
+            lines.append(
+                '# HELP gurtel_responses_total Responses by endpoint and '
+                'status code.')
+            lines.append('# TYPE gurtel_responses_total counter')
+            for (endpoint, status), count in sorted(self.responses.items()):
+                lines.append(
+                    'gurtel_responses_total{endpoint="%s",status="%s"} %d'
+                    % (_escape(endpoint), status, count))
+        return '\n'.join(lines) + '\n'
+
+
+def _render_histograms(lines, name, help_text, label, histograms):
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s histogram' % name)
+    for key, histogram in sorted(histograms.items()):
+        labels = '%s="%s"' % (label, _escape(key))
+        for bound, count in histogram.cumulative():
+            lines.append('%s_bucket{%s,le="%s"} %d' % (
+                name, labels, _format_bound(bound), count))
+        lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def instrument_middleware(middleware, name=None):
+    """
+    Wrap ``middleware`` to record its own run time (excluding inner calls).
+
+    The stage is named ``middleware.<name>`` (``name`` defaults to the
+    middleware's ``__name__``). Time taken by inner instrumented middlewares,
+    and by the innermost response callable if it is wrapped with
+    ``instrument_inner``, is excluded.
+
+    """
+    if name is None:
+        name = getattr(middleware, '__name__', None) or (
+            type(middleware).__name__)
+    stage = 'middleware.%s' % name
+
+    def _instrumented(request, response_callable):
+        timings = getattr(request, 'timings', None)
+        if timings is None or timings.stages is None:
+            return middleware(request, response_callable)
+        inner = timings.inner
+        start = timer()
+        try:
+            return middleware(request, response_callable)
+        finally:
+            seconds = timer() - start
+            timings.stages.append(
+                (stage, seconds - (timings.inner - inner)))
+            timings.inner = inner + seconds
+
+    _instrumented.__name__ = name
+    _instrumented.__doc__ = getattr(middleware, '__doc__', None)
+    mw_name = getattr(middleware, 'middleware_name', None)
+    if mw_name is not None:
+        _instrumented.middleware_name = mw_name
+    return _instrumented
+
+
+def instrument_inner(response_callable):
+    """
+    Wrap the innermost ``response_callable`` of instrumented middlewares.
+
+    Its time is then excluded from theirs (see ``instrument_middleware``).
+    Not needed for dispatchers that add their own time to ``timings.inner``
+    (those with a true ``records_timings`` attribute, such as
+    ``gurtel.dispatch.MapDispatcher``).
+
+    """
+    def _inner(request):
+        timings = getattr(request, 'timings', None)
+        if timings is None or timings.stages is None:
+            return response_callable(request)
+        start = timer()
+        try:
+            return response_callable(request)
+        finally:
+            timings.inner += timer() - start
+
+    return _inner
+
+
+def metrics_handler(request):
+    """Request handler serving the app's metrics in Prometheus format."""
+    return Response(
+        request.app.metrics.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+        )
@@ -0,0 +1,112 @@
+"""Middleware chains, and per-handler middleware selection."""
+
+
+def middleware_name(middleware):
+    """
+    Return the name identifying ``middleware`` (or a name, unchanged).
+
+    This is the middleware's ``middleware_name`` attribute if it has one (both
+    session middlewares are named ``session``), otherwise its ``__name__``;
+    ``None`` if it has neither (e.g. a ``functools.partial`` or a callable
+    instance).
+
+    """
+    if isinstance(middleware, basestring):
+        return middleware
+    return getattr(middleware, 'middleware_name', None) or getattr(
+        middleware, '__name__', None)
+
+
+def _selector(middleware):
+    # Unnamed middlewares can be selected only by passing them as such.
+    name = middleware_name(middleware)
+    return middleware if name is None else name
+
+
+def skip_middleware(*middlewares):
+    """
+    Decorator for request handlers that don't need some middlewares.
+
+    Takes middlewares or their names (see ``middleware_name``; unnamed
+    middlewares must be given themselves); the app runs requests dispatched
+    to the decorated handler through all its other middlewares. For example,
+    a health check that doesn't use the session::
+
+        @skip_middleware('session')
+        def health(request):
+            return Response('ok')
+
+    """
+    names = frozenset(_selector(m) for m in middlewares)
+
+    def _decorator(func):
+        func.skip_middleware = names
+        return func
+
+    return _decorator
+
+
+def only_middleware(*middlewares):
+    """
+    Decorator for request handlers that need only the given middlewares.
+
+    Like ``skip_middleware``, but the app skips all middlewares except those
+    given. ``only_middleware()`` skips every middleware.
+
+    """
+    names = frozenset(_selector(m) for m in middlewares)
+
+    def _decorator(func):
+        func.only_middleware = names
+        return func
+
+    return _decorator
+
+
+def selection_key(handler):
+    """
+    Return a hashable key for the middlewares ``handler`` declares it uses.
+
+    ``None`` (for all middlewares) if it declares nothing.
+
+    """
+    skip = getattr(handler, 'skip_middleware', None)
+    only = getattr(handler, 'only_middleware', None)
+    if skip is None and only is None:
+        return None
+    return (skip, only)
+
+
+def select(middlewares, key):
+    """Return list of ``middlewares`` selected by a ``selection_key``."""
+    if key is None:
+        return list(middlewares)
+    skip, only = key
+    selected = []
+    for m in middlewares:
+        selector = _selector(m)
+        if (skip is None or selector not in skip) and (
+                only is None or selector in only):
+            selected.append(m)
+    return selected
+
+
+def compile_chain(middlewares, response_callable):
+    """
+    Compile ``middlewares`` around ``response_callable`` into one callable.
+
+    The first middleware is outermost. Each middleware is called as
+    ``middleware(request, response_callable=inner)``. With no middlewares,
+    ``response_callable`` itself is returned.
+
+    """
+    for middleware in reversed(middlewares):
+        response_callable = _link(middleware, response_callable)
+    return response_callable
+
+
+def _link(middleware, inner):
+    def _call(request):
+        return middleware(request, response_callable=inner)
+
+    return _call
@@ -0,0 +1,159 @@
+"""Sampling request profiler, writing pstats files per endpoint."""
+import cProfile
+import logging
+import os
+import pstats
+import Queue
+import random
+import re
+import tempfile
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+
+
+logger = logging.getLogger(__name__)
+
+#: Endpoint name for requests that didn't match any endpoint.
+UNMATCHED = '<unmatched>'
+
+
+class Profiler(object):
+    """
+    Profiles a sampled fraction of requests with cProfile.
+
+    ``profile_middleware`` profiles each request with probability
+    ``sample_rate`` (if ``endpoints`` is given, only requests to those
+    endpoints). Requests not sampled pay only for a random number. Profiles
+    are merged per endpoint by a background thread, which every ``interval``
+    seconds writes the merged stats to ``<endpoint>.<pid>.pstats`` files in
+    ``output_dir`` (for ``pstats`` or tools like snakeviz).
+
+    Only the time until the handler returns its response is profiled; the
+    bodies of streamed responses are generated later.
+
+    """
+    def __init__(self, output_dir, sample_rate=0.01, endpoints=None,
+                 interval=60.0):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.endpoints = frozenset(endpoints) if endpoints else None
+        self.interval = interval
+        self.stats = {}
+        self._queue = Queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def profile_middleware(self, request, response_callable):
+        if random.random() >= self.sample_rate:
+            return response_callable(request)
+        endpoint = self._endpoint(request)
+        if self.endpoints is not None and endpoint not in self.endpoints:
+            return response_callable(request)
+        self._ensure_thread()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return response_callable(request)
+        finally:
+            profile.disable()
+            self._queue.put((endpoint, profile))
+
+    profile_middleware.middleware_name = 'profile'
+
+    def _endpoint(self, request):
+        match = getattr(request.app.dispatcher, 'match', None)
+        if match is None:
+            return UNMATCHED
+        try:
+            return match(request)[0]
+        except HTTPException:
+            return UNMATCHED
+
+    def _ensure_thread(self):
+        # Started on first use, and again in forked worker processes (which
+        # don't inherit threads).
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self.stats = {}
+                    self._queue = Queue.Queue()
+                    thread = threading.Thread(
+                        target=self._run, name='Profiler')
+                    thread.daemon = True
+                    thread.start()
+
+    def _run(self):
+        while True:
+            deadline = time.time() + self.interval
+            changed = set()
+            while time.time() < deadline:
+                try:
+                    item = self._queue.get(timeout=deadline - time.time())
+                except Queue.Empty:
+                    break
+                changed.update(self.merge(item))
+            if changed:
+                try:
+                    self.write(changed)
+                except Exception:
+                    logger.exception("Error writing profiles.")
+
+    def merge(self, item=None):
+        """
+        Merge an ``(endpoint, profile)`` pair, and any queued profiles.
+
+        Returns set of endpoints whose stats changed.
+
+        """
+        changed = set()
+        while True:
+            if item is None:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    return changed
+            endpoint, profile = item
+            stats = self.stats.get(endpoint)
+            if stats is None:
+                self.stats[endpoint] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            changed.add(endpoint)
+            item = None
+
+    def write(self, endpoints=None):
+        """Write merged stats for ``endpoints`` (default all) to files."""
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        for endpoint in endpoints or list(self.stats):
+            filename = os.path.join(self.output_dir, '%s.%s.pstats' % (
+                re.sub(r'[^\w.-]', '_', endpoint), os.getpid()))
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.output_dir, prefix='.tmp-')
+            os.close(fd)
+            self.stats[endpoint].dump_stats(tmp_path)
+            os.rename(tmp_path, filename)
+
+
+def profiler_from_config(settings):
+    """
+    Return the ``Profiler`` configured in ``settings``, or ``None``.
+
+    Profiling is on if ``profile.sample_rate`` is above 0. Profiles are written
+    to ``profile.dir`` (default ``gurtel-profiles`` in the temp directory)
+    every ``profile.interval`` seconds, and may be limited to the endpoints in
+    the ``profile.endpoints`` list.
+
+    """
+    if not settings['profile.sample_rate']:
+        return None
+    return Profiler(
+        settings['profile.dir'] or os.path.join(
+            tempfile.gettempdir(), 'gurtel-profiles'),
+        settings['profile.sample_rate'],
+        settings['profile.endpoints'],
+        settings['profile.interval'],
+        )
@@ -10,6 +10,51 @@ def pytest_addoption(parser):
         dest="config",
         help="A .ini file with config for running tests",
     )
+    parser.addini(
+        "gurtel_app",
+        help="Dotted path to a factory taking a Config and returning the "
+        "GurtelApp for the app and client fixtures",
+    )
+    group.addoption(
+        "--gurtel-bench",
+        action="store_true",
+        dest="gurtel_bench",
+        help="Run benchmarks (tests using the gurtel_bench fixture)",
+    )
+    group.addoption(
+        "--gurtel-bench-baseline",
+        dest="gurtel_bench_baseline",
+        default="benchmarks/baseline.json",
+        help="JSON file of baseline benchmark results",
+    )
+    group.addoption(
+        "--gurtel-bench-threshold",
+        dest="gurtel_bench_threshold",
+        type=float,
+        default=0.25,
+        help="Fail benchmarks this fraction slower than baseline (0.25)",
+    )
+    group.addoption(
+        "--gurtel-bench-save",
+        action="store_true",
+        dest="gurtel_bench_save",
+        help="Save benchmark results as the new baseline",
+    )
+
+
+def pytest_terminal_summary(terminalreporter):
+    session = getattr(terminalreporter.config, '_gurtel_bench', None)
+    if session is not None and session.results:
+        terminalreporter.write_sep('=', 'gurtel benchmarks')
+        for line in session.report():
+            terminalreporter.write_line(line)
+        missing = session.missing()
+        if missing and not session.save:
+            terminalreporter.write_line(
+                "No baseline in %s for %d benchmark(s), so they were not "
+                "checked for regressions; run with --gurtel-bench-save to "
+                "store one." % (session.baseline_path, len(missing)),
+                yellow=True, bold=True)
 
 
 @pytest.fixture(scope='session')
@@ -37,6 +82,80 @@ def config(request, _base_config):
     return config
 
 
+@pytest.fixture(scope='session')
+def gurtel_app_factory(request):
+    """
+    Factory taking a ``Config`` and returning the app under test.
+
+    Defaults to the factory named by the ``gurtel_app`` ini setting; override
+    this fixture to provide one otherwise.
+
+    """
+    from gurtel.imp import import_from_dotted_path
+
+    dotted_path = request.config.getini('gurtel_app')
+    if not dotted_path:
+        pytest.skip("No gurtel_app ini setting or gurtel_app_factory fixture.")
+    return import_from_dotted_path(dotted_path)
+
+
+@pytest.fixture(scope='session')
+def _gurtel_app(_base_config, gurtel_app_factory):
+    return gurtel_app_factory(_base_config.copy())
+
+
+@pytest.fixture
+def app(request, _gurtel_app, config, gurtel_app_factory):
+    """
+    The app under test, created once per test session (and worker process).
+
+    If this test's ``config`` (applying any ``config`` mark) differs only in
+    settings the app reads per request (its ``request_settings``), the shared
+    app's config is swapped for it, and restored afterwards. Otherwise (e.g.
+    for ``app.metrics``, ``templates.*`` or ``session.store``, used when the
+    app is created) a new app is created for this test.
+
+    """
+    original = (_gurtel_app.config, _gurtel_app.settings)
+    data, original_data = config.data, original[0].data
+    changed = set(
+        k for k in set(data) | set(original_data)
+        if data.get(k) != original_data.get(k)
+        )
+    if not changed:
+        return _gurtel_app
+
+    if changed <= getattr(_gurtel_app, 'request_settings', frozenset()):
+        _gurtel_app.set_config(config)
+
+        def _restore():
+            _gurtel_app.config, _gurtel_app.settings = original
+
+        request.addfinalizer(_restore)
+        return _gurtel_app
+
+    app = gurtel_app_factory(config)
+
+    close = getattr(app, 'close', None)
+    if close is not None:
+        request.addfinalizer(close)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    """
+    A ``gurtel.util.Client`` for the app under test.
+
+    Each test gets a new client, and so starts with no cookies: a new session,
+    with no flash messages.
+
+    """
+    from gurtel.util import Client
+
+    return Client(app)
+
+
 @pytest.fixture
 def configfile(request, tmpdir):
     """
@@ -56,3 +175,33 @@ def configfile(request, tmpdir):
         fh.write(contents)
 
     return fn
+
+
+@pytest.fixture(scope='session')
+def _gurtel_bench_session(request):
+    from gurtel.bench import BenchmarkSession
+
+    if not request.config.getoption('gurtel_bench'):
+        pytest.skip("Benchmarks only run with --gurtel-bench.")
+
+    session = BenchmarkSession(
+        request.config.getoption('gurtel_bench_baseline'),
+        request.config.getoption('gurtel_bench_threshold'),
+        request.config.getoption('gurtel_bench_save'),
+        )
+    request.config._gurtel_bench = session
+    request.addfinalizer(session.finish)
+
+    return session
+
+
+@pytest.fixture
+def gurtel_bench(_gurtel_bench_session):
+    """
+    Benchmark runner; call with a name and a function to measure.
+
+    Skips unless pytest is run with ``--gurtel-bench``. Fails if the function
+    is slower than its stored baseline by more than the threshold.
+
+    """
+    return _gurtel_bench_session
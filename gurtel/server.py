@@ -0,0 +1,784 @@
+"""Pre-fork multi-process WSGI server, run by ``gurtel serve``."""
+import argparse
+from collections import namedtuple
+import errno
+import fcntl
+from functools import partial
+import logging
+import mmap
+import os
+import random
+import select
+import signal
+import socket
+from SocketServer import ThreadingMixIn
+import struct
+import sys
+import threading
+import time
+from timeit import default_timer as timer
+
+from werkzeug.exceptions import NotFound
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import LimitedStream
+
+from .config import Config
+from .imp import import_from_dotted_path
+from . import log
+
+
+logger = logging.getLogger(__name__)
+
+#: WSGI environ key holding the server's ``Scoreboard`` in worker processes.
+SCOREBOARD_KEY = 'gurtel.scoreboard'
+
+
+def parse_bind(bind):
+    """Return ``(host, port)`` from a ``host:port`` string (or ``:port``)."""
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '127.0.0.1', int(port)
+
+
+def bind_socket(host, port, backlog=1024):
+    """Return a non-blocking socket listening on ``host`` and ``port``."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    # Workers all wait for connections on this socket; those that lose the
+    # race to accept one must not block.
+    sock.setblocking(0)
+    return sock
+
+
+class Scoreboard(object):
+    """
+    Per-worker counters, in memory shared by the master and its workers.
+
+    Has ``slots`` slots, one per worker process: its ``pid``, the number of
+    workers in the slot that exited unexpectedly (``crashes``), ``requests``
+    served, requests in progress (``active``), the time the worker was
+    ``started`` (0 until it is ready to serve) and seconds spent in the app
+    (``busy``). Each field is only written by one process at a time, so no
+    locking between processes is needed.
+
+    """
+    fields = ('pid', 'crashes', 'requests', 'active', 'started', 'busy')
+    _float_fields = frozenset(['started', 'busy'])
+    _int = struct.Struct('q')
+    _float = struct.Struct('d')
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._slot_size = 8 * len(self.fields)
+        self._offsets = dict((f, 8 * i) for i, f in enumerate(self.fields))
+        # Anonymous mmaps are shared with forked child processes.
+        self._mem = mmap.mmap(-1, self._slot_size * slots)
+        self._lock = threading.Lock()
+
+    def _struct(self, field):
+        return self._float if field in self._float_fields else self._int
+
+    def get(self, slot, field):
+        offset = slot * self._slot_size + self._offsets[field]
+        return self._struct(field).unpack_from(self._mem, offset)[0]
+
+    def set(self, slot, **values):
+        for field, value in values.items():
+            offset = slot * self._slot_size + self._offsets[field]
+            self._struct(field).pack_into(self._mem, offset, value)
+
+    def reset(self, slot):
+        """Clear ``slot`` for a new worker (keeping its count of crashes)."""
+        self.set(slot, pid=0, requests=0, active=0, started=0.0, busy=0.0)
+
+    def begin(self, slot):
+        """Count a request starting in worker ``slot``."""
+        with self._lock:
+            self.set(
+                slot,
+                requests=self.get(slot, 'requests') + 1,
+                active=self.get(slot, 'active') + 1,
+                )
+
+    def end(self, slot, seconds):
+        """Count a request that took ``seconds`` finishing in ``slot``."""
+        with self._lock:
+            self.set(
+                slot,
+                active=self.get(slot, 'active') - 1,
+                busy=self.get(slot, 'busy') + seconds,
+                )
+
+    def workers(self):
+        """Return a list of dictionaries of counters, one per live worker."""
+        result = []
+        for slot in range(self.slots):
+            if self.get(slot, 'pid'):
+                entry = dict((f, self.get(slot, f)) for f in self.fields)
+                entry['slot'] = slot
+                result.append(entry)
+        return result
+
+    def render(self):
+        """Return worker counters in Prometheus text exposition format."""
+        workers = self.workers()
+        lines = []
+        for name, field, type_, help_text in [
+                ('gurtel_worker_requests_total', 'requests', 'counter',
+                 'Requests served by worker.'),
+                ('gurtel_worker_active_requests', 'active', 'gauge',
+                 'Requests in progress in worker.'),
+                ('gurtel_worker_busy_seconds_total', 'busy', 'counter',
+                 'Seconds worker spent in the app.'),
+                ('gurtel_worker_start_time_seconds', 'started', 'gauge',
+                 'Start time of worker since the epoch.'),
+                ('gurtel_worker_crashes_total', 'crashes', 'counter',
+                 'Workers in this slot that exited unexpectedly.'),
+                ]:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, type_))
+            for worker in workers:
+                value = worker[field]
+                lines.append('%s{slot="%d",pid="%d"} %s' % (
+                    name,
+                    worker['slot'],
+                    worker['pid'],
+                    repr(value) if isinstance(value, float) else value,
+                    ))
+        return '\n'.join(lines) + '\n'
+
+
+def scoreboard_handler(request):
+    """Request handler serving worker counters in Prometheus format."""
+    scoreboard = request.environ.get(SCOREBOARD_KEY)
+    if scoreboard is None:
+        raise NotFound()
+    return Response(
+        scoreboard.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+        )
+
+
+# The C library's sendfile function, once loaded.
+_sendfile = NOT_LOADED = object()
+
+
+def libc_sendfile():
+    """Return the C library's ``sendfile`` function, or ``None``."""
+    global _sendfile
+    if _sendfile is NOT_LOADED:
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(
+                ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            _sendfile = libc.sendfile
+        except (OSError, AttributeError):
+            _sendfile = None
+        else:
+            _sendfile.argtypes = [
+                ctypes.c_int,
+                ctypes.c_int,
+                ctypes.POINTER(ctypes.c_int64),
+                ctypes.c_size_t,
+                ]
+            _sendfile.restype = ctypes.c_ssize_t
+    return _sendfile
+
+
+class FileWrapper(object):
+    """
+    ``wsgi.file_wrapper``: iterates over file ``f``, ``block_size`` bytes at a
+    time (from its current position).
+
+    If the app returns it as its response (not wrapped in another iterable),
+    the worker server instead sends the rest of the file straight to the
+    client's socket, ``connection``, with sendfile(2), without copying it
+    through Python (see ``send_files``).
+
+    """
+    def __init__(self, f, block_size=8192, connection=None):
+        self.f = f
+        self.block_size = block_size
+        self.connection = connection
+
+    def __iter__(self):
+        return iter(lambda: self.f.read(self.block_size), '')
+
+    def can_sendfile(self):
+        """Return ``True`` if the file can be sent with sendfile(2)."""
+        if self.connection is None or libc_sendfile() is None:
+            return False
+        try:
+            self.f.fileno()
+        except (AttributeError, IOError):
+            return False
+        return True
+
+    def sendfile(self):
+        """Send the rest of the file to ``connection`` with sendfile(2)."""
+        import ctypes
+
+        sendfile = libc_sendfile()
+        fileno = self.f.fileno()
+        out = self.connection.fileno()
+        offset = ctypes.c_int64(os.lseek(fileno, 0, os.SEEK_CUR))
+        size = os.fstat(fileno).st_size
+        while offset.value < size:
+            sent = sendfile(
+                out, fileno, ctypes.byref(offset), size - offset.value)
+            if sent == 0:
+                break
+            elif sent < 0:
+                err = ctypes.get_errno()
+                if err == errno.EAGAIN:
+                    # The socket has a timeout, so is non-blocking.
+                    timeout = self.connection.gettimeout()
+                    if not select.select([], [out], [], timeout)[1]:
+                        raise socket.timeout('timed out')
+                elif err != errno.EINTR:
+                    raise socket.error(err, os.strerror(err))
+
+    def close(self):
+        self.f.close()
+
+
+def send_files(app):
+    """
+    Wrap WSGI ``app`` to send ``FileWrapper`` responses with sendfile(2).
+
+    Other responses, and files that can't be sent that way, are passed on to
+    the server as they are.
+
+    """
+    def _app(environ, start_response):
+        app_iter = app(environ, start_response)
+        if isinstance(app_iter, FileWrapper) and app_iter.can_sendfile():
+            return _SentFile(app_iter)
+        return app_iter
+
+    return _app
+
+
+class _SentFile(object):
+    """Response iterable sending a ``FileWrapper``'s file with sendfile."""
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+
+    def __iter__(self):
+        # The server sends the response headers on the first (empty) write.
+        yield ''
+        self.wrapper.sendfile()
+
+    def close(self):
+        self.wrapper.close()
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Werkzeug request handler supporting HTTP/1.1 keep-alive.
+
+    If the server's ``keepalive`` is set, connections are kept open for up to
+    that many seconds between requests. Responses without a Content-Length,
+    and requests without one that have a body, still close the connection. Any
+    part of a request body the app didn't read is discarded before the next
+    request. Provides ``FileWrapper`` as ``wsgi.file_wrapper``, which
+    ``WorkerServer`` sends with sendfile(2).
+
+    """
+    def setup(self):
+        if self.server.keepalive:
+            self.protocol_version = 'HTTP/1.1'
+            self.timeout = self.server.keepalive
+        # Headers and body are written separately; don't let Nagle's
+        # algorithm hold back the body of a kept-alive response.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        WSGIRequestHandler.setup(self)
+
+    def make_environ(self):
+        environ = WSGIRequestHandler.make_environ(self)
+        environ['wsgi.file_wrapper'] = partial(
+            FileWrapper, connection=self.connection)
+        if self.server.keepalive:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = None
+            if length is None or 'chunked' in environ.get(
+                    'HTTP_TRANSFER_ENCODING', ''):
+                self.close_connection = 1
+            elif length:
+                self._input = environ['wsgi.input'] = LimitedStream(
+                    self.rfile, length)
+        return environ
+
+    def run_wsgi(self):
+        self._input = None
+        try:
+            return WSGIRequestHandler.run_wsgi(self)
+        finally:
+            if self._input is not None and not self.close_connection:
+                self._input.exhaust()
+
+
+class WorkerServer(BaseWSGIServer):
+    """
+    Werkzeug WSGI server accepting connections on an already bound socket.
+
+    Handles one connection at a time; see ``ThreadedWorkerServer``. Responses
+    that are a ``FileWrapper`` are sent with sendfile(2) (see ``send_files``).
+
+    """
+    multiprocess = True
+
+    def __init__(self, listener, app, keepalive=None):
+        self.listener = listener
+        self.keepalive = keepalive
+        host, port = listener.getsockname()[:2]
+        BaseWSGIServer.__init__(
+            self, host, port, send_files(app), RequestHandler)
+
+    def server_bind(self):
+        # Use the listening socket inherited from the master process instead
+        # of binding a new one.
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        self.server_name, self.server_port = self.server_address[:2]
+
+    def server_activate(self):
+        pass
+
+
+class ThreadedWorkerServer(ThreadingMixIn, WorkerServer):
+    """``WorkerServer`` handling each connection in a new thread."""
+    multithread = True
+
+
+_Child = namedtuple('_Child', 'slot generation spawned')
+
+
+class Arbiter(object):
+    """
+    Pre-fork server master process.
+
+    ``load_app`` is called (with no arguments) to create the ``GurtelApp`` to
+    serve. ``run()`` binds the listening socket once, warms up the app (see
+    ``GurtelApp.warmup``) and forks ``workers`` worker processes (default one
+    per CPU), which share the warmed-up app copy-on-write and accept
+    connections on the socket. Workers are ``threaded`` or handle one
+    connection at a time; only threaded workers keep connections alive for
+    ``keepalive`` seconds, as an idle connection would block a single-threaded
+    worker. Options not given are read from the app's ``server.*`` settings.
+
+    Workers that exit unexpectedly are replaced (at most once a second, if
+    they keep exiting straight away). The master handles these signals:
+
+    - ``SIGHUP``: gracefully reload. Calls ``load_app`` again (code already
+      imported isn't reloaded), warms up the new app and replaces the workers
+      one at a time, starting each new worker before stopping an old one. If
+      ``load_app`` fails the old app is kept; otherwise it is closed. If the
+      app watches its config files (the ``app.config_reload`` setting), a
+      change triggers the same reload, since workers don't inherit the
+      watcher thread.
+    - ``SIGTERM``, ``SIGINT``: graceful shutdown. Workers finish the requests
+      in progress (for up to ``graceful_timeout`` seconds) and exit.
+    - ``SIGQUIT``: immediate shutdown.
+    - ``SIGUSR1``: log the workers' counters (see ``Scoreboard``).
+
+    Worker counters are also served by ``scoreboard_handler``.
+
+    """
+    def __init__(self, load_app, bind=None, workers=None, threaded=None,
+                 keepalive=None, graceful_timeout=None, backlog=1024):
+        self.load_app = load_app
+        self.options = {
+            'bind': bind,
+            'workers': workers,
+            'threaded': threaded,
+            'keepalive': keepalive,
+            'graceful_timeout': graceful_timeout,
+            }
+        self.backlog = backlog
+        self.app = None
+        self.workers = None
+        self.listener = None
+        self.scoreboard = None
+        self.children = {}
+        self.generation = 0
+        self._stopping = set()
+        self._spawn_after = 0
+        self._signals = []
+        self._pipe = None
+
+    def option(self, name):
+        value = self.options[name]
+        if value is None:
+            value = self.app.settings['server.%s' % name]
+        return value
+
+    def run(self):
+        """Run the server until shut down by a signal."""
+        self.app = self._load()
+        host, port = parse_bind(self.option('bind'))
+        self.workers = self.option('workers')
+        if not self.workers:
+            import multiprocessing
+            self.workers = multiprocessing.cpu_count()
+        self.listener = bind_socket(host, port, self.backlog)
+        self._warmup()
+        # One slot more than workers, for rolling reloads.
+        self.scoreboard = Scoreboard(self.workers + 1)
+        self._install_signals()
+        logger.info(
+            "Listening on %s:%s (master pid %s, %s %sworkers).",
+            host,
+            self.listener.getsockname()[1],
+            os.getpid(),
+            self.workers,
+            'threaded ' if self.option('threaded') else '',
+            )
+        graceful = True
+        try:
+            graceful = self._loop()
+        finally:
+            self.stop(graceful)
+            self.listener.close()
+
+    def _load(self):
+        app = self.load_app()
+        watcher = getattr(app, 'config_watcher', None)
+        if watcher is not None:
+            # Swapping config in the master wouldn't reach the workers.
+            watcher.callback = self._config_changed
+        return app
+
+    def _config_changed(self):
+        logger.info("Config changed.")
+        self._signal(signal.SIGHUP, None)
+
+    def _warmup(self):
+        warmup = getattr(self.app, 'warmup', None)
+        if warmup is not None:
+            timings = warmup()
+            logger.info("Warmed up app in %.3fs.", timings['total'])
+
+    def _install_signals(self):
+        self._pipe = os.pipe()
+        for fd in self._pipe:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGQUIT, signal.SIGUSR1, signal.SIGCHLD]:
+            signal.signal(signum, self._signal)
+
+    def _signal(self, signum, frame):
+        if signum != signal.SIGCHLD:
+            self._signals.append(signum)
+        # Wake the master loop, if it's waiting.
+        if self._pipe is None:
+            return
+        try:
+            os.write(self._pipe[1], '.')
+        except OSError:
+            pass
+
+    def _loop(self):
+        """Run the master loop; return whether to shut down gracefully."""
+        while True:
+            self.reap()
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    logger.info("Shutting down gracefully.")
+                    return True
+                elif signum == signal.SIGQUIT:
+                    logger.info("Shutting down.")
+                    return False
+                elif signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGUSR1:
+                    self.log_stats()
+            self.maintain()
+            self._wait(1.0)
+
+    def _wait(self, timeout):
+        try:
+            if select.select([self._pipe[0]], [], [], timeout)[0]:
+                while os.read(self._pipe[0], 1024):
+                    pass
+        except (select.error, OSError) as e:
+            if e.args[0] not in (errno.EINTR, errno.EAGAIN):
+                raise
+
+    def reload(self):
+        """Load and warm up a new app, and replace workers one at a time."""
+        logger.info("Reloading.")
+        old_app = self.app
+        try:
+            self.app = self._load()
+            self._warmup()
+        except Exception:
+            logger.exception("Error loading app; not reloading.")
+            if self.app is not old_app:
+                _close(self.app)
+            self.app = old_app
+            return
+        _close(old_app)
+        self.generation += 1
+
+    def maintain(self):
+        """Start and stop workers as needed, one step at a time."""
+        current = [
+            pid for pid, child in self.children.items()
+            if child.generation == self.generation]
+        old = [
+            pid for pid, child in self.children.items()
+            if child.generation != self.generation and
+            pid not in self._stopping]
+        if len(current) < self.workers and time.time() >= self._spawn_after:
+            slot = self._free_slot()
+            if slot is not None:
+                self.spawn(slot)
+                return
+        ready = all(
+            self.scoreboard.get(self.children[pid].slot, 'started')
+            for pid in current)
+        if old and ready and len(current) + len(old) > self.workers:
+            self.kill(old[0], signal.SIGTERM)
+
+    def _free_slot(self):
+        used = set(child.slot for child in self.children.values())
+        for slot in range(self.scoreboard.slots):
+            if slot not in used:
+                return slot
+        return None
+
+    def spawn(self, slot):
+        """Fork a worker process in scoreboard ``slot``; return its pid."""
+        self.scoreboard.reset(slot)
+        pid = os.fork()
+        if pid:
+            self.children[pid] = _Child(slot, self.generation, time.time())
+            return pid
+        status = 0
+        try:
+            Worker(self, slot).run()
+        except SystemExit as e:
+            status = e.code
+        except BaseException:
+            logger.exception("Error in worker.")
+            status = 1
+        finally:
+            os._exit(status or 0)
+
+    def kill(self, pid, signum):
+        if signum == signal.SIGTERM:
+            self._stopping.add(pid)
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        """Clean up after exited workers."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            child = self.children.pop(pid, None)
+            if child is None:
+                continue
+            if pid in self._stopping:
+                self._stopping.discard(pid)
+            else:
+                logger.warning(
+                    "Worker %s exited unexpectedly (status %s).", pid, status)
+                self.scoreboard.set(
+                    child.slot,
+                    crashes=self.scoreboard.get(child.slot, 'crashes') + 1,
+                    )
+                if time.time() - child.spawned < 1.0:
+                    self._spawn_after = time.time() + 1.0
+            self.scoreboard.set(child.slot, pid=0)
+
+    def stop(self, graceful=True):
+        """Stop all workers; kill any still running after the timeout."""
+        deadline = time.time()
+        if graceful:
+            deadline += self.option('graceful_timeout')
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGTERM if graceful else signal.SIGKILL)
+        while self.children and time.time() < deadline:
+            self.reap()
+            self._wait(0.1)
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGKILL)
+        while self.children:
+            self.reap()
+            self._wait(0.1)
+
+    def log_stats(self):
+        for worker in self.scoreboard.workers():
+            logger.info(
+                "Worker %(pid)s: %(requests)s requests, %(active)s active, "
+                "%(busy).3fs busy, %(crashes)s crashes in slot %(slot)s.",
+                worker,
+                )
+
+
+def _close(app):
+    close = getattr(app, 'close', None)
+    if close is not None:
+        close()
+
+
+class Worker(object):
+    """A worker process of an ``Arbiter``, in scoreboard ``slot``."""
+    def __init__(self, arbiter, slot):
+        self.arbiter = arbiter
+        self.slot = slot
+        self.master_pid = os.getppid()
+        self.alive = True
+
+    def run(self):
+        arbiter, scoreboard = self.arbiter, self.arbiter.scoreboard
+        for fd in arbiter._pipe:
+            os.close(fd)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for signum in [signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1,
+                       signal.SIGCHLD]:
+            signal.signal(signum, signal.SIG_DFL)
+        # Don't share the master's random sequence (e.g. for sampling).
+        random.seed()
+
+        if arbiter.option('threaded'):
+            server_class = ThreadedWorkerServer
+            keepalive = arbiter.option('keepalive')
+        else:
+            server_class = WorkerServer
+            keepalive = None
+        server = server_class(arbiter.listener, self.wsgi_app, keepalive)
+        scoreboard.set(self.slot, pid=os.getpid(), started=time.time())
+
+        # Not ``server.handle_request()``, which doesn't wait on a non-blocking
+        # socket. Accepting fails harmlessly if another worker got there first.
+        while self.alive and os.getppid() == self.master_pid:
+            try:
+                ready = select.select([server], [], [], 0.5)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if ready:
+                server._handle_request_noblock()
+        self._finish_threads(arbiter.option('graceful_timeout'))
+        logging.shutdown()
+
+    def wsgi_app(self, environ, start_response):
+        """WSGI app running the arbiter's app, counting its requests."""
+        scoreboard = self.arbiter.scoreboard
+        environ[SCOREBOARD_KEY] = scoreboard
+        scoreboard.begin(self.slot)
+        start = timer()
+        try:
+            return self.arbiter.app(environ, start_response)
+        finally:
+            scoreboard.end(self.slot, timer() - start)
+
+    def _stop(self, signum, frame):
+        self.alive = False
+
+    def _finish_threads(self, timeout):
+        deadline = time.time() + timeout
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join(max(deadline - time.time(), 0))
+
+
+def main(argv=None):
+    """Entry point of the ``gurtel`` command."""
+    parser = argparse.ArgumentParser(prog='gurtel')
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser(
+        'serve', help="Run a pre-fork server for an app.")
+    serve.add_argument(
+        'app',
+        help="Dotted path to a factory taking a Config and returning the "
+        "GurtelApp to serve",
+        )
+    serve.add_argument(
+        '-c', '--config', action='append', default=[],
+        help="A .ini config file (may be given more than once)",
+        )
+    serve.add_argument(
+        '--env-prefix',
+        help="Also read config from env vars with this prefix",
+        )
+    serve.add_argument(
+        '-b', '--bind', help="host:port to listen on (server.bind setting)")
+    serve.add_argument(
+        '-w', '--workers', type=int,
+        help="Number of worker processes (server.workers setting)",
+        )
+    serve.add_argument(
+        '--threaded', action='store_true', default=None,
+        help="Handle each connection in a thread (server.threaded setting)",
+        )
+    serve.add_argument(
+        '--keepalive', type=float,
+        help="Seconds to keep idle connections open (server.keepalive "
+        "setting)",
+        )
+    build_assets = commands.add_parser(
+        'assets', help="Build fingerprinted static assets.")
+    build_assets.add_argument('source_dir', help="Directory of assets")
+    build_assets.add_argument(
+        'build_dir', help="Directory to build into (assets.dir setting)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'assets':
+        from gurtel import assets
+        manifest = assets.build(args.source_dir, args.build_dir)
+        print "Built %d assets into %s." % (len(manifest), args.build_dir)
+        return
+
+    factory = import_from_dotted_path(args.app)
+
+    def load_config():
+        config = Config()
+        for conf_file in args.config:
+            config.read_from_file(conf_file)
+        if args.env_prefix:
+            config.read_from_env(args.env_prefix)
+        return config
+
+    config = load_config()
+    if config.get('app.logging') is None:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='[%(process)d] %(levelname)s %(name)s: %(message)s',
+            )
+    log.configure_logging(config)
+
+    Arbiter(
+        lambda: factory(load_config()),
+        bind=args.bind,
+        workers=args.workers,
+        threaded=args.threaded,
+        keepalive=args.keepalive,
+        ).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
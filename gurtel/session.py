@@ -1,28 +1,336 @@
+import base64
+import calendar
+from collections import Counter
 from datetime import timedelta
+from hashlib import sha1
+from hmac import new as hmac
 import json
+import marshal
+from time import time
+from timeit import default_timer as timer
+import zlib
 
 from werkzeug.contrib.securecookie import SecureCookie
+from werkzeug.local import LocalProxy
+from werkzeug.security import safe_str_cmp
 
-from . import timezone
+from . import metrics, timezone
+
+
+#: Counts of session work done and skipped, across all requests.
+stats = Counter()
+
+#: Prefix of compact-format cookies; can't start a legacy cookie (which
+#: begins with a base64-encoded MAC).
+FORMAT_PREFIX = '!'
+FORMAT_VERSION = '1'
+
+
+class JSONSerializer(object):
+    """Compact JSON session serializer."""
+    tag = 'j'
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MarshalSerializer(object):
+    """
+    Binary session serializer using ``marshal``.
+
+    Fast and compact, but only safe because the payload's MAC is verified
+    before it is loaded, and only portable between identical Python versions.
+
+    """
+    tag = 'm'
+
+    def dumps(self, data):
+        return marshal.dumps(data, 2)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+#: Maps serializer names (for the ``session.serializer`` config setting) to
+#: serializer instances. Each serializer's ``tag`` is stored in the cookie.
+serializers = {}
+
+
+def register_serializer(name, serializer):
+    """
+    Register ``serializer`` for use under ``name``.
+
+    ``serializer`` must have ``dumps`` and ``loads`` methods (converting
+    between a dictionary and a bytestring) and a unique single-character
+    ``tag``.
+
+    """
+    for other in serializers.values():
+        if other.tag == serializer.tag and other is not serializer:
+            raise ValueError(
+                "Serializer tag %r is already registered." % serializer.tag)
+    serializers[name] = serializer
+
+
+register_serializer('json', JSONSerializer())
+register_serializer('marshal', MarshalSerializer())
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
 
 
 class JSONSecureCookie(SecureCookie):
     serialization_method = json
 
 
+class CompactSecureCookie(JSONSecureCookie):
+    """
+    Signed cookie storing the whole session as a single versioned payload.
+
+    The format is ``!<version><tag>[z].<mac>.<payload>``, where ``tag``
+    identifies the serializer used and ``z`` marks a zlib-compressed payload
+    (payloads are compressed once they exceed ``compress_threshold`` bytes).
+    Cookies in the legacy ``JSONSecureCookie`` format are still loaded.
+
+    """
+    serializer = serializers['json']
+    compress_threshold = 1024
+
+    def serialize(self, expires=None):
+        if self.secret_key is None:
+            raise RuntimeError('no secret key defined')
+        data = dict(self)
+        if expires:
+            data['_expires'] = calendar.timegm(expires.utctimetuple())
+        payload = self.serializer.dumps(data)
+        header = FORMAT_PREFIX + FORMAT_VERSION + self.serializer.tag
+        if self.compress_threshold is not None and (
+                len(payload) > self.compress_threshold):
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                header += 'z'
+                payload = compressed
+        payload = _b64encode(payload)
+        mac = self._mac(self.secret_key, header, payload)
+        return '.'.join([header, mac, payload])
+
+    @classmethod
+    def unserialize(cls, string, secret_key):
+        if isinstance(string, unicode):
+            string = string.encode('utf-8', 'replace')
+        if not string.startswith(FORMAT_PREFIX):
+            return super(CompactSecureCookie, cls).unserialize(
+                string, secret_key)
+        if isinstance(secret_key, unicode):
+            secret_key = secret_key.encode('utf-8', 'replace')
+        try:
+            header, mac, payload = string.split('.', 2)
+            data = cls._load(secret_key, header, mac, payload)
+        except Exception:
+            # Bad MACs, unknown versions and corrupt payloads all just
+            # result in an empty session.
+            data = {}
+        if '_expires' in data:
+            if time() > data.pop('_expires'):
+                data = {}
+        return cls(data, secret_key, False)
+
+    @classmethod
+    def _load(cls, secret_key, header, mac, payload):
+        if not safe_str_cmp(mac, cls._mac(secret_key, header, payload)):
+            raise ValueError("Bad session MAC.")
+        if header[1:2] != FORMAT_VERSION:
+            raise ValueError("Unknown session format %r." % header)
+        tag, flags = header[2:3], header[3:]
+        for serializer in serializers.values():
+            if serializer.tag == tag:
+                break
+        else:
+            raise ValueError("Unknown session serializer %r." % tag)
+        payload = _b64decode(payload)
+        if flags == 'z':
+            payload = zlib.decompress(payload)
+        data = serializer.loads(payload)
+        if not isinstance(data, dict):
+            raise ValueError("Session payload is not a dictionary.")
+        return data
+
+    @classmethod
+    def _mac(cls, secret_key, header, payload):
+        mac = hmac(secret_key, header + '.' + payload, cls.hash_method)
+        return _b64encode(mac.digest())
+
+
+_cookie_classes = {}
+
+
+def get_cookie_class(serializer=None, compress_threshold=1024):
+    """
+    Return a session cookie class for given serializer name and threshold.
+
+    With no ``serializer``, returns the legacy ``JSONSecureCookie``.
+
+    """
+    if serializer is None:
+        return JSONSecureCookie
+    key = (serializer, compress_threshold)
+    cookie_class = _cookie_classes.get(key)
+    if cookie_class is None:
+        cookie_class = _cookie_classes[key] = type(
+            'CompactSecureCookie', (CompactSecureCookie,), {
+                'serializer': serializers[serializer],
+                'compress_threshold': compress_threshold,
+                })
+    return cookie_class
+
+
+class SessionLoader(object):
+    """
+    Callable that loads a request's session cookie the first time it's called.
+
+    ``session`` is ``None`` until then.
+
+    """
+    def __init__(self, request, cookie_class=JSONSecureCookie):
+        self.request = request
+        self.cookie_class = cookie_class
+        self.session = None
+
+    def __call__(self):
+        if self.session is None:
+            start = timer()
+            self.session = self.load()
+            stats['loaded'] += 1
+            metrics.record(self.request, 'session.load', timer() - start)
+        return self.session
+
+    def load(self):
+        return self.cookie_class.load_cookie(
+            self.request, secret_key=self.request.app.secret_key)
+
+
+class StoreSessionLoader(SessionLoader):
+    """Loads a request's session from a store, by the ID in its cookie."""
+    def __init__(self, request, store):
+        SessionLoader.__init__(self, request)
+        self.store = store
+
+    def load(self):
+        sid = unsign_session_id(
+            self.request.cookies.get('session'), self.request.app.secret_key)
+        if sid is None:
+            return self.store.new()
+        return self.store.get(sid)
+
+
+def sign_session_id(sid, secret_key):
+    """Return cookie value for session ID ``sid``, signed with secret key."""
+    mac = hmac(bytes(secret_key), sid, sha1)
+    return '%s.%s' % (sid, _b64encode(mac.digest()))
+
+
+def unsign_session_id(value, secret_key):
+    """Return session ID from signed cookie ``value``, or ``None``."""
+    if not value:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode('utf-8', 'replace')
+    sid = value.split('.', 1)[0]
+    if not safe_str_cmp(value, sign_session_id(sid, secret_key)):
+        return None
+    return sid
+
+
 def session_middleware(request, response_callable):
-    """JSON signed-cookie sessions middleware."""
-    request.session = JSONSecureCookie.load_cookie(
-        request, secret_key=request.app.secret_key)
+    """
+    JSON signed-cookie sessions middleware.
+
+    By default sessions are stored in the legacy ``JSONSecureCookie`` format.
+    If the ``session.serializer`` config setting names a registered serializer,
+    the ``CompactSecureCookie`` format is written instead, compressed above
+    ``session.compress_threshold`` bytes (default 1024).
+
+    ``request.session`` is a lazy proxy; the cookie is only parsed if the
+    session is accessed, and only re-signed and set on the response if the
+    session was modified.
+
+    """
+    settings = request.settings
+    cookie_class = get_cookie_class(
+        settings['session.serializer'],
+        settings['session.compress_threshold'],
+        )
+    loader = SessionLoader(request, cookie_class)
+    request.session = LocalProxy(loader)
+    response = response_callable(request)
+    stats['requests'] += 1
+    if loader.session is None or not loader.session.should_save:
+        stats['skipped_save'] += 1
+        return response
+    start = timer()
+    loader.session.save_cookie(response, **_cookie_kwargs(request))
+    stats['saved'] += 1
+    metrics.record(request, 'session.save', timer() - start)
+    return response
+
+
+def store_session_middleware(request, response_callable):
+    """
+    Server-side sessions middleware.
+
+    Session data lives in ``request.app.session_store`` (see
+    ``gurtel.session_store``); the cookie holds only the signed session ID.
+    As with ``session_middleware``, the session is loaded lazily, and only
+    written back to the store (and the cookie set) if modified. Sessions
+    emptied during the request are deleted from the store.
+
+    """
+    store = request.app.session_store
+    loader = StoreSessionLoader(request, store)
+    request.session = LocalProxy(loader)
     response = response_callable(request)
+    stats['requests'] += 1
+    session = loader.session
+    if session is None or not session.should_save:
+        stats['skipped_save'] += 1
+        return response
+    if not session:
+        if not session.new:
+            store.delete(session)
+        stats['skipped_save'] += 1
+        return response
+    start = timer()
+    store.save(session)
+    response.set_cookie(
+        'session',
+        sign_session_id(session.sid, request.app.secret_key),
+        **_cookie_kwargs(request))
+    stats['saved'] += 1
+    metrics.record(request, 'session.save', timer() - start)
+    return response
+
+
+# Handlers opt out of either session middleware as 'session'; see
+# ``gurtel.middleware``.
+session_middleware.middleware_name = 'session'
+store_session_middleware.middleware_name = 'session'
+
+
+def _cookie_kwargs(request):
     cookie_kwargs = {
         'httponly': True,
         'secure': request.app.is_ssl,
     }
-    expiry_minutes = int(
-        request.app.config.get('session.expiry_minutes', 0))
+    expiry_minutes = request.settings['session.expiry_minutes']
     if expiry_minutes:
         delta = timedelta(minutes=expiry_minutes)
         cookie_kwargs['expires'] = timezone.now() + delta
-    request.session.save_cookie(response, **cookie_kwargs)
-    return response
+    return cookie_kwargs
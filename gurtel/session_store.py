@@ -0,0 +1,342 @@
+"""
+Server-side session stores.
+
+Each store is a Werkzeug ``SessionStore``; session data is kept in the store
+and only the (signed) session ID goes in the cookie. See
+``gurtel.session.store_session_middleware``.
+
+"""
+from collections import OrderedDict
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urlparse
+
+from werkzeug.contrib.sessions import SessionStore
+
+
+class MemorySessionStore(SessionStore):
+    """
+    In-process session store, bounded to ``max_entries`` (least recently used
+    sessions are evicted first), with optional ``ttl`` in seconds.
+
+    Expired sessions are ignored when fetched, and swept out at most every
+    ``sweep_interval`` seconds, when a session is saved.
+
+    """
+    def __init__(self, max_entries=10000, ttl=None, sweep_interval=60,
+                 session_class=None):
+        SessionStore.__init__(self, session_class)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = time.time() + sweep_interval
+
+    def get(self, sid):
+        if not self.is_valid_key(sid):
+            return self.new()
+        with self._lock:
+            try:
+                expires, data = self._data.pop(sid)
+            except KeyError:
+                return self.new()
+            if expires is not None and expires < time.time():
+                return self.new()
+            self._data[sid] = (expires, data)
+        return self.session_class(json.loads(data), sid, False)
+
+    def save(self, session):
+        now = time.time()
+        expires = now + self.ttl if self.ttl else None
+        data = json.dumps(dict(session))
+        with self._lock:
+            self._data.pop(session.sid, None)
+            self._data[session.sid] = (expires, data)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+    def delete(self, session):
+        with self._lock:
+            self._data.pop(session.sid, None)
+
+    def _sweep(self, now):
+        self._next_sweep = now + self.sweep_interval
+        expired = [
+            sid for sid, (expires, _) in self._data.items()
+            if expires is not None and expires < now
+            ]
+        for sid in expired:
+            del self._data[sid]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store in an SQLite database file, shareable between processes.
+
+    Each thread (in each process) reuses its own connection. Expired sessions
+    are ignored when fetched, and deleted at most every ``sweep_interval``
+    seconds, when a session is saved.
+
+    """
+    def __init__(self, path, ttl=None, sweep_interval=60, timeout=5.0,
+                 session_class=None):
+        SessionStore.__init__(self, session_class)
+        self.path = path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.timeout = timeout
+        self._local = threading.local()
+        self._next_sweep = time.time() + sweep_interval
+        with self.connection as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL)"
+                )
+
+    @property
+    def connection(self):
+        """A connection for the current thread (and process)."""
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.connection = self._connect()
+            self._local.pid = pid
+        return self._local.connection
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, sid):
+        if not self.is_valid_key(sid):
+            return self.new()
+        row = self.connection.execute(
+            "SELECT data FROM sessions "
+            "WHERE sid = ? AND (expires IS NULL OR expires >= ?)",
+            (sid, time.time()),
+            ).fetchone()
+        if row is None:
+            return self.new()
+        return self.session_class(json.loads(row[0]), sid, False)
+
+    def save(self, session):
+        now = time.time()
+        expires = now + self.ttl if self.ttl else None
+        with self.connection as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, data, expires) "
+                "VALUES (?, ?, ?)",
+                (session.sid, json.dumps(dict(session)), expires),
+                )
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                conn.execute(
+                    "DELETE FROM sessions WHERE expires < ?", (now,))
+
+    def delete(self, session):
+        with self.connection as conn:
+            conn.execute(
+                "DELETE FROM sessions WHERE sid = ?", (session.sid,))
+
+
+class RedisError(Exception):
+    """An error reply from a Redis server."""
+
+
+class RedisConnection(object):
+    """A single connection to a Redis-compatible server."""
+    def __init__(self, host='localhost', port=6379, db=0, timeout=5.0):
+        self.pid = os.getpid()
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        if db:
+            self.execute('SELECT', db)
+
+    def execute(self, *args):
+        """Send a command and return its reply."""
+        self.sock.sendall(encode_command(args))
+        return read_reply(self.reader)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def encode_command(args):
+    """Encode a Redis command as a RESP array of bulk strings."""
+    parts = ['*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        else:
+            arg = str(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+def read_reply(reader):
+    """Read and decode one RESP reply from file-like ``reader``."""
+    line = reader.readline()
+    if not line.endswith('\r\n'):
+        raise socket.error("Connection closed by Redis server.")
+    kind, rest = line[0], line[1:-2]
+    if kind == '+':
+        return rest
+    elif kind == '-':
+        raise RedisError(rest)
+    elif kind == ':':
+        return int(rest)
+    elif kind == '$':
+        length = int(rest)
+        if length == -1:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    elif kind == '*':
+        length = int(rest)
+        if length == -1:
+            return None
+        return [read_reply(reader) for i in range(length)]
+    raise RedisError("Unknown reply type %r." % line)
+
+
+class RedisClient(object):
+    """
+    Minimal client for a Redis-compatible server, with a connection pool.
+
+    Up to ``max_idle`` idle connections are kept for reuse; connections are
+    never shared between threads or (after a fork) processes.
+
+    """
+    connection_class = RedisConnection
+
+    def __init__(self, host='localhost', port=6379, db=0, timeout=5.0,
+                 max_idle=10):
+        self.connection_kwargs = {
+            'host': host, 'port': port, 'db': db, 'timeout': timeout}
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """Create a client from a ``redis://host:port/db`` URL."""
+        bits = urlparse.urlparse(url)
+        db = bits.path.strip('/')
+        return cls(
+            host=bits.hostname or 'localhost',
+            port=bits.port or 6379,
+            db=int(db) if db else 0,
+            **kwargs)
+
+    def execute(self, *args):
+        """Run a command on a pooled connection and return its reply."""
+        conn = self._acquire()
+        try:
+            reply = conn.execute(*args)
+        except RedisError:
+            self._release(conn)
+            raise
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn)
+        return reply
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def set(self, key, value, ex=None):
+        if ex:
+            return self.execute('SET', key, value, 'EX', int(ex))
+        return self.execute('SET', key, value)
+
+    def delete(self, key):
+        return self.execute('DEL', key)
+
+    def _acquire(self):
+        pid = os.getpid()
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if conn.pid == pid:
+                    return conn
+        return self.connection_class(**self.connection_kwargs)
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Session store on a Redis-compatible server.
+
+    ``client`` can be any object with Redis-like ``get``, ``set`` (accepting
+    an ``ex`` expiry in seconds) and ``delete`` methods; a ``RedisClient`` for
+    ``localhost`` is used by default. Expiry is handled by the server.
+
+    """
+    def __init__(self, client=None, ttl=None, prefix='session:',
+                 session_class=None):
+        SessionStore.__init__(self, session_class)
+        self.client = client or RedisClient()
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, sid):
+        if not self.is_valid_key(sid):
+            return self.new()
+        data = self.client.get(self.prefix + sid)
+        if data is None:
+            return self.new()
+        return self.session_class(json.loads(data), sid, False)
+
+    def save(self, session):
+        self.client.set(
+            self.prefix + session.sid, json.dumps(dict(session)), ex=self.ttl)
+
+    def delete(self, session):
+        self.client.delete(self.prefix + session.sid)
+
+
+def store_from_config(config):
+    """
+    Return the session store configured in ``config``, or ``None``.
+
+    The ``session.store`` config setting selects the store: ``memory``,
+    ``sqlite`` (database at ``session.store_path``) or ``redis`` (server at
+    ``session.store_url``). Sessions expire after ``session.expiry_minutes``,
+    if set; ``session.store_max_entries`` bounds the ``memory`` store.
+
+    """
+    kind = config.get('session.store')
+    if not kind:
+        return None
+    ttl = int(config.get('session.expiry_minutes', 0)) * 60 or None
+    if kind == 'memory':
+        return MemorySessionStore(
+            max_entries=int(config.get('session.store_max_entries', 10000)),
+            ttl=ttl,
+            )
+    elif kind == 'sqlite':
+        return SQLiteSessionStore(config.getpath('session.store_path'), ttl)
+    elif kind == 'redis':
+        client = RedisClient.from_url(
+            config.get('session.store_url', 'redis://localhost:6379/0'))
+        return RedisSessionStore(client, ttl)
+    raise ValueError("Unknown session store %r." % kind)
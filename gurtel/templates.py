@@ -1,22 +1,333 @@
-from jinja2 import Environment, FileSystemLoader
+from collections import Counter, defaultdict
+import errno
+import os
+import tempfile
+import time
+import types
+
+import jinja2
+from jinja2 import FileSystemBytecodeCache, TemplateNotFound, meta
 from werkzeug.wrappers import Response
 
+from . import metrics
+from .fragment_cache import FragmentCacheExtension
+
+
+class Environment(jinja2.Environment):
+    """Jinja environment that keeps template cache and compile statistics."""
+    def __init__(self, *args, **kwargs):
+        self.template_stats = Counter()
+        jinja2.Environment.__init__(self, *args, **kwargs)
+
+    def get_template(self, *args, **kwargs):
+        self.template_stats['lookups'] += 1
+        return jinja2.Environment.get_template(self, *args, **kwargs)
+
+    def compile(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return jinja2.Environment.compile(self, *args, **kwargs)
+        finally:
+            self.template_stats['compiles'] += 1
+            self.template_stats['compile_time'] += time.time() - start
+
+
+class FileSystemLoader(jinja2.FileSystemLoader):
+    """
+    Filesystem template loader that counts template cache misses.
+
+    Jinja only asks its loader to load a template when it isn't in the
+    environment's template cache (or is out of date).
+
+    """
+    def load(self, environment, name, globals=None):
+        environment.template_stats['misses'] += 1
+        return jinja2.FileSystemLoader.load(self, environment, name, globals)
+
+
+class IndexedFileSystemLoader(FileSystemLoader):
+    """
+    Production template loader.
+
+    Indexes the template directories once, on creation; thereafter never
+    touches the filesystem except to read a template's source, and always
+    considers loaded templates up to date.
+
+    """
+    def __init__(self, searchpath, encoding='utf-8'):
+        FileSystemLoader.__init__(self, searchpath, encoding)
+        self.index = {}
+        for searchpath in reversed(self.searchpath):
+            for dirpath, dirnames, filenames in os.walk(searchpath):
+                for filename in filenames:
+                    full_path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(full_path, searchpath).replace(
+                        os.path.sep, '/')
+                    self.index[name] = full_path
+
+    def get_source(self, environment, template):
+        filename = self.index.get(template)
+        if filename is None:
+            raise TemplateNotFound(template)
+        with open(filename, 'rb') as f:
+            contents = f.read().decode(self.encoding)
+        return contents, filename, lambda: True
+
+    def list_templates(self):
+        return sorted(self.index)
+
+
+class AtomicFileSystemBytecodeCache(FileSystemBytecodeCache):
+    """
+    Filesystem bytecode cache that is safe for concurrent writers.
+
+    Bytecode is written to a temporary file and renamed into place, so readers
+    never see a partially-written cache file. The cache directory is created if
+    it doesn't exist.
+
+    """
+    def __init__(self, directory, pattern='__jinja2_%s.cache'):
+        FileSystemBytecodeCache.__init__(self, directory, pattern)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def dump_bytecode(self, bucket):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmp_path, self._get_cache_filename(bucket))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def provides(*names):
+    """
+    Decorator declaring the template variables a context processor provides.
+
+    ``TemplateRenderer.render`` only calls such a context processor if the
+    template being rendered uses one of those variables. Context processors
+    without a declaration are always called.
+
+    """
+    def _decorator(func):
+        func.provides = frozenset(names)
+        return func
+
+    return _decorator
+
+
+# Environment for precompile worker processes, which inherit it via fork.
+_precompile_env = None
+
+
+def _precompile(names):
+    for name in names:
+        _precompile_env.get_template(name)
+
 
 class TemplateRenderer(object):
+    """
+    Renders Jinja templates from ``template_dir``.
+
+    In ``production`` mode, the template directory is indexed once up front
+    and templates are never checked for changes, and by default the template
+    cache is unbounded. Otherwise ``cache_size`` defaults to Jinja's default
+    of 50 templates. A negative ``cache_size`` means unbounded.
+
+    ``stream_buffer_size`` is the number of template events buffered into each
+    chunk of a streamed response (see ``render_stream``).
+
+    ``fragment_cache`` (a ``gurtel.fragment_cache.FragmentCache``) is used by
+    the ``{% cache %}`` template tag and by ``cache_fragment``.
+
+    If an ``asset_handler`` (a ``gurtel.assets.AssetHandler``) is given, its
+    ``url`` method is available to templates as ``asset_url``; e.g.
+    ``{{ asset_url('css/site.css') }}``.
+
+    """
     def __init__(self, template_dir,
-                 asset_handler=None, context_processors=None):
+                 asset_handler=None, context_processors=None,
+                 bytecode_cache_dir=None, production=False, cache_size=None,
+                 stream_buffer_size=5, fragment_cache=None):
+        bytecode_cache = None
+        if bytecode_cache_dir is not None:
+            bytecode_cache = AtomicFileSystemBytecodeCache(bytecode_cache_dir)
+        if production:
+            loader = IndexedFileSystemLoader(template_dir)
+        else:
+            loader = FileSystemLoader(template_dir)
+        if cache_size is None:
+            cache_size = -1 if production else 50
         self.jinja_env = Environment(
-            loader=FileSystemLoader(template_dir),
+            loader=loader,
             autoescape=True,
+            bytecode_cache=bytecode_cache,
+            auto_reload=not production,
+            cache_size=cache_size,
+            extensions=[FragmentCacheExtension],
             )
+        self.jinja_env.fragment_cache = fragment_cache
+        self.asset_handler = asset_handler
+        if asset_handler is not None:
+            self.jinja_env.globals['asset_url'] = asset_handler.url
         self.context_processors = context_processors or []
+        self.stream_buffer_size = stream_buffer_size
+        self.processor_stats = defaultdict(Counter)
+        self._variables = {}
+
+    @property
+    def fragment_cache(self):
+        return self.jinja_env.fragment_cache
+
+    def cache_fragment(self, name, vary_on, render, ttl=None):
+        """
+        Return fragment ``name`` from the fragment cache, varying on values.
+
+        If not cached, call ``render`` to get it, and cache it for ``ttl``
+        seconds (or the fragment cache default). If there is no fragment
+        cache, just call ``render``.
+
+        """
+        if self.fragment_cache is None:
+            return render()
+        return self.fragment_cache.get_or_render(name, vary_on, render, ttl)
+
+    def cache_stats(self):
+        """
+        Return template cache statistics.
+
+        ``hits`` and ``misses`` count template lookups (including those for
+        extended and included templates) served from and not from the template
+        cache. ``compile_time`` is total seconds spent compiling templates.
+
+        """
+        stats = self.jinja_env.template_stats
+        return {
+            'hits': stats['lookups'] - stats['misses'],
+            'misses': stats['misses'],
+            'compiles': stats['compiles'],
+            'compile_time': stats['compile_time'],
+            }
+
+    def precompile(self, processes=None):
+        """
+        Compile all templates ahead of time; return list of template names.
+
+        If a bytecode cache is configured, templates are compiled into it in
+        parallel by ``processes`` worker processes (defaults to CPU count), so
+        that other processes sharing the cache start with compiled templates.
+
+        """
+        import multiprocessing
+
+        names = self.jinja_env.list_templates()
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if self.jinja_env.bytecode_cache is not None and processes > 1:
+            global _precompile_env
+            _precompile_env = self.jinja_env
+            chunks = [names[i::processes] for i in range(processes)]
+            pool = multiprocessing.Pool(processes)
+            try:
+                pool.map(_precompile, [c for c in chunks if c])
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+                _precompile_env = None
+        for name in names:
+            self.jinja_env.get_template(name)
+        return names
+
+    def template_variables(self, template_name):
+        """
+        Return set of variables used by a template (or ``None`` if unknown).
+
+        Includes variables used by templates it extends, includes or imports.
+        Referenced templates that don't exist (such as ``ignore missing``
+        includes, or fallbacks in a list of includes) are skipped; if
+        auto-reloading, they might yet be created, so the variables are
+        unknown. Cached per template (until it changes, if auto-reloading).
+
+        """
+        env = self.jinja_env
+        cached = self._variables.get(template_name)
+        if cached is not None:
+            variables, tpls = cached
+            if not env.auto_reload or all(t.is_up_to_date for t in tpls):
+                return variables
+        variables, tpls = set(), []
+        pending, seen = [template_name], set()
+        while pending and variables is not None:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            try:
+                tpls.append(env.get_template(name))
+            except TemplateNotFound:
+                if name == template_name:
+                    raise
+                if env.auto_reload:
+                    variables = None
+                continue
+            ast = env.parse(env.loader.get_source(env, name)[0])
+            variables.update(meta.find_undeclared_variables(ast))
+            for referenced in meta.find_referenced_templates(ast):
+                if referenced is None:
+                    # Dynamic template reference; can't know variables.
+                    variables = None
+                    break
+                pending.append(referenced)
+        if variables is not None:
+            variables = frozenset(variables)
+        self._variables[template_name] = (variables, tpls)
+        return variables
 
     def render(self, request, template_name, context=None,
-               mimetype='text/html'):
-        """Request-aware template render."""
+               mimetype='text/html', stream=False):
+        """
+        Request-aware template render.
+
+        Context processors that declare the variables they provide (see
+        ``provides``) are only called if the template uses those variables.
+
+        For HEAD requests whose validators are already known (set by the
+        ``gurtel.conditional.conditional`` decorator) the response is
+        streamed, so the template is never actually rendered. Otherwise it is
+        rendered, so the response gets the same headers (e.g. an ETag hashed
+        from the body) as for GET.
+
+        """
+        render_start = time.time()
+        try:
+            return self._render(
+                request, template_name, context, mimetype, stream)
+        finally:
+            metrics.record(request, 'render', time.time() - render_start)
+
+    def _render(self, request, template_name, context, mimetype, stream):
         context = context or {}
+        variables = self.template_variables(template_name)
         for cp in self.context_processors:
+            stats = self.processor_stats[getattr(cp, '__name__', repr(cp))]
+            keys = getattr(cp, 'provides', None)
+            if keys is not None and variables is not None and not (
+                    keys & variables):
+                stats['skipped'] += 1
+                continue
+            start = time.time()
             context.update(cp(request))
+            stats['calls'] += 1
+            stats['time'] += time.time() - start
+        if stream or (getattr(request, 'method', None) == 'HEAD' and
+                      getattr(request, 'validators', None)):
+            return self.render_stream(template_name, context, mimetype)
         return self.render_template(template_name, context, mimetype)
 
     def render_template(self, template_name, context=None,
@@ -29,3 +340,28 @@ class TemplateRenderer(object):
         """
         tpl = self.jinja_env.get_template(template_name)
         return Response(tpl.render(context or {}), mimetype=mimetype)
+
+    def render_stream(self, template_name, context=None,
+                      mimetype='text/html'):
+        """
+        Render ``template_name`` with ``context`` and ``mimetype``, streaming.
+
+        Return a streamed ``Response``; the template is rendered as the
+        response is iterated, in chunks of ``stream_buffer_size`` template
+        events (unbuffered if ``stream_buffer_size`` is 1 or less).
+
+        Rendering happens after response headers are sent, so it can't affect
+        them (or the session cookie); generators in the context (such as the
+        flash messages from ``flash.context_processor``) are consumed up front
+        for this reason.
+
+        """
+        context = dict(context or {})
+        for key, value in context.items():
+            if isinstance(value, types.GeneratorType):
+                context[key] = list(value)
+        tpl = self.jinja_env.get_template(template_name)
+        stream = tpl.stream(context)
+        if self.stream_buffer_size > 1:
+            stream.enable_buffering(self.stream_buffer_size)
+        return Response(stream, mimetype=mimetype)
@@ -1,6 +1,12 @@
 """Testing utilities."""
+from cStringIO import StringIO
+import urllib
 import urlparse
 
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from werkzeug.urls import url_encode
+from werkzeug.wrappers import Response
+
 
 class Url(object):
     """
@@ -34,3 +40,79 @@ class Url(object):
 
     def __repr__(self):
         return "Url(%s)" % self.url
+
+
+class Client(object):
+    """
+    Lightweight in-process WSGI client for testing an app.
+
+    Builds the base WSGI environ for ``base_url`` once, and copies it per
+    request, setting only request-specific keys. Keeps cookies set by
+    responses (a new client starts with none) and sends them with later
+    requests. Returns ``response_class`` instances with buffered bodies.
+
+    """
+    def __init__(self, app, base_url='http://localhost/',
+                 response_class=Response):
+        self.app = app
+        self.response_class = response_class
+        self.cookies = {}
+        environ = EnvironBuilder(base_url=base_url).get_environ()
+        del environ['wsgi.input']
+        self._base_environ = environ
+
+    def open(self, path, method='GET', data=None, headers=None,
+             content_type=None):
+        """
+        Make a request; return response.
+
+        ``data`` is the request body: a string, or a dictionary to send as
+        form data. ``headers`` is a dictionary of extra request headers.
+
+        """
+        environ = self._base_environ.copy()
+        path, _, query = path.partition('?')
+        environ['PATH_INFO'] = urllib.unquote(path)
+        environ['QUERY_STRING'] = query
+        environ['REQUEST_METHOD'] = method
+        if isinstance(data, dict):
+            data = url_encode(data)
+            content_type = content_type or 'application/x-www-form-urlencoded'
+        data = data or ''
+        environ['wsgi.input'] = StringIO(data)
+        environ['CONTENT_LENGTH'] = str(len(data))
+        environ['CONTENT_TYPE'] = content_type or ''
+        for name, value in (headers or {}).items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = value
+        if self.cookies:
+            environ['HTTP_COOKIE'] = '; '.join(
+                '%s=%s' % item for item in self.cookies.items())
+
+        app_iter, status, response_headers = run_wsgi_app(
+            self.app, environ, buffered=True)
+        response = self.response_class(app_iter, status, response_headers)
+        for header in response.headers.getlist('Set-Cookie'):
+            name, _, value = header.split(';', 1)[0].partition('=')
+            if value:
+                self.cookies[name] = value
+            else:
+                self.cookies.pop(name, None)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.open(path, 'GET', **kwargs)
+
+    def head(self, path, **kwargs):
+        return self.open(path, 'HEAD', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, 'POST', **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.open(path, 'PUT', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, 'DELETE', **kwargs)
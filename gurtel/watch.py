@@ -0,0 +1,104 @@
+"""Watching files (such as config files) for changes."""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import threading
+
+from .config import file_stamp
+
+
+logger = logging.getLogger(__name__)
+
+# inotify event mask: file written, or created/moved into a directory (as
+# editors and deploy tools replace files).
+_IN_MASK = 0x00000008 | 0x00000080 | 0x00000100  # CLOSE_WRITE|MOVED_TO|CREATE
+
+
+def inotify_watch(directories):
+    """
+    Return a non-blocking inotify file descriptor watching ``directories``.
+
+    Returns ``None`` if inotify isn't available (it is Linux-only).
+
+    """
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = inotify_init1(os.O_NONBLOCK)
+    if fd < 0:
+        return None
+    for directory in directories:
+        inotify_add_watch(fd, directory, _IN_MASK)
+    return fd
+
+
+class FileWatcher(object):
+    """
+    Calls ``callback`` (with no arguments) when any of ``paths`` changes.
+
+    ``start()`` starts a daemon thread watching the files' directories with
+    inotify, where available, and otherwise polling the files every
+    ``interval`` seconds. Exceptions raised by ``callback`` in the watcher
+    thread are logged. ``check()`` checks for changes synchronously.
+
+    """
+    def __init__(self, paths, callback, interval=1.0):
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.callback = callback
+        self.interval = interval
+        self.stamps = self._stamps()
+        self.inotify = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stamps(self):
+        return [file_stamp(p) for p in self.paths]
+
+    def check(self):
+        """Call ``callback`` if any file has changed; return ``True`` if so."""
+        stamps = self._stamps()
+        if stamps == self.stamps:
+            return False
+        self.stamps = stamps
+        self.callback()
+        return True
+
+    def start(self):
+        """Start watching in a daemon thread; return ``self``."""
+        self._thread = threading.Thread(target=self._run, name='FileWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching (waiting for the watcher thread to finish)."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        fd = inotify_watch(set(os.path.dirname(p) for p in self.paths))
+        self.inotify = fd is not None
+        try:
+            while not self._stopped.is_set():
+                if fd is None:
+                    self._stopped.wait(self.interval)
+                elif select.select([fd], [], [], self.interval)[0]:
+                    # Drain the events; which file changed is found by stat.
+                    os.read(fd, 65536)
+                if self._stopped.is_set():
+                    break
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception(
+                        "Error handling change to %s.", self.paths)
+        finally:
+            if fd is not None:
+                os.close(fd)
@@ -47,6 +47,9 @@ setup(
         "requests",
         ],
     entry_points={
+        'console_scripts': [
+            'gurtel = gurtel.server:main',
+            ],
         'pytest11': [
             'gurtel = gurtel.pytest_plugin',
             ]
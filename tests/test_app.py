@@ -1,13 +1,21 @@
+from functools import partial
+import os
+import subprocess
+import sys
+
 import mock
 from pretend import stub
 import pytest
+from werkzeug.routing import Rule
 from werkzeug.test import Client, EnvironBuilder
 from werkzeug.wrappers import Response
 
+from gurtel import assets, conditional, log, middleware, session
 from gurtel.app import redirect_if, GurtelApp
 from gurtel.config import Config
 
 from .conftest import TESTAPP_BASE_DIR
+from .test_templates import Messages
 
 
 class FakeApp(object):
@@ -59,7 +67,7 @@ class TestGurtelAppConfig(object):
         assert app.server_scheme == 'https'
         assert app.server_host == 'example.com'
 
-    @mock.patch('gurtel.app.DebuggedApplication')
+    @mock.patch('werkzeug.debug.DebuggedApplication')
     @pytest.mark.parametrize('tf', [True, False])
     def test_debugger(self, mock_DebuggedApplication, tf):
         """Debugger enabled only if configured."""
@@ -67,6 +75,145 @@ class TestGurtelAppConfig(object):
 
         assert bool(mock_DebuggedApplication.call_count) == tf
 
+    def test_session_store(self):
+        """Server-side sessions used if a session store is configured."""
+        app = self.get_app({'session.store': 'memory'})
+
+        assert app.session_store is not None
+        assert app.middlewares == [session.store_session_middleware]
+
+    def test_no_session_store(self):
+        """Cookie sessions used by default."""
+        app = self.get_app({})
+
+        assert app.session_store is None
+        assert app.middlewares == [session.session_middleware]
+
+    def test_template_bytecode_cache(self, tmpdir):
+        """Template bytecode cache and precompilation are configurable."""
+        app = self.get_app({
+            'templates.bytecode_cache_dir': str(tmpdir),
+            'templates.precompile': 'true',
+            })
+
+        assert app.tpl.jinja_env.bytecode_cache.directory == str(tmpdir)
+        assert len(tmpdir.listdir()) == 3
+
+    def test_template_production_mode(self):
+        """Production template settings are configurable."""
+        app = self.get_app({
+            'templates.production': 'true',
+            'templates.cache_size': '100',
+            })
+
+        assert not app.tpl.jinja_env.auto_reload
+        assert app.tpl.jinja_env.cache.capacity == 100
+
+    def test_profiler(self, tmpdir):
+        """Profiling middleware is outermost, if configured."""
+        app = self.get_app({
+            'profile.sample_rate': '0.1',
+            'profile.dir': str(tmpdir),
+            'profile.endpoints': 'thing, other',
+            })
+
+        assert app.profiler.sample_rate == 0.1
+        assert app.profiler.endpoints == frozenset(['thing', 'other'])
+        assert app.middlewares[0] == app.profiler.profile_middleware
+
+    def test_compress(self):
+        """Compression middleware wraps all but profiling, if configured."""
+        app = self.get_app({'app.compress': 'true', 'compress.min_size': '1'})
+
+        assert app.middlewares[0] == app.compressor.compress_middleware
+        assert self.get_app({}).compressor is None
+
+    def test_access_log(self):
+        """Access log middleware wraps compression, if configured."""
+        app = self.get_app({'app.access_log': 'true', 'app.compress': 'true'})
+
+        assert app.middlewares[:2] == [
+            log.access_log_middleware, app.compressor.compress_middleware]
+
+    def test_assets(self, tmpdir):
+        """Assets are served ahead of the app, and resolved in templates."""
+        tmpdir.join('source', 'site.css').write('body {}', ensure=True)
+        assets.build(str(tmpdir.join('source')), str(tmpdir.join('build')))
+        app = self.get_app({'assets.dir': str(tmpdir.join('build'))})
+        url = app.assets.url('site.css')
+        resp = Client(app, Response).get(url)
+
+        assert resp.data == 'body {}'
+        assert 'Set-Cookie' not in resp.headers
+        assert app.tpl.jinja_env.globals['asset_url']('site.css') == url
+
+    def test_no_profiler(self):
+        """Profiling is off by default."""
+        assert self.get_app({}).profiler is None
+
+    def test_settings(self):
+        """Framework settings are parsed once into ``app.settings``."""
+        app = self.get_app({'app.url_cache_size': '10'})
+
+        assert app.settings['app.url_cache_size'] == 10
+        assert app.settings['session.expiry_minutes'] == 0
+
+    def test_invalid_settings(self):
+        """Invalid settings are rejected on startup."""
+        with pytest.raises(ValueError):
+            self.get_app({'session.expiry_minutes': 'never'})
+
+    def test_reload_config(self, tmpdir):
+        """Reloading config swaps in new config and settings."""
+        configfile = str(tmpdir.join('config.ini'))
+        with open(configfile, 'w') as f:
+            f.write("[session]\nexpiry_minutes = 5\n")
+        app = self.get_app({})
+        app.config.read_from_file(configfile)
+        with open(configfile, 'w') as f:
+            f.write("[session]\nexpiry_minutes = 10\n")
+        app.reload_config()
+
+        assert app.config['session.expiry_minutes'] == '10'
+        assert app.settings['session.expiry_minutes'] == 10
+
+    def test_reload_invalid_config(self, tmpdir):
+        """Invalid reloaded config is rejected and the old config kept."""
+        configfile = str(tmpdir.join('config.ini'))
+        with open(configfile, 'w') as f:
+            f.write("[session]\nexpiry_minutes = 5\n")
+        config = Config({'app.secret_key': 'secret'})
+        app = GurtelApp(config.read_from_file(configfile), TESTAPP_BASE_DIR)
+        with open(configfile, 'w') as f:
+            f.write("[session]\nexpiry_minutes = never\n")
+
+        with pytest.raises(ValueError):
+            app.reload_config()
+        assert app.settings['session.expiry_minutes'] == 5
+
+    def test_config_watcher(self, tmpdir):
+        """Config files are watched if ``app.config_reload`` is set."""
+        configfile = str(tmpdir.join('config.ini'))
+        with open(configfile, 'w') as f:
+            f.write("[app]\nconfig_reload = true\n")
+        config = Config({'app.secret_key': 'secret'})
+        app = GurtelApp(config.read_from_file(configfile), TESTAPP_BASE_DIR)
+        app.config_watcher.stop()
+
+        assert app.config_watcher.paths == [configfile]
+        assert app.config_watcher.callback == app.reload_config
+
+    def test_close(self, tmpdir):
+        """Closing the app stops its config watcher."""
+        configfile = str(tmpdir.join('config.ini'))
+        with open(configfile, 'w') as f:
+            f.write("[app]\nconfig_reload = true\n")
+        config = Config({'app.secret_key': 'secret'})
+        app = GurtelApp(config.read_from_file(configfile), TESTAPP_BASE_DIR)
+        app.close()
+
+        assert not app.config_watcher._thread.is_alive()
+
     def get_app(self, config_dict):
         """Shortcut for creating app with given config data."""
         config_dict.setdefault('app.secret_key', 'secret')
@@ -99,6 +246,14 @@ class TestGurtelApp(object):
         """Turns relative url into absolute by prepending base_url."""
         assert app.make_absolute_url('/foo/') == 'http://somehost/foo/'
 
+    @pytest.mark.config({'app.base_url': 'http://somehost'})
+    def test_make_absolute_url_cached(self, app):
+        """Absolute URLs are cached."""
+        app.make_absolute_url('/foo/')
+
+        assert app.make_absolute_url('/foo/') == 'http://somehost/foo/'
+        assert app._absolute_urls.stats()['hits'] == 1
+
     @pytest.mark.config({'app.base_url': 'http://somehost'})
     def test_redirect_to(self, app):
         """Given relative URL, returns redirect response to absolute URL."""
@@ -146,8 +301,213 @@ class TestGurtelApp(object):
 
         assert resp.data == 'thing id: 3'
 
+    @pytest.mark.config({'app.conditional_get': 'true'})
+    def test_conditional_get(self, client, app):
+        """Conditional GET support can be enabled."""
+        url = app.url_for('thing', thing_id=3)
+        etag = client.get(url).headers['ETag']
+        resp = client.get(url, headers={'If-None-Match': etag})
+
+        assert resp.status_code == 304
+        assert resp.data == ''
+
+    @pytest.mark.config({'app.conditional_get': 'true'})
+    def test_conditional_get_head_not_rendered(self, client, app):
+        """HEAD requests to ``conditional`` handlers don't render templates."""
+        messages = Messages()
+
+        @conditional.conditional(etag=lambda request, thing_id: 'abc')
+        def handler(request, thing_id):
+            return request.app.tpl.render(
+                request, 'flash.html', {'flash': messages})
+
+        app.dispatcher.handler_map['thing'] = handler
+        resp = client.head(app.url_for('thing', thing_id=3))
+
+        assert resp.status_code == 200
+        assert resp.data == ''
+        assert 'Content-Length' not in resp.headers
+        assert resp.headers['ETag'] == '"abc"'
+        assert messages.iterated is False
+
+    @pytest.mark.config({'app.conditional_get': 'true'})
+    def test_conditional_get_head_headers(self, client, app):
+        """HEAD requests get the same headers as GET."""
+        def handler(request, thing_id):
+            return request.app.tpl.render(request, 'flash.html')
+
+        app.dispatcher.handler_map['thing'] = handler
+        url = app.url_for('thing', thing_id=3)
+        get, head = client.get(url), client.head(url)
+
+        assert sorted(head.headers.keys()) == sorted(get.headers.keys())
+        assert head.headers['ETag'] == get.headers['ETag']
+        assert head.data == ''
+
+    def test_head(self, client, app):
+        """HEAD requests get headers but no body."""
+        resp = client.head(app.url_for('thing', thing_id=3))
+
+        assert resp.status_code == 200
+        assert resp.data == ''
+
+    def test_warmup(self, app):
+        """Warmup compiles templates and middleware chains."""
+        timings = app.warmup()
+
+        assert set(timings) == set(['templates', 'dispatch', 'total'])
+        assert app.tpl.cache_stats()['compiles'] == len(
+            app.tpl.jinja_env.list_templates())
+        assert None in app._chains
+
+    def test_lazy_imports(self):
+        """Rarely used modules aren't imported with the app module."""
+        # Without pytest-cov's subprocess coverage, which imports sqlite3.
+        env = dict(
+            (k, v) for k, v in os.environ.items()
+            if not k.startswith('COV_CORE_'))
+        output = subprocess.check_output([
+            sys.executable,
+            '-c',
+            'import sys, gurtel.app; '
+            'print sorted(m for m in ["werkzeug.debug", "cProfile", "ctypes",'
+            ' "sqlite3", "gurtel.session_store", "gurtel.conditional"]'
+            ' if m in sys.modules)',
+            ], env=env)
+
+        assert output.strip() == '[]'
+
     def test_404(self, client):
         """Unknown URL returns 404 status."""
         resp = client.get('/foo/')
 
         assert resp.status_code == 404
+
+    def test_skip_middleware(self, client, app, map_dispatcher):
+        """Handlers can opt out of middlewares."""
+        @middleware.skip_middleware('session')
+        def health(request):
+            return Response(str(hasattr(request, 'session')))
+
+        map_dispatcher.url_map.add(Rule('/health/', endpoint='health'))
+        map_dispatcher.handler_map['health'] = health
+
+        assert client.get('/health/').data == 'False'
+        assert client.get(
+            app.url_for('thing', thing_id=3)).data == 'thing id: 3'
+        assert len(app._chains) == 2
+
+    def test_minimal_dispatcher(self):
+        """Dispatchers need only ``dispatch`` (and ``url_for``)."""
+        class Dispatcher(object):
+            def dispatch(self, request):
+                return Response('minimal')
+
+            def url_for(self, *args, **kwargs):
+                return '/'
+
+        app = GurtelApp(
+            Config({'app.secret_key': 'secret'}),
+            TESTAPP_BASE_DIR,
+            Dispatcher(),
+            )
+
+        assert Client(app, Response).get('/').data == 'minimal'
+        assert app.warmup()['total'] >= 0
+
+    @pytest.mark.parametrize('enabled', ['false', 'true'])
+    def test_skip_unnamed_middleware(self, map_dispatcher, enabled):
+        """Unnamed middlewares can be skipped, with or without metrics."""
+        def tagging(tag, request, response_callable):
+            response = response_callable(request)
+            response.headers.add('X-Tag', tag)
+            return response
+
+        skipped = partial(tagging, 'skipped')
+
+        @middleware.skip_middleware(skipped)
+        def health(request):
+            return Response('ok')
+
+        map_dispatcher.url_map.add(Rule('/health/', endpoint='health'))
+        map_dispatcher.handler_map['health'] = health
+        app = GurtelApp(
+            Config({'app.secret_key': 'secret', 'app.metrics': enabled}),
+            TESTAPP_BASE_DIR,
+            map_dispatcher,
+            middlewares=[skipped, partial(tagging, 'kept')],
+            )
+        client = Client(app, Response)
+
+        assert client.get('/health/').headers.getlist('X-Tag') == ['kept']
+        assert client.get(app.url_for('thing', thing_id=3)).headers.getlist(
+            'X-Tag') == ['kept', 'skipped']
+
+    @pytest.mark.config({'app.metrics': 'true'})
+    def test_metrics(self, client, app):
+        """Request metrics can be enabled; stages aren't timed by default."""
+        client.get(app.url_for('thing', thing_id=3))
+        client.get('/foo/')
+        app.metrics.merge()
+
+        assert app.metrics.requests['thing'].count == 1
+        assert app.metrics.responses == {
+            ('thing', 200): 1, ('<unmatched>', 404): 1}
+        assert app.metrics.stages == {}
+
+    @pytest.mark.config(
+        {'app.metrics': 'true', 'app.metrics_stages': 'true'})
+    def test_metrics_stages(self, client, app):
+        """Request stages can be timed too."""
+        client.get(app.url_for('thing', thing_id=3))
+        app.metrics.merge()
+
+        assert app.metrics.requests['thing'].count == 1
+        for stage in ['request', 'dispatch', 'handler',
+                      'middleware.session_middleware']:
+            assert app.metrics.stages[stage].count >= 1
+
+    @pytest.mark.config({'app.metrics': 'true'})
+    def test_metrics_error(self, client, app):
+        """Requests raising unhandled exceptions are recorded as 500s."""
+        def broken(request, thing_id):
+            raise ValueError()
+
+        app.dispatcher.handler_map['thing'] = broken
+        with pytest.raises(ValueError):
+            client.get(app.url_for('thing', thing_id=3))
+        app.metrics.merge()
+
+        assert app.metrics.responses == {('thing', 500): 1}
+
+    def test_metrics_unnamed_middlewares(self, map_dispatcher):
+        """Partials and callable objects can be instrumented middlewares."""
+        def tagging(tag, request, response_callable):
+            response = response_callable(request)
+            response.headers.add('X-Tag', tag)
+            return response
+
+        class Tagging(object):
+            def __call__(self, request, response_callable):
+                return tagging('object', request, response_callable)
+
+        app = GurtelApp(
+            Config({
+                'app.secret_key': 'secret',
+                'app.metrics': 'true',
+                'app.metrics_stages': 'true',
+                }),
+            TESTAPP_BASE_DIR,
+            map_dispatcher,
+            middlewares=[partial(tagging, 'partial'), Tagging()],
+            )
+        resp = Client(app, Response).get(app.url_for('thing', thing_id=3))
+        app.metrics.merge()
+
+        assert resp.headers.getlist('X-Tag') == ['object', 'partial']
+        assert 'middleware.partial' in app.metrics.stages
+        assert 'middleware.Tagging' in app.metrics.stages
+
+    def test_no_metrics(self, app):
+        """Request metrics are disabled by default."""
+        assert app.metrics is None
@@ -0,0 +1,193 @@
+import gzip
+import json
+import os
+from StringIO import StringIO
+
+import pytest
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import Response
+
+from gurtel import assets
+
+
+CSS = 'body { color: red; }\n' * 50
+
+
+def write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(contents)
+
+
+@pytest.fixture
+def built(tmpdir):
+    """Build a few assets; return the build directory."""
+    source_dir = str(tmpdir.join('source'))
+    build_dir = str(tmpdir.join('build'))
+    write(os.path.join(source_dir, 'css', 'site.css'), CSS)
+    write(os.path.join(source_dir, 'small.js'), 'var a;')
+    write(os.path.join(source_dir, 'logo.png'), '\x89PNG' * 100)
+    assets.build(source_dir, build_dir)
+    return build_dir
+
+
+@pytest.fixture
+def handler(built):
+    return assets.AssetHandler(built)
+
+
+@pytest.fixture
+def client(handler):
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return ['app']
+
+    return Client(handler.wrap(app), Response)
+
+
+class TestBuild(object):
+    def test_manifest(self, built):
+        """Assets are copied to fingerprinted names listed in a manifest."""
+        with open(os.path.join(built, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        assert sorted(manifest) == ['css/site.css', 'logo.png', 'small.js']
+        assert manifest['css/site.css'].startswith('css/site.')
+        assert manifest['css/site.css'].endswith('.css')
+        with open(os.path.join(built, manifest['css/site.css'])) as f:
+            assert f.read() == CSS
+
+    def test_gzip(self, built):
+        """Large enough text assets get a smaller gzipped variant."""
+        with open(os.path.join(built, 'manifest.json')) as f:
+            manifest = json.load(f)
+        path = os.path.join(built, manifest['css/site.css'])
+
+        assert gzip.open(path + '.gz').read() == CSS
+        for name in ['small.js', 'logo.png']:
+            assert not os.path.exists(
+                os.path.join(built, manifest[name]) + '.gz')
+
+    def test_fingerprint_changes(self, tmpdir):
+        """Changed files get new names; old versions are kept."""
+        source = str(tmpdir.join('source', 'a.css'))
+        build_dir = str(tmpdir.join('build'))
+        write(source, 'a')
+        first = assets.build(str(tmpdir.join('source')), build_dir)['a.css']
+        write(source, 'b')
+        second = assets.build(str(tmpdir.join('source')), build_dir)['a.css']
+
+        assert first != second
+        assert os.path.exists(os.path.join(build_dir, first))
+
+
+class TestAssetHandler(object):
+    def test_url(self, handler):
+        """URLs of assets are resolved from the manifest."""
+        url = handler.url('css/site.css')
+
+        assert url == '/static/' + handler.manifest['css/site.css']
+        with pytest.raises(assets.AssetNotFound):
+            handler.url('nope.css')
+
+    def test_serve(self, client, handler):
+        """Serves assets with far-future cache headers."""
+        resp = client.get(handler.url('css/site.css'))
+
+        assert resp.status_code == 200
+        assert resp.data == CSS
+        assert resp.mimetype == 'text/css'
+        assert resp.cache_control.max_age == assets.MAX_AGE
+        assert resp.headers['Content-Length'] == str(len(CSS))
+        assert 'Content-Encoding' not in resp.headers
+
+    def test_serve_gzip(self, client, handler):
+        """Serves the gzipped variant to clients that accept it."""
+        resp = client.get(
+            handler.url('css/site.css'),
+            headers={'Accept-Encoding': 'gzip, deflate'},
+            )
+
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert gzip.GzipFile(fileobj=StringIO(resp.data)).read() == CSS
+
+    def test_range(self, client, handler):
+        """Serves single byte ranges."""
+        resp = client.get(
+            handler.url('css/site.css'),
+            headers={'Range': 'bytes=5-9', 'Accept-Encoding': 'gzip'},
+            )
+
+        assert resp.status_code == 206
+        assert resp.data == CSS[5:10]
+        assert resp.headers['Content-Range'] == 'bytes 5-9/%d' % len(CSS)
+
+    def test_unsatisfiable_range(self, client, handler):
+        resp = client.get(
+            handler.url('small.js'), headers={'Range': 'bytes=100-200'})
+
+        assert resp.status_code == 416
+
+    def test_not_modified(self, client, handler):
+        """Answers a request with a matching ETag with a 304."""
+        url = handler.url('logo.png')
+        etag = client.get(url).headers['ETag']
+        resp = client.get(url, headers={'If-None-Match': etag})
+
+        assert resp.status_code == 304
+        assert resp.data == ''
+
+    def test_not_modified_gzip(self, client, handler):
+        """The gzipped variant's ETag also matches."""
+        url = handler.url('css/site.css')
+        etag = client.get(
+            url, headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        resp = client.get(url, headers={'If-None-Match': '"x", ' + etag})
+
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == etag
+
+    def test_etag_substring_modified(self, client, handler):
+        """An If-None-Match ETag containing the asset's name doesn't match."""
+        url = handler.url('logo.png')
+        etag = client.get(url).headers['ETag']
+        resp = client.get(url, headers={'If-None-Match': etag[:-1] + 'x"'})
+
+        assert resp.status_code == 200
+
+    def test_head(self, client, handler):
+        resp = client.head(handler.url('logo.png'))
+
+        assert resp.status_code == 200
+        assert resp.headers['Content-Length'] == '400'
+        assert resp.data == ''
+
+    def test_not_found(self, client):
+        """Unknown files under the prefix are 404s."""
+        assert client.get('/static/small.js').status_code == 404
+        assert client.get('/static/../manifest.json').status_code == 404
+
+    def test_other_paths(self, client):
+        """Requests not under the prefix go to the wrapped app."""
+        assert client.get('/page/').data == 'app'
+
+    def test_file_wrapper(self, handler):
+        """Uses the server's ``wsgi.file_wrapper``, if any."""
+        environ = EnvironBuilder(handler.url('logo.png')).get_environ()
+        environ['wsgi.file_wrapper'] = lambda f, block_size: ('wrapped', f)
+        body = handler(environ, lambda status, headers: None)
+
+        assert body[0] == 'wrapped'
+        body[1].close()
+
+
+def test_handler_from_config(built):
+    """Assets are served if a build directory is configured."""
+    handler = assets.handler_from_config(
+        {'assets.dir': built, 'assets.url_prefix': '/assets'})
+
+    assert handler.url('small.js').startswith('/assets/small.')
+    assert assets.handler_from_config(
+        {'assets.dir': None, 'assets.url_prefix': '/static/'}) is None
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from gurtel import bench
+
+
+def test_measure():
+    """Returns time per call."""
+    calls = []
+    seconds = bench.measure(lambda: calls.append(1), min_time=0.001)
+
+    assert 0 < seconds < 0.001
+    assert calls
+
+
+def test_load_missing_baseline(tmpdir):
+    """Missing baseline file is an empty baseline."""
+    assert bench.load_baseline(str(tmpdir.join('baseline.json'))) == {}
+
+
+class TestBenchmarkSession(object):
+    def make_session(self, tmpdir, baseline=None, **kwargs):
+        path = str(tmpdir.join('baseline.json'))
+        if baseline is not None:
+            bench.save_baseline(path, baseline)
+        kwargs.setdefault('min_time', 0.001)
+        return bench.BenchmarkSession(path, **kwargs)
+
+    def test_no_baseline(self, tmpdir):
+        """Without a baseline, results are only recorded."""
+        session = self.make_session(tmpdir)
+        session('noop', lambda: None)
+
+        assert session.results.keys() == ['noop']
+        assert session.missing() == ['noop']
+        assert session.report()[0].endswith(' no baseline')
+
+    def test_missing(self, tmpdir):
+        """Lists only results that have no baseline."""
+        session = self.make_session(tmpdir, {'noop': 1.0})
+        session('noop', lambda: None)
+        session('other', lambda: None)
+
+        assert session.missing() == ['other']
+
+    def test_regression(self, tmpdir):
+        """Fails if slower than baseline by more than the threshold."""
+        session = self.make_session(tmpdir, {'noop': 1e-12}, threshold=0.5)
+
+        with pytest.raises(bench.BenchmarkRegression):
+            session('noop', lambda: None)
+
+    def test_within_threshold(self, tmpdir):
+        """Passes if not slower than baseline by more than the threshold."""
+        session = self.make_session(tmpdir, {'noop': 1.0})
+        session('noop', lambda: None)
+
+        assert '%' in session.report()[0]
+
+    def test_save(self, tmpdir):
+        """Saving merges results into the baseline file."""
+        session = self.make_session(
+            tmpdir, {'noop': 1e-12, 'other': 1.0}, save=True)
+        session('noop', lambda: None)
+        session.finish()
+
+        baseline = json.loads(tmpdir.join('baseline.json').read())
+        assert baseline['other'] == 1.0
+        assert baseline['noop'] == session.results['noop']
@@ -0,0 +1,97 @@
+from gurtel.cache import FileSystemCache, LRUCache, MemoryCache
+
+
+def test_get_set():
+    c = LRUCache()
+    c.set('a', 1)
+
+    assert c.get('a') == 1
+    assert c.get('b') is None
+    assert c.get('b', 2) == 2
+
+
+def test_hits_and_misses():
+    c = LRUCache()
+    c.set('a', 1)
+    c.get('a')
+    c.get('b')
+
+    assert c.stats() == {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 1024}
+
+
+def test_evicts_least_recently_used():
+    c = LRUCache(2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+
+    assert 'a' in c
+    assert 'b' not in c
+    assert 'c' in c
+
+
+def test_unbounded():
+    c = LRUCache(None)
+    for i in range(2000):
+        c.set(i, i)
+
+    assert len(c) == 2000
+
+
+def test_delete_and_clear():
+    c = LRUCache()
+    c.set('a', 1)
+    c.set('b', 2)
+    c.delete('a')
+    c.delete('missing')
+
+    assert 'a' not in c
+    c.clear()
+    assert len(c) == 0
+
+
+class TestMemoryCache(object):
+    def test_expiry(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr('time.time', lambda: now[0])
+        c = MemoryCache(default_timeout=10)
+        c.set('a', 1)
+        c.set('b', 2, timeout=0)
+        now[0] += 11
+
+        assert c.get('a') is None
+        assert c.get('b') == 2
+
+    def test_add(self):
+        c = MemoryCache()
+
+        assert c.add('a', 1)
+        assert not c.add('a', 2)
+        assert c.get('a') == 1
+
+    def test_bounded(self):
+        c = MemoryCache(maxsize=1)
+        c.set('a', 1)
+        c.set('b', 2)
+
+        assert c.get('a') is None
+
+
+class TestFileSystemCache(object):
+    def test_add(self, tmpdir):
+        """``add`` only adds if key not present, atomically."""
+        c = FileSystemCache(str(tmpdir))
+
+        assert c.add('a', 1)
+        assert not c.add('a', 2)
+        assert c.get('a') == 1
+        assert len(tmpdir.listdir()) == 1
+
+    def test_add_expired(self, tmpdir):
+        """Can add over an expired value."""
+        c = FileSystemCache(str(tmpdir))
+        c.set('a', 1, timeout=-1)
+
+        assert c.add('a', 2)
+        assert c.get('a') == 2
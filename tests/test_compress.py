@@ -0,0 +1,191 @@
+import gzip
+from StringIO import StringIO
+import zlib
+
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from gurtel import compress, conditional
+
+
+BODY = 'Hello, world! ' * 100
+
+
+def make_request(accept='gzip', **headers):
+    if accept is not None:
+        headers['Accept-Encoding'] = accept
+    return Request(EnvironBuilder('/', headers=headers).get_environ())
+
+
+def handler(request):
+    return Response(BODY, mimetype='text/html')
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+@pytest.fixture
+def compressor():
+    c = compress.Compressor()
+    # Brotli is preferred if installed; most tests use gzip.
+    c.encodings = ['gzip', 'deflate']
+    return c
+
+
+def test_gzip(compressor):
+    """Compresses responses with an accepted encoding."""
+    resp = compressor.compress_middleware(make_request(), handler)
+
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert resp.headers['Content-Length'] == str(len(resp.data))
+    assert gunzip(resp.data) == BODY
+
+
+def test_deflate(compressor):
+    resp = compressor.compress_middleware(
+        make_request('deflate;q=1.0, gzip;q=0.5'), handler)
+
+    assert resp.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(resp.data) == BODY
+
+
+def test_brotli():
+    """Brotli is preferred, if installed."""
+    brotli = pytest.importorskip('brotli')
+    resp = compress.Compressor().compress_middleware(
+        make_request('gzip, deflate, br'), handler)
+
+    assert resp.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(resp.data) == BODY
+
+
+@pytest.mark.parametrize('accept', [None, 'identity', 'compress'])
+def test_not_accepted(compressor, accept):
+    """Responses aren't compressed for clients that don't accept it."""
+    resp = compressor.compress_middleware(make_request(accept), handler)
+
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == BODY
+
+
+@pytest.mark.parametrize('response', [
+    Response('tiny', mimetype='text/html'),
+    Response(BODY, mimetype='image/png'),
+    Response(BODY, mimetype='text/html', headers={'Content-Encoding': 'br'}),
+    Response(BODY, status=404, mimetype='text/html'),
+    ])
+def test_not_compressed(compressor, response):
+    """Small bodies, binary types and encoded responses are left alone."""
+    resp = compressor.compress_middleware(make_request(), lambda r: response)
+
+    assert resp.headers.get('Content-Encoding') == response.headers.get(
+        'Content-Encoding')
+    assert resp.data == BODY or resp.data == 'tiny'
+
+
+def test_streamed(compressor):
+    """Streamed responses are compressed incrementally."""
+    closed = []
+
+    def generate():
+        try:
+            yield u'Hello, '
+            yield u'w\xf6rld!'
+        finally:
+            closed.append(True)
+
+    resp = compressor.compress_middleware(
+        make_request(), lambda r: Response(generate(), mimetype='text/html'))
+    chunks = list(resp.iter_encoded())
+
+    assert 'Content-Length' not in resp.headers
+    # Each chunk is flushed, so can be decompressed as it arrives.
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert d.decompress(chunks[0]) == 'Hello, '
+    assert gunzip(''.join(chunks)) == u'Hello, w\xf6rld!'.encode('utf-8')
+    assert closed == [True]
+
+
+def test_cache(compressor, monkeypatch):
+    """Bodies of responses with strong ETags are compressed once."""
+    def tagged(request):
+        resp = handler(request)
+        resp.add_etag()
+        return resp
+
+    first = compressor.compress_middleware(make_request(), tagged)
+    monkeypatch.setattr(compress, 'compress', pytest.fail)
+    second = compressor.compress_middleware(make_request(), tagged)
+
+    assert second.data == first.data
+    assert compressor.cache.stats()['hits'] == 1
+
+
+def test_cache_same_etag_other_body(compressor):
+    """Bodies sharing a declared ETag aren't mixed up."""
+    def tagged(request):
+        resp = Response(request.args['user'] * 100, mimetype='text/html')
+        resp.set_etag(conditional.etag_for('page', 1))
+        return resp
+
+    def get(user):
+        request = Request(EnvironBuilder(
+            '/', query_string={'user': user},
+            headers={'Accept-Encoding': 'gzip'}).get_environ())
+        return gunzip(compressor.compress_middleware(request, tagged).data)
+
+    assert get('alice') == 'alice' * 100
+    assert get('bobby') == 'bobby' * 100
+
+
+def test_no_cache_weak_etag(compressor):
+    def tagged(request):
+        resp = handler(request)
+        resp.set_etag('abc', weak=True)
+        return resp
+
+    compressor.compress_middleware(make_request(), tagged)
+
+    assert compressor.cache.stats()['size'] == 0
+
+
+def test_conditional(compressor):
+    """ETags of compressed responses get the encoding, and still match."""
+    def conditional_handler(request):
+        return conditional.conditional_middleware(request, handler)
+
+    resp = compressor.compress_middleware(make_request(), conditional_handler)
+    etag = resp.headers['ETag']
+    resp = compressor.compress_middleware(
+        make_request(If_None_Match=etag), conditional_handler)
+
+    assert etag.endswith('-gzip"')
+    assert resp.status_code == 304
+    assert resp.headers['ETag'] == etag
+
+
+@pytest.mark.parametrize('size,level', [
+    (100, 9),
+    (100 * 1024, 6),
+    (1024 * 1024, 4),
+    (None, 6),
+    ])
+def test_level_for_size(size, level):
+    """Large bodies are compressed faster."""
+    assert compress.level_for_size('gzip', size) == level
+
+
+def test_compressor_from_config():
+    compressor = compress.compressor_from_config({
+        'app.compress': True,
+        'compress.min_size': 100,
+        'compress.cache_size': 0,
+        'compress.cache_max_size': 1000,
+        })
+
+    assert compressor.min_size == 100
+    assert compressor.cache is None
+    assert compress.compressor_from_config({'app.compress': False}) is None
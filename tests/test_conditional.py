@@ -0,0 +1,138 @@
+import datetime
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from gurtel import conditional
+
+
+def make_request(method='GET', **headers):
+    return Request(
+        EnvironBuilder(method=method, headers=headers).get_environ())
+
+
+def test_etag_for():
+    """ETag is stable for the same version keys."""
+    assert conditional.etag_for('page', 3) == conditional.etag_for('page', 3)
+    assert conditional.etag_for('page', 3) != conditional.etag_for('page', 4)
+
+
+class TestConditionalDecorator(object):
+    def make_handler(self, **kwargs):
+        calls = []
+
+        @conditional.conditional(**kwargs)
+        def handler(request, page_id):
+            calls.append(page_id)
+            return Response('page %s' % page_id)
+
+        handler.calls = calls
+        return handler
+
+    def test_sets_etag(self):
+        """Sets ETag computed before calling handler on the response."""
+        handler = self.make_handler(
+            etag=lambda req, page_id: conditional.etag_for(page_id))
+        response = handler(make_request(), page_id=3)
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] == '"%s"' % (
+            conditional.etag_for(3))
+
+    def test_not_modified_etag(self):
+        """Matching If-None-Match gets a 304 without calling handler."""
+        handler = self.make_handler(
+            etag=lambda req, page_id: conditional.etag_for(page_id),
+            weak=True,
+            )
+        request = make_request(
+            If_None_Match='W/"%s"' % conditional.etag_for(3))
+        response = handler(request, page_id=3)
+
+        assert response.status_code == 304
+        assert response.data == ''
+        assert handler.calls == []
+
+    def test_not_modified_since(self):
+        """Satisfied If-Modified-Since gets a 304 without calling handler."""
+        handler = self.make_handler(
+            last_modified=lambda req, page_id: datetime.datetime(2014, 1, 1))
+        request = make_request(
+            If_Modified_Since='Wed, 01 Jan 2014 00:00:00 GMT')
+        response = handler(request, page_id=3)
+
+        assert response.status_code == 304
+        assert 'Last-Modified' in response.headers
+        assert handler.calls == []
+
+    def test_modified(self):
+        """Non-matching ETag gets a full response."""
+        handler = self.make_handler(
+            etag=lambda req, page_id: conditional.etag_for(page_id))
+        response = handler(make_request(If_None_Match='"other"'), page_id=3)
+
+        assert response.status_code == 200
+        assert handler.calls == [3]
+
+    def test_post(self):
+        """Non-GET/HEAD requests aren't conditional."""
+        etags = []
+        handler = self.make_handler(
+            etag=lambda req, page_id: etags.append(page_id))
+        response = handler(make_request('POST'), page_id=3)
+
+        assert response.status_code == 200
+        assert etags == []
+
+
+class TestConditionalMiddleware(object):
+    def test_adds_etag(self):
+        """Adds ETag to GET responses."""
+        response = conditional.conditional_middleware(
+            make_request(), lambda req: Response('hello'))
+
+        assert response.status_code == 200
+        assert 'ETag' in response.headers
+
+    def test_not_modified(self):
+        """Answers matching If-None-Match with 304."""
+        etag = Response('hello')
+        etag.add_etag()
+        request = make_request(If_None_Match=etag.headers['ETag'])
+        response = conditional.conditional_middleware(
+            request, lambda req: Response('hello'))
+
+        assert response.status_code == 304
+
+    def test_streamed_no_etag(self):
+        """Doesn't buffer streamed responses to compute an ETag."""
+        body = iter(['hello'])
+        response = conditional.conditional_middleware(
+            make_request(), lambda req: Response(body))
+
+        assert 'ETag' not in response.headers
+        assert 'Content-Length' not in response.headers
+        assert list(body) == ['hello']
+
+    def test_streamed_not_modified(self):
+        """Streamed responses are compared by the ETag they have."""
+        body = iter(['hello'])
+        request = make_request(If_None_Match='"abc"')
+        response = conditional.conditional_middleware(
+            request, lambda req: Response(body, headers={'ETag': '"abc"'}))
+
+        assert response.status_code == 304
+        assert response.headers['ETag'] == '"abc"'
+        assert list(body) == ['hello']
+
+    def test_non_get_untouched(self):
+        response = conditional.conditional_middleware(
+            make_request('POST'), lambda req: Response('hello'))
+
+        assert 'ETag' not in response.headers
+
+    def test_error_untouched(self):
+        response = conditional.conditional_middleware(
+            make_request(), lambda req: Response('gone', status=410))
+
+        assert 'ETag' not in response.headers
@@ -2,6 +2,7 @@ import os
 
 import pytest
 
+from gurtel import config
 from gurtel.config import Config
 
 
@@ -160,3 +161,119 @@ def test_getpath_default():
     c = Config()
 
     assert c.getpath('app.logging', None) is None
+
+
+def test_getint():
+    c = Config({'app.size': '12'})
+
+    assert c.getint('app.size') == 12
+    assert c.getint('app.other', None) is None
+
+
+def test_getint_bad():
+    c = Config({'app.size': 'big'})
+
+    with pytest.raises(ValueError):
+        c.getint('app.size')
+
+
+def test_getfloat():
+    c = Config({'app.ratio': '0.5'})
+
+    assert c.getfloat('app.ratio') == 0.5
+
+
+def test_getlist():
+    c = Config({'app.hosts': 'a.com, b.com,\nc.com,'})
+
+    assert c.getlist('app.hosts') == ['a.com', 'b.com', 'c.com']
+
+
+class TestSnapshot(object):
+    schema = {
+        'app.debug': ('bool', False),
+        'app.size': ('int', 10),
+        'app.name': 'str',
+        }
+
+    def test_typed(self):
+        """Values are parsed to their declared types."""
+        c = Config({'app.debug': 'yes', 'app.size': '3', 'app.name': 'x'})
+        s = c.snapshot(self.schema)
+
+        assert s == {'app.debug': True, 'app.size': 3, 'app.name': 'x'}
+
+    def test_defaults(self):
+        """Missing keys take their defaults."""
+        s = Config({'app.name': 'x'}).snapshot(self.schema)
+
+        assert s['app.debug'] is False
+        assert s['app.size'] == 10
+
+    def test_required(self):
+        """Missing keys without defaults raise ``KeyError``."""
+        with pytest.raises(KeyError):
+            Config().snapshot(self.schema)
+
+    def test_invalid(self):
+        """Badly typed values raise ``ValueError`` up front."""
+        c = Config({'app.name': 'x', 'app.size': 'lots'})
+
+        with pytest.raises(ValueError):
+            c.snapshot(self.schema)
+
+    def test_immutable(self):
+        """Snapshots can't be modified."""
+        s = Config({'app.name': 'x'}).snapshot(self.schema)
+
+        with pytest.raises(TypeError):
+            s['app.name'] = 'y'
+        with pytest.raises(TypeError):
+            s.update({'app.name': 'y'})
+
+    def test_not_affected_by_config_changes(self):
+        """Snapshot keeps the values as of its creation."""
+        c = Config({'app.name': 'x'})
+        s = c.snapshot(self.schema)
+        c.update({'app.name': 'y'})
+
+        assert s['app.name'] == 'x'
+
+
+@pytest.mark.configfile_contents("[database]\nuri = sqlite:///")
+def test_parsed_file_cached(configfile, monkeypatch):
+    """Unchanged config files aren't reparsed."""
+    Config().read_from_file(configfile)
+    monkeypatch.setattr(config, 'RawConfigParser', None)
+    c = Config().read_from_file(configfile)
+
+    assert c.data == {'database.uri': 'sqlite:///'}
+
+
+@pytest.mark.configfile_contents("[database]\nuri = sqlite:///")
+def test_parsed_file_cache_invalidated(configfile):
+    """Changed config files are reparsed."""
+    Config().read_from_file(configfile)
+    with open(configfile, 'w') as f:
+        f.write("[database]\nuri = postgres:///db\n")
+    c = Config().read_from_file(configfile)
+
+    assert c.data == {'database.uri': 'postgres:///db'}
+
+
+@pytest.mark.configfile_contents("[database]\nuri = sqlite:///\nuser = me")
+def test_reloaded(configfile):
+    """Reloaded config has current file values, and non-file values."""
+    c = Config().read_from_file(configfile)
+    c.update({'database.uri': 'sqlite:///override', 'app.debug': 'true'})
+    with open(configfile, 'w') as f:
+        f.write("[database]\nuri = postgres:///db\npassword = pw\n")
+    d = c.reloaded()
+
+    assert d.data == {
+        'database.uri': 'sqlite:///override',
+        'database.password': 'pw',
+        'app.debug': 'true',
+        }
+    assert d.files == [configfile]
+    assert c.data['database.user'] == 'me'
@@ -1,10 +1,11 @@
 from werkzeug.exceptions import NotFound
-from werkzeug.routing import BuildError
+from werkzeug.routing import BuildError, Rule
 from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
 
 import pytest
 
-from gurtel import dispatch
+from gurtel import dispatch, metrics
 
 
 class TestNullDispatcher(object):
@@ -36,3 +37,149 @@ class TestMapDispatcher(object):
         request = EnvironBuilder('/no/handler/').get_environ()
         with pytest.raises(NotFound):
             map_dispatcher.dispatch(request)
+
+    def test_dispatch_timed(self, map_dispatcher):
+        """Records endpoint and dispatch/handler times of timed requests."""
+        request = Request(EnvironBuilder('/thing/2/').get_environ())
+        request.timings = metrics.RequestTimings()
+        map_dispatcher.dispatch(request)
+
+        assert request.timings.endpoint == 'thing'
+        assert [stage for stage, t in request.timings.stages] == [
+            'dispatch', 'handler']
+
+    def test_dispatch_timed_no_stages(self, map_dispatcher):
+        """Only the endpoint is recorded if stages aren't being timed."""
+        request = Request(EnvironBuilder('/thing/2/').get_environ())
+        request.timings = metrics.RequestTimings(stages=False)
+        map_dispatcher.dispatch(request)
+
+        assert request.timings.endpoint == 'thing'
+        assert request.timings.stages is None
+
+    def test_handler_for(self, map_dispatcher):
+        """Returns the handler for a request, or None if there isn't one."""
+        assert map_dispatcher.handler_for(
+            EnvironBuilder('/thing/2/').get_environ()) is not None
+        assert map_dispatcher.handler_for(
+            EnvironBuilder('/no/handler/').get_environ()) is None
+        assert map_dispatcher.handler_for(
+            EnvironBuilder('/nope/').get_environ()) is None
+
+    def test_dotted_path_handler(self, map_dispatcher):
+        """Handlers can be given as dotted paths, imported on first use."""
+        map_dispatcher.handler_map['thing'] = 'tests.conftest.handle_thing'
+        response = map_dispatcher.dispatch(
+            EnvironBuilder('/thing/2/').get_environ())
+
+        assert response.data == 'thing id: 2'
+        assert callable(map_dispatcher.handler_map['thing'])
+
+    def test_warmup(self, map_dispatcher):
+        """Warmup imports handlers and binds a build adapter."""
+        map_dispatcher.handler_map['thing'] = 'tests.conftest.handle_thing'
+        map_dispatcher.warmup('example.com')
+
+        assert callable(map_dispatcher.handler_map['thing'])
+        assert 'example.com' in map_dispatcher._build_adapters
+        assert not map_dispatcher.url_map._remap
+
+    def test_dispatch_caches_match(self, map_dispatcher):
+        """Repeated dispatch of the same path is served from match cache."""
+        for i in range(3):
+            request = EnvironBuilder('/thing/2/').get_environ()
+            response = map_dispatcher.dispatch(request)
+            assert response.data == 'thing id: 2'
+
+        stats = map_dispatcher.cache_stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 2
+        assert stats['adapters'] == 1
+
+    def test_adapters_bounded(self, map_dispatcher):
+        """Adapters for client-given hosts are kept in a bounded cache."""
+        d = dispatch.MapDispatcher(
+            map_dispatcher.url_map,
+            map_dispatcher.handler_map,
+            adapter_cache_size=10,
+            )
+        for i in range(100):
+            d.dispatch(EnvironBuilder(
+                '/thing/2/', base_url='http://host%s/' % i).get_environ())
+
+        assert d.cache_stats()['adapters'] == 10
+
+    def test_match_cache_keyed_on_method(self, map_dispatcher):
+        """Same path with different methods are separate cache entries."""
+        for method in ['GET', 'POST']:
+            request = EnvironBuilder('/thing/2/', method=method).get_environ()
+            map_dispatcher.dispatch(request)
+
+        assert map_dispatcher.cache_stats()['size'] == 2
+
+    def test_not_found_not_cached(self, map_dispatcher):
+        """Failed matches are not cached."""
+        request = EnvironBuilder('/nope/').get_environ()
+        with pytest.raises(NotFound):
+            map_dispatcher.dispatch(request)
+
+        assert map_dispatcher.cache_stats()['size'] == 0
+
+    def test_cache_bounded(self, map_dispatcher):
+        """Match cache evicts least-recently-used entries."""
+        map_dispatcher.match_cache.maxsize = 2
+        for i in range(5):
+            request = EnvironBuilder('/thing/%s/' % i).get_environ()
+            map_dispatcher.dispatch(request)
+
+        assert map_dispatcher.cache_stats()['size'] == 2
+
+    def test_invalidated_when_map_changes(self, map_dispatcher):
+        """Adding a rule to the map drops cached matches."""
+        request = EnvironBuilder('/thing/2/').get_environ()
+        map_dispatcher.dispatch(request)
+        map_dispatcher.url_map.add(Rule('/other/', endpoint='other'))
+        map_dispatcher.handler_map['other'] = lambda req: 'other'
+
+        assert map_dispatcher.dispatch(
+            EnvironBuilder('/other/').get_environ()) == 'other'
+        assert map_dispatcher.cache_stats()['size'] == 1
+
+    def test_url_for_cached(self, map_dispatcher):
+        """Repeated builds of the same URL are served from build cache."""
+        for i in range(3):
+            assert map_dispatcher.url_for(
+                'loc', 'thing', thing_id=4) == '/thing/4/'
+        map_dispatcher.url_for('loc', 'thing', thing_id=5)
+
+        stats = map_dispatcher.build_cache_stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+
+    def test_url_for_unhashable_args(self, map_dispatcher):
+        """Unhashable URL arguments bypass the build cache."""
+        url = map_dispatcher.url_for('loc', 'thing', thing_id=4, q=['a'])
+
+        assert url == '/thing/4/?q=a'
+        assert map_dispatcher.build_cache_stats()['size'] == 0
+
+    def test_url_for_invalidated_when_map_changes(self, map_dispatcher):
+        """Adding a rule to the map drops cached URLs."""
+        map_dispatcher.url_for('loc', 'thing', thing_id=4)
+        map_dispatcher.url_map.add(
+            Rule('/new/<int:thing_id>/', endpoint='thing'))
+
+        map_dispatcher.url_for('loc', 'thing', thing_id=4)
+        assert map_dispatcher.build_cache_stats()['size'] == 1
+
+
+def test_build_cache_key_order_independent():
+    """Cache key doesn't depend on keyword argument order."""
+    assert dispatch.build_cache_key('e', {'a': 1, 'b': 2}) == (
+        dispatch.build_cache_key('e', {'b': 2, 'a': 1}))
+
+
+def test_build_cache_key_typed():
+    """Cache key distinguishes values that compare equal across types."""
+    assert dispatch.build_cache_key('e', {'a': 1}) != (
+        dispatch.build_cache_key('e', {'a': True}))
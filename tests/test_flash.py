@@ -7,11 +7,11 @@ from gurtel import flash
 
 def test_context_processor():
     """Context processor returns and clears flash messages."""
-    msgs = [{'message': 'foo'}]
-    req = stub(flash=flash.Flash(mdt(flash=msgs[:])))
+    req = stub(flash=flash.Flash(mdt(flash=[['info', 'foo']])))
     result = flash.context_processor(req)
     assert result.keys() == ['flash']
-    assert list(result['flash']) == msgs
+    assert list(result['flash']) == [
+        {'level': 'info', 'message': 'foo', 'count': 1}]
 
 
 def test_request_mixin():
@@ -22,6 +22,17 @@ def test_request_mixin():
     f = FakeRequest()
 
     assert f.flash.messages == []
+    assert not f.session.modified
+    assert 'flash' not in f.session
+
+
+def test_request_mixin_settings():
+    """Request mixin takes maximum message count from request settings."""
+    class FakeRequest(flash.FlashRequestMixin):
+        session = mdt()
+        settings = {'flash.max_messages': 5}
+
+    assert FakeRequest().flash.max_messages == 5
 
 
 @pytest.mark.parametrize('key_exists', [True, False])
@@ -32,19 +43,48 @@ def test_send(key_exists):
     f = flash.Flash(session)
     f.send('error', "Some error message")
 
-    assert session['flash'] == [
-        {'level': 'error', 'message': "Some error message"}]
+    assert session['flash'] == [['error', "Some error message"]]
     assert session.modified
 
 
+def test_send_fifo():
+    """Messages are queued oldest first."""
+    f = flash.Flash(mdt())
+    f.info("First")
+    f.error("Second")
+
+    assert [m['message'] for m in f.get_and_clear()] == ["First", "Second"]
+
+
+def test_send_coalesces_duplicates():
+    """Sending the same message again increments its count."""
+    session = mdt()
+    f = flash.Flash(session)
+    f.info("Saved")
+    f.info("Saved")
+    f.info("Saved")
+
+    assert session['flash'] == [['info', "Saved", 3]]
+    assert f.messages == [{'level': 'info', 'message': "Saved", 'count': 3}]
+
+
+def test_send_bounded():
+    """Oldest messages are dropped beyond ``max_messages``."""
+    session = mdt()
+    f = flash.Flash(session, max_messages=2)
+    for i in range(4):
+        f.info(str(i))
+
+    assert session['flash'] == [['info', '2'], ['info', '3']]
+
+
 def test_custom_key():
     """Can set a custom key in the session."""
     session = mdt()
     f = flash.Flash(session, 'messages')
     f.send('info', "Some info")
 
-    assert session['messages'] == [
-        {'level': 'info', 'message': "Some info"}]
+    assert session['messages'] == [['info', "Some info"]]
 
 
 @pytest.mark.parametrize('level', ['error', 'warning', 'info', 'success'])
@@ -54,21 +94,41 @@ def test_level_shortcuts(level):
     f = flash.Flash(session)
     getattr(f, level)("The message")
 
-    assert session['flash'] == [
-        {'level': level, 'message': "The message"}]
+    assert session['flash'] == [[level, "The message"]]
 
 
 def test_get_and_clear():
     """Gets and clears messages."""
-    f = flash.Flash(mdt(flash=[{'level': 'error', 'message': "Hello"}]))
+    f = flash.Flash(mdt(flash=[['error', "Hello"]]))
 
-    assert list(f.get_and_clear()) == [{'level': 'error', 'message': "Hello"}]
+    assert list(f.get_and_clear()) == [
+        {'level': 'error', 'message': "Hello", 'count': 1}]
     assert list(f.messages) == []
+    assert 'flash' not in f.session
     assert f.session.modified
 
 
+def test_get_and_clear_empty():
+    """Reading no messages doesn't modify the session."""
+    f = flash.Flash(mdt())
+
+    assert list(f.get_and_clear()) == []
+    assert not f.session.modified
+    assert 'flash' not in f.session
+
+
 def test_partial_get_and_clear():
     """Only clears messages that are actually iterated through."""
+    f = flash.Flash(mdt(flash=[['info', "Done!"], ['error', "Hello"]]))
+
+    iterator = f.get_and_clear()
+    assert iterator.next()['level'] == 'info'
+    assert len(f.messages) == 1
+    assert f.session.modified
+
+
+def test_legacy_format():
+    """Reads messages stored in the legacy (newest first) format."""
     f = flash.Flash(
         mdt(
             flash=[
@@ -77,8 +137,12 @@ def test_partial_get_and_clear():
             ]
         )
     )
+    f.info("Later")
 
-    iterator = f.get_and_clear()
-    assert iterator.next()['level'] == 'info'
-    assert len(f.messages) == 1
-    assert f.session.modified
+    assert [m['message'] for m in f.get_and_clear()] == [
+        "Done!", "Hello", "Later"]
+
+
+def test_context_processor_provides():
+    """Context processor declares that it provides ``flash``."""
+    assert flash.context_processor.provides == frozenset(['flash'])
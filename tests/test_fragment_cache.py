@@ -0,0 +1,204 @@
+import threading
+
+from jinja2 import Environment
+from pretend import stub
+import pytest
+
+from gurtel import fragment_cache
+from gurtel.cache import FileSystemCache, MemoryCache
+from gurtel.config import Config
+
+
+@pytest.fixture(params=['memory', 'filesystem'])
+def cache(request, tmpdir):
+    if request.param == 'memory':
+        backend = MemoryCache()
+    else:
+        backend = FileSystemCache(str(tmpdir))
+    return fragment_cache.FragmentCache(backend)
+
+
+@pytest.fixture
+def env(request):
+    env = Environment(
+        autoescape=True, extensions=[fragment_cache.FragmentCacheExtension])
+    env.fragment_cache = fragment_cache.FragmentCache()
+    return env
+
+
+class Counter(object):
+    """Render function that counts its calls."""
+    def __init__(self, value='rendered'):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+class TestFragmentCache(object):
+    def test_get_or_render(self, cache):
+        """Renders fragment once, then serves it from cache."""
+        render = Counter()
+
+        assert cache.get_or_render('nav', [1], render) == 'rendered'
+        assert cache.get_or_render('nav', [1], render) == 'rendered'
+        assert render.calls == 1
+        assert cache.stats['hits'] == 1
+        assert cache.stats['misses'] == 1
+
+    def test_vary_on(self, cache):
+        """Fragments are cached separately per vary-on values."""
+        render = Counter()
+        cache.get_or_render('nav', [1], render)
+        cache.get_or_render('nav', [2], render)
+        cache.get_or_render('sidebar', [1], render)
+
+        assert render.calls == 3
+
+    def test_ttl(self, monkeypatch):
+        """Fragments expire after their TTL."""
+        cache = fragment_cache.FragmentCache()
+        now = [1000.0]
+        monkeypatch.setattr('time.time', lambda: now[0])
+        render = Counter()
+        cache.get_or_render('nav', [], render, ttl=10)
+        now[0] += 11
+        cache.get_or_render('nav', [], render, ttl=10)
+
+        assert render.calls == 2
+
+    def test_stampede_protection(self):
+        """Concurrent misses for the same fragment render it only once."""
+        cache = fragment_cache.FragmentCache()
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def slow_render():
+            started.set()
+            release.wait()
+            return 'slow'
+
+        def fetch():
+            results.append(cache.get_or_render('nav', [], slow_render))
+
+        first = threading.Thread(target=fetch)
+        first.start()
+        started.wait()
+        render = Counter()
+        second = threading.Thread(
+            target=lambda: results.append(
+                cache.get_or_render('nav', [], render)))
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+
+        assert results == ['slow', 'slow']
+        assert render.calls == 0
+        assert cache._locks == {}
+
+    def test_shared_lock_held_elsewhere(self, tmpdir, monkeypatch):
+        """Waits for another process rendering the fragment."""
+        cache = fragment_cache.FragmentCache(
+            FileSystemCache(str(tmpdir)), lock_timeout=1)
+        key = cache.make_key('nav', [])
+        cache.backend.add(key + ':lock', 1)
+
+        def sleep(seconds):
+            cache.backend.set(key, 'other process')
+
+        monkeypatch.setattr(fragment_cache.time, 'sleep', sleep)
+        render = Counter()
+
+        assert cache.get_or_render('nav', [], render) == 'other process'
+        assert render.calls == 0
+        assert cache.stats['waits'] == 1
+
+    def test_shared_wait_timeout(self, tmpdir, monkeypatch):
+        """Renders after waiting too long, leaving the other lock alone."""
+        cache = fragment_cache.FragmentCache(
+            FileSystemCache(str(tmpdir)), lock_timeout=1)
+        lock_key = cache.make_key('nav', []) + ':lock'
+        cache.backend.add(lock_key, 1)
+        clock = iter(range(100)).next
+        monkeypatch.setattr(
+            fragment_cache, 'time', stub(time=clock, sleep=lambda s: None))
+        render = Counter()
+
+        assert cache.get_or_render('nav', [], render) == 'rendered'
+        assert render.calls == 1
+        assert cache.backend.get(lock_key) == 1
+
+    def test_shared_lock_released(self, tmpdir):
+        cache = fragment_cache.FragmentCache(FileSystemCache(str(tmpdir)))
+        cache.get_or_render('nav', [], Counter())
+
+        assert cache.backend.get(cache.make_key('nav', []) + ':lock') is None
+
+
+class TestExtension(object):
+    def test_cache_tag(self, env):
+        """``cache`` tag caches its body."""
+        tpl = env.from_string(
+            '{% cache "nav", user %}<b>{{ user }}{{ n }}</b>{% endcache %}')
+
+        assert tpl.render(user='a', n=1) == '<b>a1</b>'
+        assert tpl.render(user='a', n=2) == '<b>a1</b>'
+        assert tpl.render(user='b', n=3) == '<b>b3</b>'
+
+    def test_cache_tag_escaping(self, env):
+        """Cached fragments are neither escaped twice nor left unescaped."""
+        tpl = env.from_string('{% cache "x" %}{{ v }}{% endcache %}')
+
+        assert tpl.render(v='<i>') == '&lt;i&gt;'
+        assert tpl.render(v='<i>') == '&lt;i&gt;'
+
+    def test_cache_tag_ttl(self, env, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr('time.time', lambda: now[0])
+        tpl = env.from_string(
+            '{% cache "nav", ttl=5 %}{{ n }}{% endcache %}')
+        tpl.render(n=1)
+        now[0] += 6
+
+        assert tpl.render(n=2) == '2'
+
+    def test_no_cache(self, env):
+        """Without a fragment cache, the tag has no effect."""
+        env.fragment_cache = None
+        tpl = env.from_string('{% cache "nav" %}{{ n }}{% endcache %}')
+        tpl.render(n=1)
+
+        assert tpl.render(n=2) == '2'
+
+
+class TestCacheFromConfig(object):
+    def test_none(self):
+        assert fragment_cache.cache_from_config(Config()) is None
+
+    def test_memory(self):
+        cache = fragment_cache.cache_from_config(Config({
+            'templates.fragment_cache': 'memory',
+            'templates.fragment_cache_size': '10',
+            'templates.fragment_cache_ttl': '60',
+            }))
+
+        assert cache.backend.stats()['maxsize'] == 10
+        assert cache.default_ttl == 60
+        assert not cache.shared
+
+    def test_filesystem(self, tmpdir):
+        cache = fragment_cache.cache_from_config(Config({
+            'templates.fragment_cache': 'filesystem',
+            'templates.fragment_cache_dir': str(tmpdir),
+            }))
+
+        assert cache.shared
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            fragment_cache.cache_from_config(
+                Config({'templates.fragment_cache': 'bogus'}))
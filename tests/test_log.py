@@ -1,4 +1,12 @@
+import logging
+import threading
+
 import mock
+from pretend import stub
+import pytest
+from werkzeug.exceptions import NotFound
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
 
 from gurtel import log
 from gurtel.config import Config
@@ -21,3 +29,219 @@ class TestConfigureLogging(object):
         log.configure_logging(Config({}))
 
         assert mock_fileConfig.call_count == 0
+
+    @mock.patch('gurtel.log.queue_handlers')
+    @mock.patch('logging.config.fileConfig')
+    def test_queue(self, mock_fileConfig, mock_queue_handlers):
+        """Moves configured handlers behind queues if app.logging_queue."""
+        log.configure_logging(Config({
+            'app.logging': 'logging.ini',
+            'app.logging_queue': 'true',
+            'app.logging_queue_size': '100',
+            }))
+
+        mock_queue_handlers.assert_called_once_with(100)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.append(threading.current_thread())
+
+
+class TestQueueHandler(object):
+    def test_handles_on_thread(self):
+        """Records are handled by the target handlers on another thread."""
+        target = ListHandler()
+        handler = log.QueueHandler([target])
+        logger = logging.getLogger('gurtel.test_queue')
+        logger.addHandler(handler)
+        try:
+            logger.warning('Hello %s', 'world')
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        assert [r.getMessage() for r in target.records] == ['Hello world']
+        assert target.threads[0] is not threading.current_thread()
+
+    def test_levels(self):
+        """Target handler levels apply."""
+        errors = ListHandler(logging.ERROR)
+        handler = log.QueueHandler([errors])
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO}))
+        handler.handle(logging.makeLogRecord({'levelno': logging.ERROR}))
+        handler.close()
+
+        assert len(errors.records) == 1
+
+    def test_exception(self):
+        """Tracebacks are rendered before records are queued."""
+        target = ListHandler()
+        handler = log.QueueHandler([target])
+        logger = logging.getLogger('gurtel.test_queue')
+        logger.addHandler(handler)
+        try:
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                logger.exception('Oops')
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        record = target.records[0]
+        assert record.exc_info is None
+        assert 'ZeroDivisionError' in logging.Formatter().format(record)
+
+    def test_full(self):
+        """Records are dropped, not waited on, if the queue is full."""
+        target = ListHandler()
+        handler = log.QueueHandler([target], maxsize=1)
+        handler._ensure_thread()
+        handler._queue.put('blocker')
+        release = threading.Event()
+        # Hold up the listener thread.
+        target.handle = lambda record: release.wait()
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO}))
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO}))
+        release.set()
+        handler.close()
+
+        assert handler.dropped >= 1
+
+    def test_fork(self):
+        """A new thread and queue are started in forked processes."""
+        target = ListHandler()
+        handler = log.QueueHandler([target])
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO}))
+        first_thread = handler._thread
+        # As if in a forked child process.
+        handler._pid = -1
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO}))
+        second_thread = handler._thread
+        handler.close()
+        first_thread.join(1)
+
+        assert second_thread is not first_thread
+        assert second_thread.is_alive() is False
+
+    def test_closed(self):
+        """Records are handled synchronously once the handler is closed."""
+        target = ListHandler()
+        handler = log.QueueHandler([target])
+        handler.close()
+        handler.handle(logging.makeLogRecord({'levelno': logging.INFO}))
+
+        assert target.threads == [threading.current_thread()]
+
+
+def test_queue_handlers():
+    """Handlers of configured loggers are moved behind queue handlers."""
+    target = ListHandler()
+    logger = logging.getLogger('gurtel.test_queue_handlers')
+    logger.addHandler(target)
+    root_handlers = logging.getLogger().handlers[:]
+    try:
+        queued = log.queue_handlers()
+
+        assert len(logger.handlers) == 1
+        assert isinstance(logger.handlers[0], log.QueueHandler)
+        assert logger.handlers[0].handlers == [target]
+        assert logger.handlers[0] in queued
+    finally:
+        for handler in queued:
+            handler.close()
+        logger.handlers = []
+        logging.getLogger().handlers = root_handlers
+
+
+class TestRateLimitFilter(object):
+    def test_limit(self, monkeypatch):
+        """Passes records up to the rate, then drops them."""
+        now = [100.0]
+        monkeypatch.setattr(log, 'timer', lambda: now[0])
+        f = log.RateLimitFilter(2)
+        records = [logging.makeLogRecord({}) for i in range(4)]
+
+        assert [f.filter(r) for r in records[:3]] == [True, True, False]
+        now[0] += 0.5
+        assert f.filter(records[3])
+        assert records[3].dropped == 1
+        assert f.dropped == 1
+
+    @mock.patch('logging.config.fileConfig')
+    def test_configure(self, mock_fileConfig):
+        """Rate limits are configured for named loggers."""
+        log.configure_logging(
+            Config({'app.logging_rate_limits': 'gurtel.test_noisy: 5'}))
+        log.configure_logging(
+            Config({'app.logging_rate_limits': 'gurtel.test_noisy: 10'}))
+        filters = logging.getLogger('gurtel.test_noisy').filters
+
+        assert [f.rate for f in filters] == [10.0]
+
+
+def make_request(path='/', **headers):
+    request = Request(EnvironBuilder(path, headers=headers).get_environ())
+    request.app = stub(dispatcher=stub(match=lambda r: ('thing', {})))
+    return request
+
+
+class TestAccessLog(object):
+    @pytest.fixture
+    def records(self, monkeypatch):
+        target = ListHandler()
+        monkeypatch.setattr(log.access_logger, 'level', logging.INFO)
+        log.access_logger.addHandler(target)
+        yield target.records
+        log.access_logger.removeHandler(target)
+
+    def test_record(self, records):
+        """Logs a structured record per request."""
+        resp = log.access_log_middleware(
+            make_request('/thing/'), lambda r: Response('Hello'))
+
+        record, = records
+        assert record.endpoint == 'thing'
+        assert record.status == 200
+        assert record.bytes == 5
+        assert record.path == '/thing/'
+        assert record.latency >= 0
+        assert resp.headers['X-Request-ID'] == record.request_id
+
+    def test_request_id_header(self, records):
+        """Uses a request ID given by a proxy."""
+        request = make_request(X_Request_ID='abc123')
+        log.access_log_middleware(request, lambda r: Response(''))
+
+        assert request.request_id == 'abc123'
+        assert records[0].request_id == 'abc123'
+
+    def test_streamed(self, records):
+        """Streamed responses are logged once sent, with bytes sent."""
+        request = make_request()
+        resp = log.access_log_middleware(
+            request, lambda r: Response(iter([u'a', u'\xe9'])))
+        assert records == []
+        app_iter = resp(request.environ, lambda status, headers: None)
+        assert ''.join(app_iter) == 'a\xc3\xa9'
+        app_iter.close()
+
+        assert records[0].bytes == 3
+
+    def test_http_exception(self, records):
+        """Raised HTTP exceptions are logged with their status."""
+        def not_found(request):
+            raise NotFound()
+
+        with pytest.raises(NotFound):
+            log.access_log_middleware(make_request(), not_found)
+
+        assert records[0].status == 404
+        assert records[0].bytes is None
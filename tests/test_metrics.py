@@ -0,0 +1,193 @@
+from functools import partial
+import time
+
+from pretend import stub
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from gurtel import metrics
+
+
+def make_request(timed=True):
+    request = Request(EnvironBuilder().get_environ())
+    if timed:
+        request.timings = metrics.RequestTimings()
+    return request
+
+
+class TestHistogram(object):
+    def test_cumulative(self):
+        """Cumulative bucket counts include all smaller buckets."""
+        h = metrics.Histogram(buckets=(0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            h.observe(value)
+
+        assert h.cumulative() == [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+        assert h.count == 4
+        assert h.sum == 2.65
+
+
+def test_record():
+    """Stage times are recorded only for timed requests."""
+    request = make_request()
+    metrics.record(request, 'render', 0.5)
+    metrics.record(make_request(timed=False), 'render', 0.5)
+
+    assert request.timings.stages == [('render', 0.5)]
+
+
+def test_record_no_stages():
+    """Nothing is recorded if the request's stages aren't being timed."""
+    request = make_request()
+    request.timings = metrics.RequestTimings(stages=False)
+    metrics.record(request, 'render', 0.5)
+
+    assert request.timings.stages is None
+
+
+class TestMetrics(object):
+    def test_observe(self):
+        """Records request latency, stage latencies and status by endpoint."""
+        m = metrics.Metrics()
+        timings = metrics.RequestTimings()
+        timings.endpoint = 'index'
+        timings.add('handler', 0.01)
+        m.observe(timings, 200, 0.02)
+        m.observe(metrics.RequestTimings(), 404, 0.001)
+        m.merge()
+
+        assert m.requests['index'].count == 1
+        assert m.stages['handler'].sum == 0.01
+        assert m.responses == {
+            ('index', 200): 1, (metrics.UNMATCHED, 404): 1}
+
+    def test_merged_in_background(self):
+        """Observed timings are merged by a background thread."""
+        m = metrics.Metrics(interval=0.01)
+        m.observe(metrics.RequestTimings(), 200, 0.02)
+        for i in range(100):
+            if m.responses:
+                break
+            time.sleep(0.01)
+
+        assert m.responses == {(metrics.UNMATCHED, 200): 1}
+
+    def test_fork(self, monkeypatch):
+        """Forked processes start a thread, and don't merge parent timings."""
+        threads = []
+        monkeypatch.setattr(
+            metrics.threading, 'Thread',
+            lambda **kwargs: threads.append(kwargs) or stub(
+                daemon=False, start=lambda: None))
+        m = metrics.Metrics()
+        m.observe(metrics.RequestTimings(), 200, 0.02)
+        m.observe(metrics.RequestTimings(), 200, 0.02)
+        # As if in a forked child process.
+        m._pid = -1
+        m.observe(metrics.RequestTimings(), 200, 0.02)
+        m.merge()
+
+        assert len(threads) == 2
+        assert m.responses == {(metrics.UNMATCHED, 200): 1}
+
+    def test_render(self):
+        """Renders metrics in Prometheus text format."""
+        m = metrics.Metrics(buckets=(0.1,))
+        timings = metrics.RequestTimings()
+        timings.endpoint = 'index'
+        timings.add('handler', 0.05)
+        m.observe(timings, 200, 0.2)
+
+        assert m.render().splitlines() == [
+            '# HELP gurtel_request_duration_seconds '
+            'Request latency by endpoint.',
+            '# TYPE gurtel_request_duration_seconds histogram',
+            'gurtel_request_duration_seconds_bucket'
+            '{endpoint="index",le="0.1"} 0',
+            'gurtel_request_duration_seconds_bucket'
+            '{endpoint="index",le="+Inf"} 1',
+            'gurtel_request_duration_seconds_sum{endpoint="index"} 0.2',
+            'gurtel_request_duration_seconds_count{endpoint="index"} 1',
+            '# HELP gurtel_stage_duration_seconds '
+            'Request stage latency by stage.',
+            '# TYPE gurtel_stage_duration_seconds histogram',
+            'gurtel_stage_duration_seconds_bucket'
+            '{stage="handler",le="0.1"} 1',
+            'gurtel_stage_duration_seconds_bucket'
+            '{stage="handler",le="+Inf"} 1',
+            'gurtel_stage_duration_seconds_sum{stage="handler"} 0.05',
+            'gurtel_stage_duration_seconds_count{stage="handler"} 1',
+            '# HELP gurtel_responses_total '
+            'Responses by endpoint and status code.',
+            '# TYPE gurtel_responses_total counter',
+            'gurtel_responses_total{endpoint="index",status="200"} 1',
+            ]
+
+
+def test_instrument_middleware(monkeypatch):
+    """Records middleware time excluding the inner response callable."""
+    clock = iter([0.0, 1.0, 3.0, 3.5])
+    monkeypatch.setattr(metrics, 'timer', lambda: next(clock))
+
+    def my_middleware(request, response_callable):
+        return response_callable(request)
+
+    instrumented = metrics.instrument_middleware(my_middleware)
+    request = make_request()
+    response = instrumented(
+        request, metrics.instrument_inner(lambda req: 'response'))
+
+    assert response == 'response'
+    assert request.timings.stages == [('middleware.my_middleware', 1.5)]
+
+
+def test_instrument_middleware_no_stages(monkeypatch):
+    """Middlewares aren't timed if the request's stages aren't."""
+    monkeypatch.setattr(metrics, 'timer', pytest.fail)
+    instrumented = metrics.instrument_middleware(
+        lambda request, response_callable: response_callable(request))
+    request = make_request()
+    request.timings = metrics.RequestTimings(stages=False)
+
+    assert instrumented(request, lambda req: 'response') == 'response'
+
+
+def test_instrument_nested_middlewares(monkeypatch):
+    """Inner instrumented middlewares' time is excluded from outer ones."""
+    clock = iter([0.0, 1.0, 3.0, 4.0, 7.0, 10.0])
+    monkeypatch.setattr(metrics, 'timer', lambda: next(clock))
+
+    def outer(request, response_callable):
+        return response_callable(request)
+
+    def inner(request, response_callable):
+        return response_callable(request)
+
+    instrumented_inner = metrics.instrument_middleware(inner)
+    instrumented = metrics.instrument_middleware(outer)
+    request = make_request()
+    instrumented(request, lambda req: instrumented_inner(
+        req, metrics.instrument_inner(lambda r: 'response')))
+
+    assert request.timings.stages == [
+        ('middleware.inner', 5.0), ('middleware.outer', 4.0)]
+
+
+def test_instrument_middleware_name():
+    """Middlewares without a ``__name__`` are named by their type."""
+    instrumented = metrics.instrument_middleware(
+        partial(lambda tag, request, response_callable: tag, 'x'))
+
+    assert instrumented.__name__ == 'partial'
+
+
+def test_metrics_handler():
+    """Serves the app's metrics as plain text."""
+    request = make_request()
+    request.app = type('App', (object,), {'metrics': metrics.Metrics()})()
+    response = metrics.metrics_handler(request)
+
+    assert isinstance(response, Response)
+    assert response.mimetype == 'text/plain'
+    assert '# TYPE gurtel_responses_total counter' in response.data
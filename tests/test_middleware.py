@@ -0,0 +1,111 @@
+from functools import partial
+
+from gurtel import middleware, session
+
+
+def make_middleware(name, calls):
+    def _middleware(request, response_callable):
+        calls.append(name)
+        return response_callable(request)
+
+    _middleware.__name__ = name
+    return _middleware
+
+
+def test_middleware_name():
+    """Named by ``middleware_name`` attribute, else ``__name__``."""
+    assert middleware.middleware_name(session.session_middleware) == 'session'
+    assert middleware.middleware_name(
+        session.store_session_middleware) == 'session'
+    assert middleware.middleware_name(make_middleware('foo', [])) == 'foo'
+    assert middleware.middleware_name('foo') == 'foo'
+
+
+def test_middleware_name_unnamed():
+    """Partials and callable instances have no name."""
+    class Middleware(object):
+        def __call__(self, request, response_callable):
+            return response_callable(request)
+
+    assert middleware.middleware_name(
+        partial(make_middleware('foo', []))) is None
+    assert middleware.middleware_name(Middleware()) is None
+
+
+class TestCompileChain(object):
+    def test_order(self):
+        """First middleware is outermost."""
+        calls = []
+        chain = middleware.compile_chain(
+            [make_middleware('a', calls), make_middleware('b', calls)],
+            lambda request: calls.append('handler') or 'response',
+            )
+
+        assert chain('request') == 'response'
+        assert calls == ['a', 'b', 'handler']
+
+    def test_empty(self):
+        """With no middlewares, the response callable is returned as is."""
+        def handler(request):
+            pass
+
+        assert middleware.compile_chain([], handler) is handler
+
+
+class TestSelect(object):
+    def make_middlewares(self):
+        return [make_middleware(name, []) for name in ['a', 'b', 'c']]
+
+    def selected(self, handler):
+        return [
+            m.__name__ for m in middleware.select(
+                self.make_middlewares(), middleware.selection_key(handler))]
+
+    def test_all(self):
+        """Handlers declaring nothing get all middlewares."""
+        assert middleware.selection_key(lambda request: None) is None
+        assert self.selected(lambda request: None) == ['a', 'b', 'c']
+
+    def test_skip(self):
+        """Handlers can skip middlewares."""
+        @middleware.skip_middleware('a', make_middleware('c', []))
+        def handler(request):
+            pass
+
+        assert self.selected(handler) == ['b']
+
+    def test_only(self):
+        """Handlers can require only some middlewares."""
+        @middleware.only_middleware('b')
+        def handler(request):
+            pass
+
+        assert self.selected(handler) == ['b']
+
+    def test_unnamed(self):
+        """Unnamed middlewares can be skipped or required as themselves."""
+        named = make_middleware('a', [])
+        unnamed = partial(make_middleware('b', []))
+
+        @middleware.skip_middleware(unnamed)
+        def skipping(request):
+            pass
+
+        @middleware.only_middleware(unnamed)
+        def requiring(request):
+            pass
+
+        def selected(handler):
+            return middleware.select(
+                [named, unnamed], middleware.selection_key(handler))
+
+        assert selected(skipping) == [named]
+        assert selected(requiring) == [unnamed]
+
+    def test_only_none(self):
+        """``only_middleware()`` skips all middlewares."""
+        @middleware.only_middleware()
+        def handler(request):
+            pass
+
+        assert self.selected(handler) == []
@@ -0,0 +1,97 @@
+import os
+import pstats
+import time
+
+from pretend import stub
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from gurtel import profiling
+
+
+def make_request(map_dispatcher, path='/thing/2/'):
+    request = Request(EnvironBuilder(path).get_environ())
+    request.app = stub(dispatcher=map_dispatcher)
+    return request
+
+
+def handler(request):
+    return Response(''.join(str(i) for i in range(100)))
+
+
+@pytest.fixture
+def profiler(tmpdir, monkeypatch):
+    profiler = profiling.Profiler(str(tmpdir.join('profiles')), 1.0)
+    # Don't start the background thread; tests merge and write explicitly.
+    monkeypatch.setattr(profiler, '_ensure_thread', lambda: None)
+    return profiler
+
+
+def test_not_sampled(profiler, map_dispatcher):
+    """Requests not sampled aren't profiled."""
+    profiler.sample_rate = 0.0
+    profiler.profile_middleware(make_request(map_dispatcher), handler)
+
+    assert profiler.merge() == set()
+
+
+def test_profiles_per_endpoint(profiler, map_dispatcher):
+    """Sampled requests are profiled, and merged per endpoint."""
+    for path in ['/thing/2/', '/thing/3/', '/nope/']:
+        response = profiler.profile_middleware(
+            make_request(map_dispatcher, path), handler)
+        assert response.status_code == 200
+
+    assert profiler.merge() == set(['thing', profiling.UNMATCHED])
+    assert profiler.stats['thing'].total_calls > 0
+
+
+def test_endpoint_filter(profiler, map_dispatcher):
+    """Only listed endpoints are profiled, if given."""
+    profiler.endpoints = frozenset(['other'])
+    profiler.profile_middleware(make_request(map_dispatcher), handler)
+
+    assert profiler.merge() == set()
+
+
+def test_write(profiler, map_dispatcher, tmpdir):
+    """Writes merged stats to a pstats file per endpoint and process."""
+    profiler.profile_middleware(make_request(map_dispatcher), handler)
+    profiler.merge()
+    profiler.write()
+
+    filename = str(tmpdir.join('profiles', 'thing.%s.pstats' % os.getpid()))
+    assert os.listdir(str(tmpdir.join('profiles'))) == [
+        os.path.basename(filename)]
+    assert pstats.Stats(filename).total_calls > 0
+
+
+def test_background_thread(tmpdir, map_dispatcher):
+    """Background thread merges and periodically writes profiles."""
+    output_dir = tmpdir.join('profiles')
+    profiler = profiling.Profiler(str(output_dir), 1.0, interval=0.05)
+    profiler.profile_middleware(make_request(map_dispatcher), handler)
+    for i in range(100):
+        if output_dir.check() and output_dir.listdir():
+            break
+        time.sleep(0.05)
+
+    assert [p.basename for p in output_dir.listdir()] == [
+        'thing.%s.pstats' % os.getpid()]
+
+
+def test_from_config():
+    """Profiler is only configured if sample rate is set."""
+    settings = {
+        'profile.sample_rate': 0.0,
+        'profile.dir': None,
+        'profile.endpoints': None,
+        'profile.interval': 60.0,
+        }
+
+    assert profiling.profiler_from_config(settings) is None
+    settings['profile.sample_rate'] = 0.5
+    profiler = profiling.profiler_from_config(settings)
+    assert profiler.sample_rate == 0.5
+    assert profiler.output_dir.endswith('gurtel-profiles')
@@ -0,0 +1,85 @@
+"""Tests for the ``app`` and ``client`` fixtures of the pytest plugin."""
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Response
+
+import pytest
+
+from gurtel.app import GurtelApp
+from gurtel.dispatch import MapDispatcher
+
+from .conftest import TESTAPP_BASE_DIR
+
+
+def handle_session(request):
+    count = request.session.get('count', 0) + 1
+    request.session['count'] = count
+    request.flash.info("Visit %s" % count)
+    return Response(str(count))
+
+
+def handle_expiry(request):
+    return Response(str(request.settings['session.expiry_minutes']))
+
+
+def handle_metrics(request):
+    return Response(str(request.app.metrics is not None))
+
+
+@pytest.fixture(scope='session')
+def gurtel_app_factory():
+    def factory(config):
+        dispatcher = MapDispatcher(
+            Map([
+                Rule('/session/', endpoint='session'),
+                Rule('/expiry/', endpoint='expiry'),
+                Rule('/metrics/', endpoint='metrics'),
+                ]),
+            {
+                'session': handle_session,
+                'expiry': handle_expiry,
+                'metrics': handle_metrics,
+                },
+            )
+        return GurtelApp(config, TESTAPP_BASE_DIR, dispatcher)
+
+    return factory
+
+
+def test_app_reused(app, _gurtel_app):
+    """App is created once per test session."""
+    assert isinstance(app, GurtelApp)
+    assert app is _gurtel_app
+
+
+@pytest.mark.parametrize('attempt', [1, 2])
+def test_fresh_session(client, attempt):
+    """Each test's client starts with a new session."""
+    assert client.get('/session/').data == '1'
+    assert client.get('/session/').data == '2'
+
+
+@pytest.mark.config({'session.expiry_minutes': '30'})
+def test_config_mark(app, client, _gurtel_app):
+    """Config mark overrides are applied to the shared app."""
+    assert client.get('/expiry/').data == '30'
+    assert app is _gurtel_app
+
+
+def test_config_restored(app, client, _gurtel_app):
+    """Config overrides don't leak into later tests."""
+    assert client.get('/expiry/').data == '0'
+    assert app is _gurtel_app
+
+
+@pytest.mark.config({'app.metrics': 'true'})
+def test_config_mark_creation_setting(app, client, _gurtel_app):
+    """Marks for settings used on app creation get a new app."""
+    assert client.get('/metrics/').data == 'True'
+    assert app is not _gurtel_app
+    assert _gurtel_app.metrics is None
+
+
+def test_creation_setting_restored(app, client, _gurtel_app):
+    """The shared app is used again after a test with a new app."""
+    assert client.get('/metrics/').data == 'False'
+    assert app is _gurtel_app
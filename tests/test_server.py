@@ -0,0 +1,390 @@
+from functools import partial
+import httplib
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from pretend import stub
+import pytest
+from werkzeug.exceptions import NotFound
+from werkzeug.routing import Map, Rule
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from gurtel import server
+from gurtel.app import GurtelApp
+from gurtel.dispatch import MapDispatcher
+
+from .conftest import TESTAPP_BASE_DIR
+
+
+def handle_pid(request):
+    return Response(str(os.getpid()))
+
+
+def make_app(config):
+    """App factory for ``gurtel serve`` in the tests below."""
+    dispatcher = MapDispatcher(
+        Map([
+            Rule('/pid/', endpoint='pid'),
+            Rule('/scoreboard/', endpoint='scoreboard'),
+            ]),
+        {'pid': handle_pid, 'scoreboard': server.scoreboard_handler},
+        )
+    return GurtelApp(config, TESTAPP_BASE_DIR, dispatcher)
+
+
+@pytest.mark.parametrize('bind,expected', [
+    ('0.0.0.0:80', ('0.0.0.0', 80)),
+    (':8000', ('127.0.0.1', 8000)),
+    ('[::1]:8000', ('::1', 8000)),
+    ])
+def test_parse_bind(bind, expected):
+    assert server.parse_bind(bind) == expected
+
+
+class TestScoreboard(object):
+    def test_counts(self):
+        """Counts requests, active requests and busy time per slot."""
+        scoreboard = server.Scoreboard(2)
+        scoreboard.set(1, pid=123, started=1.5)
+        scoreboard.begin(1)
+        scoreboard.begin(1)
+        scoreboard.end(1, 0.25)
+
+        assert scoreboard.workers() == [{
+            'slot': 1,
+            'pid': 123,
+            'crashes': 0,
+            'requests': 2,
+            'active': 1,
+            'started': 1.5,
+            'busy': 0.25,
+            }]
+
+    def test_reset(self):
+        """Resetting a slot keeps only its count of crashes."""
+        scoreboard = server.Scoreboard(1)
+        scoreboard.set(0, pid=123, crashes=2, requests=5)
+        scoreboard.reset(0)
+
+        assert scoreboard.get(0, 'crashes') == 2
+        assert scoreboard.get(0, 'requests') == 0
+        assert scoreboard.workers() == []
+
+    def test_render(self):
+        """Renders counters per worker in Prometheus text format."""
+        scoreboard = server.Scoreboard(1)
+        scoreboard.set(0, pid=123, requests=4)
+
+        assert (
+            'gurtel_worker_requests_total{slot="0",pid="123"} 4'
+            in scoreboard.render().splitlines())
+
+
+def test_scoreboard_handler():
+    """Serves the scoreboard from the environ, if running under the server."""
+    environ = EnvironBuilder().get_environ()
+    with pytest.raises(NotFound):
+        server.scoreboard_handler(Request(environ))
+
+    environ[server.SCOREBOARD_KEY] = server.Scoreboard(1)
+    response = server.scoreboard_handler(Request(environ))
+
+    assert '# TYPE gurtel_worker_requests_total counter' in response.data
+
+
+def test_file_wrapper(tmpdir):
+    """Iterates over the file in blocks."""
+    path = tmpdir.join('data')
+    path.write('x' * 50000)
+    wrapper = server.FileWrapper(path.open('rb'), 8192)
+
+    blocks = list(wrapper)
+    wrapper.close()
+
+    assert ''.join(blocks) == 'x' * 50000
+    assert len(blocks[0]) == 8192
+    assert wrapper.f.closed
+
+
+@pytest.mark.parametrize('sendfile', [True, False])
+def test_send_files(tmpdir, monkeypatch, sendfile):
+    """Sends ``FileWrapper`` responses with sendfile, if available."""
+    if not sendfile:
+        monkeypatch.setattr(server, '_sendfile', None)
+    path = tmpdir.join('data')
+    path.write('x' * 50000)
+    a, b = socket.socketpair()
+    b.settimeout(5)
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return environ['wsgi.file_wrapper'](path.open('rb'))
+
+    environ = {'wsgi.file_wrapper': partial(server.FileWrapper, connection=a)}
+    app_iter = server.send_files(app)(environ, lambda *args: None)
+    received = list(app_iter)
+    app_iter.close()
+    a.close()
+    while True:
+        data = b.recv(65536)
+        if not data:
+            break
+        received.append(data)
+
+    assert ''.join(received) == 'x' * 50000
+    assert (received[0] == '') == sendfile
+
+
+def test_send_files_wrapped(tmpdir):
+    """File wrappers wrapped by another iterable are iterated over."""
+    path = tmpdir.join('data')
+    path.write('x' * 50000)
+    a, b = socket.socketpair()
+
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return iter(server.FileWrapper(path.open('rb'), connection=a))
+
+    received = list(server.send_files(app)({}, lambda *args: None))
+
+    assert ''.join(received) == 'x' * 50000
+
+
+class TestArbiterMaintain(object):
+    @pytest.fixture
+    def arbiter(self, monkeypatch):
+        arbiter = server.Arbiter(lambda: None, workers=2)
+        arbiter.workers = 2
+        arbiter.scoreboard = server.Scoreboard(3)
+        pids = iter(range(100, 200))
+
+        def spawn(slot):
+            pid = next(pids)
+            arbiter.children[pid] = server._Child(
+                slot, arbiter.generation, time.time())
+            arbiter.scoreboard.set(slot, pid=pid, started=time.time())
+
+        def kill(pid, signum):
+            arbiter._stopping.add(pid)
+
+        monkeypatch.setattr(arbiter, 'spawn', spawn)
+        monkeypatch.setattr(arbiter, 'kill', kill)
+        return arbiter
+
+    def exit(self, arbiter, pid):
+        child = arbiter.children.pop(pid)
+        arbiter._stopping.discard(pid)
+        arbiter.scoreboard.set(child.slot, pid=0)
+
+    def test_spawns_workers(self, arbiter):
+        """Spawns workers one at a time, up to the number wanted."""
+        for i in range(3):
+            arbiter.maintain()
+
+        assert sorted(arbiter.children) == [100, 101]
+        assert not arbiter._stopping
+
+    def test_rolling_reload(self, arbiter):
+        """After reload, starts each new worker before stopping an old one."""
+        arbiter.maintain()
+        arbiter.maintain()
+        arbiter.generation += 1
+
+        arbiter.maintain()
+        assert sorted(arbiter.children) == [100, 101, 102]
+        arbiter.maintain()
+        assert arbiter._stopping == set([100])
+        arbiter.maintain()
+        assert arbiter._stopping == set([100])
+
+        self.exit(arbiter, 100)
+        arbiter.maintain()
+        arbiter.maintain()
+        assert arbiter._stopping == set([101])
+
+        self.exit(arbiter, 101)
+        arbiter.maintain()
+        assert sorted(arbiter.children) == [102, 103]
+
+    def test_spawn_backoff(self, arbiter):
+        """No workers are spawned while backing off after quick crashes."""
+        arbiter._spawn_after = time.time() + 60
+        arbiter.maintain()
+
+        assert arbiter.children == {}
+
+
+class TestArbiterReload(object):
+    def make_app(self, closed):
+        return stub(
+            config_watcher=stub(callback=None),
+            close=lambda: closed.append(True),
+            )
+
+    def test_config_change(self):
+        """A change to the app's watched config files reloads the app."""
+        arbiter = server.Arbiter(lambda: self.make_app([]))
+        app = arbiter._load()
+        app.config_watcher.callback()
+
+        assert arbiter._signals == [signal.SIGHUP]
+
+    def test_closes_old_app(self):
+        """After reload, the old app is closed."""
+        closed = []
+        arbiter = server.Arbiter(lambda: self.make_app([]))
+        arbiter.app = self.make_app(closed)
+        arbiter.reload()
+
+        assert closed == [True]
+        assert arbiter.generation == 1
+
+    def test_failed_reload(self):
+        """If the new app fails to warm up, it is closed instead."""
+        closed = []
+        new_app = self.make_app(closed)
+        new_app.warmup = lambda: 1 / 0
+        arbiter = server.Arbiter(lambda: new_app)
+        old_app = arbiter.app = self.make_app([])
+        arbiter.reload()
+
+        assert arbiter.app is old_app
+        assert closed == [True]
+        assert arbiter.generation == 0
+
+
+def start_serve(request, tmpdir, configfile):
+    """Start ``gurtel serve`` for ``make_app``; return process and port."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'gurtel.server', 'serve',
+            'tests.test_server.make_app',
+            '--config', configfile,
+            '--bind', '127.0.0.1:%s' % port,
+            '--workers', '2',
+            '--threaded',
+            ],
+        stderr=tmpdir.join('server.log').open('w'),
+        )
+
+    def _stop():
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    request.addfinalizer(_stop)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    return process, port
+
+
+@pytest.fixture
+def serve(request, tmpdir):
+    """Start ``gurtel serve`` for ``make_app``; return process and port."""
+    return start_serve(
+        request, tmpdir, os.path.join(TESTAPP_BASE_DIR, 'test.ini'))
+
+
+def get(connection, path):
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return response.read()
+
+
+def worker_values(port, metric):
+    """Return dict of pids to values of ``metric`` on the scoreboard."""
+    scoreboard = get(httplib.HTTPConnection('127.0.0.1', port), '/scoreboard/')
+    values = {}
+    for line in scoreboard.splitlines():
+        if line.startswith(metric + '{'):
+            labels, value = line.split(' ')
+            values[int(labels.split('pid="')[1].split('"')[0])] = value
+    return values
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def test_serve(serve):
+    """Serves via workers over keep-alive; restarts crashed workers."""
+    process, port = serve
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    pid = int(get(connection, '/pid/'))
+    # Same connection, so same worker.
+    assert int(get(connection, '/pid/')) == pid
+    assert pid != process.pid
+
+    os.kill(pid, signal.SIGKILL)
+
+    def restarted():
+        crashes = worker_values(port, 'gurtel_worker_crashes_total')
+        return (
+            len(crashes) == 2 and pid not in crashes and
+            sorted(crashes.values()) == ['0', '1'])
+
+    wait_for(restarted)
+
+    process.send_signal(signal.SIGTERM)
+    assert process.wait() == 0
+
+
+def test_reload(serve):
+    """On SIGHUP, replaces all workers."""
+    process, port = serve
+
+    def pids():
+        return set(worker_values(port, 'gurtel_worker_requests_total'))
+
+    wait_for(lambda: len(pids()) == 2)
+    before = pids()
+    process.send_signal(signal.SIGHUP)
+
+    wait_for(lambda: len(pids()) == 2 and not (pids() & before))
+
+
+def test_config_reload(request, tmpdir):
+    """With ``app.config_reload``, config changes replace all workers."""
+    configfile = tmpdir.join('config.ini')
+    contents = (
+        "[app]\nsecret_key = test\nconfig_reload = true\n"
+        "config_reload_interval = 0.1\n")
+    configfile.write(contents)
+    process, port = start_serve(request, tmpdir, str(configfile))
+
+    def pids():
+        return set(worker_values(port, 'gurtel_worker_requests_total'))
+
+    wait_for(lambda: len(pids()) == 2)
+    before = pids()
+    configfile.write(contents + "[session]\nexpiry_minutes = 5\n")
+
+    wait_for(lambda: len(pids()) == 2 and not (pids() & before))
+
+
+def test_arbiter_options():
+    """Options not given are read from the app's settings."""
+    arbiter = server.Arbiter(lambda: None, workers=3)
+    arbiter.app = stub(settings={'server.workers': 1, 'server.bind': ':80'})
+
+    assert arbiter.option('workers') == 3
+    assert arbiter.option('bind') == ':80'
@@ -2,54 +2,113 @@ import datetime
 
 from mock import patch
 from pretend import stub
+import pytest
 
 from gurtel import session
+from gurtel.app import SETTINGS
+from gurtel.config import Config
+from gurtel.session_store import MemorySessionStore
 
 
-def test_annotates_request():
-    """Annotates request with ``session`` property."""
-    request = stub(
+def make_request(config=None):
+    return stub(
         cookies={},
-        app=stub(secret_key='secret', is_ssl=True, config={}),
+        app=stub(secret_key='secret', is_ssl=True),
+        settings=Config(config).snapshot(SETTINGS),
         )
 
+
+def modify_session(response):
+    """Return a response callable that modifies the session."""
+    def _inner(req):
+        req.session['foo'] = 'bar'
+        return response
+
+    return _inner
+
+
+@pytest.fixture(autouse=True)
+def clear_stats():
+    session.stats.clear()
+
+
+def test_annotates_request():
+    """Annotates request with ``session`` property."""
+    request = make_request()
+
     session.session_middleware(request, lambda req: None)
 
     assert request.session.secret_key == 'secret'
 
 
+def test_session_loaded_lazily():
+    """Session cookie isn't parsed unless the session is accessed."""
+    request = make_request()
+
+    with patch.object(session.JSONSecureCookie, 'load_cookie') as mock_load:
+        session.session_middleware(request, lambda req: None)
+
+    assert mock_load.call_count == 0
+    assert session.stats['loaded'] == 0
+
+
+def test_session_loaded_once():
+    """Session cookie is parsed only once, however often it's accessed."""
+    request = make_request()
+
+    def handler(req):
+        req.session.get('a')
+        req.session.get('b')
+
+    with patch.object(
+            session.JSONSecureCookie,
+            'load_cookie',
+            return_value=session.JSONSecureCookie(secret_key='secret'),
+            ) as mock_load:
+        session.session_middleware(request, handler)
+
+    assert mock_load.call_count == 1
+
+
 @patch.object(session.JSONSecureCookie, 'save_cookie')
 def test_sets_cookie_on_response(mock_save_cookie):
-    """Calls ``save_cookie`` on response."""
-    request = stub(
-        cookies={},
-        app=stub(secret_key='secret', is_ssl=True, config={}),
-        )
+    """Calls ``save_cookie`` on response if session was modified."""
+    request = make_request()
     response = stub()
 
-    session.session_middleware(request, lambda req: response)
+    session.session_middleware(request, modify_session(response))
 
     mock_save_cookie.assert_called_once_with(
         response, httponly=True, secure=True)
+    assert session.stats['saved'] == 1
+
+
+@pytest.mark.parametrize('access', [True, False])
+@patch.object(session.JSONSecureCookie, 'save_cookie')
+def test_no_cookie_if_unmodified(mock_save_cookie, access):
+    """Doesn't touch the response if session was unused or unmodified."""
+    request = make_request()
+
+    def handler(req):
+        if access:
+            req.session.get('foo')
+
+    session.session_middleware(request, handler)
+
+    assert mock_save_cookie.call_count == 0
+    assert session.stats['skipped_save'] == 1
 
 
 @patch.object(session.JSONSecureCookie, 'save_cookie')
 @patch.object(session.timezone, 'now')
 def test_can_set_expiry(mock_now, mock_save_cookie):
     """Calls ``save_cookie`` on response with expiry date, if configured."""
-    request = stub(
-        cookies={},
-        app=stub(
-            secret_key='secret',
-            is_ssl=True,
-            config={'session.expiry_minutes': '1440'},
-        ),
-    )
+    request = make_request({'session.expiry_minutes': '1440'})
     response = stub()
 
     mock_now.return_value = datetime.datetime(2013, 11, 22)
 
-    session.session_middleware(request, lambda req: response)
+    session.session_middleware(request, modify_session(response))
 
     mock_save_cookie.assert_called_once_with(
         response,
@@ -57,3 +116,165 @@ def test_can_set_expiry(mock_now, mock_save_cookie):
         secure=True,
         expires=datetime.datetime(2013, 11, 23),
     )
+
+
+class TestCompactSecureCookie(object):
+    @pytest.mark.parametrize('serializer', ['json', 'marshal'])
+    @pytest.mark.parametrize('threshold', [None, 0, 1024])
+    def test_round_trip(self, serializer, threshold):
+        """Session data survives serialization with any format options."""
+        cls = session.get_cookie_class(serializer, threshold)
+        data = {'user_id': 3, 'flash': [{'level': 'info', 'message': 'hi'}]}
+        cookie = cls(data, secret_key='secret').serialize()
+
+        assert cookie.startswith('!1')
+        assert cls.unserialize(cookie, 'secret') == data
+
+    def test_compressed_above_threshold(self):
+        """Payloads larger than the threshold are compressed."""
+        cls = session.get_cookie_class('json', 100)
+        small = cls({'a': 'b'}, secret_key='secret').serialize()
+        large = cls({'a': 'b' * 1000}, secret_key='secret').serialize()
+
+        assert small.startswith('!1j.')
+        assert large.startswith('!1jz.')
+        assert len(large) < 1000
+        assert cls.unserialize(large, 'secret') == {'a': 'b' * 1000}
+
+    def test_decodes_legacy_cookie(self):
+        """Cookies in the legacy per-value JSON format still decode."""
+        legacy = session.JSONSecureCookie(
+            {'user_id': 3}, secret_key='secret').serialize()
+        cls = session.get_cookie_class('marshal')
+
+        assert cls.unserialize(legacy, 'secret') == {'user_id': 3}
+
+    def test_decodes_other_serializer(self):
+        """Cookies written by another registered serializer decode."""
+        cookie = session.get_cookie_class('json')(
+            {'user_id': 3}, secret_key='secret').serialize()
+
+        assert session.get_cookie_class('marshal').unserialize(
+            cookie, 'secret') == {'user_id': 3}
+
+    @pytest.mark.parametrize('tamper', [
+        lambda c: c[:-2] + 'xx',
+        lambda c: c.replace('!1j', '!1m'),
+        lambda c: c.replace('!1j', '!9j'),
+        lambda c: c.split('.', 1)[0],
+        ])
+    def test_bad_cookie_gives_empty_session(self, tamper):
+        """Tampered or malformed cookies result in an empty session."""
+        cls = session.get_cookie_class('json')
+        cookie = cls({'user_id': 3}, secret_key='secret').serialize()
+        loaded = cls.unserialize(tamper(cookie), 'secret')
+
+        assert loaded == {}
+        assert not loaded.new
+
+    def test_wrong_secret_gives_empty_session(self):
+        cls = session.get_cookie_class('json')
+        cookie = cls({'user_id': 3}, secret_key='secret').serialize()
+
+        assert cls.unserialize(cookie, 'other') == {}
+
+    def test_expiry(self, monkeypatch):
+        """Expired cookies result in an empty session."""
+        cls = session.get_cookie_class('json')
+        expires = datetime.datetime(2013, 11, 22)
+        cookie = cls({'user_id': 3}, secret_key='secret').serialize(expires)
+
+        assert cls.unserialize(cookie, 'secret') == {}
+
+        monkeypatch.setattr(session, 'time', lambda: 0)
+        assert cls.unserialize(cookie, 'secret') == {'user_id': 3}
+
+    def test_duplicate_tag(self):
+        """Can't register two serializers with the same tag."""
+        with pytest.raises(ValueError):
+            session.register_serializer('other', stub(tag='j'))
+
+
+@patch.object(session.CompactSecureCookie, 'save_cookie')
+def test_middleware_uses_configured_serializer(mock_save_cookie):
+    """Middleware uses compact format if ``session.serializer`` is set."""
+    request = make_request({'session.serializer': 'marshal'})
+
+    session.session_middleware(request, modify_session(stub()))
+
+    cookie = request.session._get_current_object()
+    assert isinstance(cookie, session.CompactSecureCookie)
+    assert cookie.serializer is session.serializers['marshal']
+
+
+class TestStoreSessionMiddleware(object):
+    def make_request(self, cookie=None):
+        return stub(
+            cookies={'session': cookie} if cookie else {},
+            app=stub(
+                secret_key='secret',
+                is_ssl=False,
+                session_store=MemorySessionStore(),
+                ),
+            settings=Config().snapshot(SETTINGS),
+            )
+
+    def make_response(self):
+        cookies = {}
+        return stub(
+            cookies=cookies,
+            set_cookie=lambda k, v, **kw: cookies.__setitem__(k, v),
+            )
+
+    def test_round_trip(self):
+        """Session data is stored server-side; cookie holds signed ID."""
+        request = self.make_request()
+        response = self.make_response()
+        session.store_session_middleware(
+            request, modify_session(response))
+        cookie = response.cookies['session']
+        sid = request.session.sid
+
+        assert cookie.startswith(sid + '.')
+        assert request.app.session_store.get(sid) == {'foo': 'bar'}
+
+        request2 = self.make_request(cookie)
+        request2.app.session_store = request.app.session_store
+        session.store_session_middleware(
+            request2, lambda req: req.session['foo'])
+        assert request2.session.sid == sid
+
+    def test_unmodified_not_saved(self):
+        """Unmodified sessions aren't written or sent."""
+        request = self.make_request()
+        response = self.make_response()
+        session.store_session_middleware(
+            request, lambda req: req.session.get('foo') or response)
+
+        assert response.cookies == {}
+        assert len(request.app.session_store) == 0
+
+    def test_bad_signature(self):
+        """Cookies with a bad signature get a fresh session."""
+        request = self.make_request('a' * 40 + '.bogus')
+        session.store_session_middleware(request, lambda req: req.session)
+
+        assert request.session.new
+        assert request.session.sid != 'a' * 40
+
+    def test_emptied_session_deleted(self):
+        """A session emptied during a request is deleted from the store."""
+        request = self.make_request()
+        store = request.app.session_store
+        existing = store.new()
+        existing['foo'] = 'bar'
+        store.save(existing)
+        request.cookies['session'] = session.sign_session_id(
+            existing.sid, 'secret')
+
+        def handler(req):
+            del req.session['foo']
+
+        session.store_session_middleware(request, handler)
+
+        assert len(store) == 0
@@ -0,0 +1,261 @@
+import socket
+import StringIO
+
+from pretend import stub
+import pytest
+
+from gurtel import session_store
+from gurtel.config import Config
+
+
+class FakeRedis(object):
+    """Stand-in for a Redis client."""
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.expiry[key] = ex
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def store(request, tmpdir):
+    if request.param == 'memory':
+        return session_store.MemorySessionStore()
+    elif request.param == 'sqlite':
+        return session_store.SQLiteSessionStore(
+            str(tmpdir.join('sessions.db')))
+    return session_store.RedisSessionStore(FakeRedis())
+
+
+class TestStores(object):
+    def test_new(self, store):
+        """New sessions are empty and have a valid ID."""
+        session = store.new()
+
+        assert session == {}
+        assert session.new
+        assert store.is_valid_key(session.sid)
+
+    def test_save_and_get(self, store):
+        """Saved sessions can be fetched by ID."""
+        session = store.new()
+        session['user_id'] = 3
+        store.save(session)
+
+        fetched = store.get(session.sid)
+        assert fetched == {'user_id': 3}
+        assert fetched.sid == session.sid
+        assert not fetched.new
+        assert not fetched.modified
+
+    @pytest.mark.parametrize('sid', ['a' * 40, 'not-a-key'])
+    def test_get_unknown(self, store, sid):
+        """Unknown or invalid IDs get a fresh session with a new ID."""
+        session = store.get(sid)
+
+        assert session.new
+        assert session.sid != sid
+
+    def test_delete(self, store):
+        session = store.new()
+        session['user_id'] = 3
+        store.save(session)
+        store.delete(session)
+
+        assert store.get(session.sid).new
+
+
+class TestMemorySessionStore(object):
+    def test_bounded(self):
+        """Least recently used sessions are evicted."""
+        store = session_store.MemorySessionStore(max_entries=2)
+        sessions = [store.new() for i in range(3)]
+        store.save(sessions[0])
+        store.save(sessions[1])
+        store.get(sessions[0].sid)
+        store.save(sessions[2])
+
+        assert len(store) == 2
+        assert not store.get(sessions[0].sid).new
+        assert store.get(sessions[1].sid).new
+
+    def test_expiry(self, monkeypatch):
+        """Expired sessions aren't returned, and are swept on save."""
+        now = [1000.0]
+        monkeypatch.setattr(session_store.time, 'time', lambda: now[0])
+        store = session_store.MemorySessionStore(ttl=10, sweep_interval=60)
+        old, other = store.new(), store.new()
+        store.save(old)
+        store.save(other)
+        now[0] += 30
+
+        assert store.get(old.sid).new
+        assert len(store) == 1
+
+        now[0] += 60
+        store.save(store.new())
+        assert len(store) == 1
+
+
+class TestSQLiteSessionStore(object):
+    def test_shared(self, tmpdir):
+        """Stores on the same file share sessions."""
+        path = str(tmpdir.join('sessions.db'))
+        one = session_store.SQLiteSessionStore(path)
+        two = session_store.SQLiteSessionStore(path)
+        session = one.new()
+        session['a'] = 1
+        one.save(session)
+
+        assert two.get(session.sid) == {'a': 1}
+
+    def test_expiry(self, tmpdir, monkeypatch):
+        """Expired sessions aren't returned, and are swept on save."""
+        now = [1000.0]
+        monkeypatch.setattr(session_store.time, 'time', lambda: now[0])
+        store = session_store.SQLiteSessionStore(
+            str(tmpdir.join('sessions.db')), ttl=10, sweep_interval=60)
+        old = store.new()
+        store.save(old)
+        now[0] += 30
+
+        assert store.get(old.sid).new
+
+        now[0] += 60
+        store.save(store.new())
+        count = store.connection.execute(
+            "SELECT COUNT(*) FROM sessions").fetchone()[0]
+        assert count == 1
+
+
+class TestRedisSessionStore(object):
+    def test_ttl(self):
+        """Sessions are stored with a TTL, under a key prefix."""
+        client = FakeRedis()
+        store = session_store.RedisSessionStore(client, ttl=60)
+        session = store.new()
+        store.save(session)
+
+        assert client.expiry == {'session:' + session.sid: 60}
+
+
+class TestRedisProtocol(object):
+    def test_encode_command(self):
+        assert session_store.encode_command(('SET', 'k', u'v', 'EX', 5)) == (
+            '*5\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n$2\r\nEX\r\n$1\r\n5\r\n')
+
+    @pytest.mark.parametrize('reply,expected', [
+        ('+OK\r\n', 'OK'),
+        (':3\r\n', 3),
+        ('$5\r\nhe\r\no\r\n', 'he\r\no'),
+        ('$-1\r\n', None),
+        ('*2\r\n$1\r\na\r\n:1\r\n', ['a', 1]),
+        ])
+    def test_read_reply(self, reply, expected):
+        reader = StringIO.StringIO(reply)
+
+        assert session_store.read_reply(reader) == expected
+
+    def test_read_error(self):
+        with pytest.raises(session_store.RedisError):
+            session_store.read_reply(StringIO.StringIO('-ERR bad\r\n'))
+
+    def test_read_closed(self):
+        with pytest.raises(socket.error):
+            session_store.read_reply(StringIO.StringIO(''))
+
+
+class TestRedisClient(object):
+    def get_client(self, replies):
+        """Return client whose connections return given replies."""
+        connections = []
+
+        class FakeConnection(object):
+            def __init__(self, **kwargs):
+                self.pid = session_store.os.getpid()
+                self.commands = []
+                self.closed = False
+                connections.append(self)
+
+            def execute(self, *args):
+                self.commands.append(args)
+                reply = replies.pop(0)
+                if isinstance(reply, Exception):
+                    raise reply
+                return reply
+
+            def close(self):
+                self.closed = True
+
+        client = session_store.RedisClient()
+        client.connection_class = FakeConnection
+        return client, connections
+
+    def test_connection_reused(self):
+        """Connections are returned to the pool and reused."""
+        client, connections = self.get_client(['OK', 'v'])
+        client.set('k', 'v', ex=10)
+
+        assert client.get('k') == 'v'
+        assert len(connections) == 1
+        assert connections[0].commands == [
+            ('SET', 'k', 'v', 'EX', 10), ('GET', 'k')]
+
+    def test_broken_connection_discarded(self):
+        """Connections that fail are closed rather than reused."""
+        client, connections = self.get_client([socket.error(), 'v'])
+        with pytest.raises(socket.error):
+            client.get('k')
+
+        assert client.get('k') == 'v'
+        assert len(connections) == 2
+        assert connections[0].closed
+
+    def test_from_url(self):
+        client = session_store.RedisClient.from_url('redis://otherhost/2')
+
+        assert client.connection_kwargs == {
+            'host': 'otherhost', 'port': 6379, 'db': 2, 'timeout': 5.0}
+
+
+class TestStoreFromConfig(object):
+    def test_none(self):
+        assert session_store.store_from_config(Config()) is None
+
+    def test_memory(self):
+        store = session_store.store_from_config(Config({
+            'session.store': 'memory',
+            'session.store_max_entries': '5',
+            'session.expiry_minutes': '2',
+            }))
+
+        assert store.max_entries == 5
+        assert store.ttl == 120
+
+    def test_sqlite(self, tmpdir):
+        path = str(tmpdir.join('sessions.db'))
+        store = session_store.store_from_config(Config({
+            'session.store': 'sqlite', 'session.store_path': path}))
+
+        assert store.path == path
+
+    def test_redis(self):
+        store = session_store.store_from_config(Config({
+            'session.store': 'redis',
+            'session.store_url': 'redis://otherhost:1234/1',
+            }))
+
+        assert store.client.connection_kwargs['port'] == 1234
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            session_store.store_from_config(
+                stub(get=lambda k, d=None: 'bogus' if k else d))
@@ -1,9 +1,22 @@
 import os
 
+from jinja2 import TemplateNotFound
+import mock
 from pretend import stub
 import pytest
+from werkzeug.test import EnvironBuilder
 
-from gurtel import templates
+from gurtel import metrics, templates
+from gurtel.fragment_cache import FragmentCache
+
+
+class Messages(object):
+    """Flash messages recording whether the template iterated them."""
+    iterated = False
+
+    def __iter__(self):
+        self.iterated = True
+        return iter([{'message': 'hi'}])
 
 
 @pytest.fixture
@@ -23,6 +36,13 @@ class TestTemplateRenderer(object):
 
         assert resp.mimetype == 'text/plain'
 
+    def test_render_timed(self, tpl):
+        """Render time is recorded for timed requests."""
+        req = stub(timings=metrics.RequestTimings())
+        tpl.render(req, 'text.txt')
+
+        assert [stage for stage, t in req.timings.stages] == ['render']
+
     def test_render_template_custom_mime_type(self, tpl):
         """Render template can take a custom mime type."""
         resp = tpl.render_template('text.txt', mimetype='text/plain')
@@ -37,3 +57,289 @@ class TestTemplateRenderer(object):
         resp = tpl.render(req, 'flash.html')
 
         assert resp.data == '\n  yay for you.\n'
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_precompile(self, testapp_base_dir, tmpdir, processes):
+        """Precompiles all templates into the bytecode cache."""
+        cache_dir = str(tmpdir.join('bytecode'))
+        tpl = templates.TemplateRenderer(
+            template_dir=os.path.join(testapp_base_dir, 'templates'),
+            bytecode_cache_dir=cache_dir,
+            )
+
+        names = tpl.precompile(processes=processes)
+
+        assert sorted(names) == ['flash.html', 'test.html', 'text.txt']
+        assert len(os.listdir(cache_dir)) == 3
+
+    def test_precompile_no_bytecode_cache(self, tpl):
+        """Without a bytecode cache, compiles templates in-process."""
+        tpl.precompile()
+
+        assert len(tpl.jinja_env.cache) == 3
+
+    def test_bytecode_cache_reused(self, testapp_base_dir, tmpdir):
+        """A new renderer loads templates from the bytecode cache."""
+        cache_dir = str(tmpdir.join('bytecode'))
+        template_dir = os.path.join(testapp_base_dir, 'templates')
+        templates.TemplateRenderer(
+            template_dir, bytecode_cache_dir=cache_dir).precompile(1)
+
+        tpl = templates.TemplateRenderer(
+            template_dir, bytecode_cache_dir=cache_dir)
+        with mock.patch.object(tpl.jinja_env, 'compile') as mock_compile:
+            resp = tpl.render_template('text.txt')
+
+        assert mock_compile.call_count == 0
+        assert resp.data == 'Lorem ipsum dolor sit amet.'
+
+
+def test_atomic_bytecode_cache_write_failure(tmpdir):
+    """Temporary file is removed if writing bytecode fails."""
+    cache = templates.AtomicFileSystemBytecodeCache(str(tmpdir))
+
+    def fail(f):
+        raise IOError()
+
+    with pytest.raises(IOError):
+        cache.dump_bytecode(stub(key='k', write_bytecode=fail))
+
+    assert tmpdir.listdir() == []
+
+
+class TestProductionMode(object):
+    @pytest.mark.tpl_kwargs({'production': True})
+    def test_no_stat(self, tpl):
+        """Templates are never checked for changes."""
+        tpl.render_template('text.txt')
+        with mock.patch('os.path.getmtime') as mock_getmtime:
+            with mock.patch('os.stat') as mock_stat:
+                tpl.render_template('text.txt')
+
+        assert mock_getmtime.call_count == 0
+        assert mock_stat.call_count == 0
+
+    @pytest.mark.tpl_kwargs({'production': True})
+    def test_indexed(self, tpl):
+        """Template directory is indexed once."""
+        assert tpl.jinja_env.list_templates() == [
+            'flash.html', 'test.html', 'text.txt']
+        with pytest.raises(TemplateNotFound):
+            tpl.render_template('missing.html')
+
+    @pytest.mark.tpl_kwargs({'production': True})
+    def test_unbounded_cache(self, tpl):
+        assert tpl.jinja_env.cache == {}
+        assert not tpl.jinja_env.auto_reload
+
+    @pytest.mark.tpl_kwargs({'cache_size': 7})
+    def test_cache_size(self, tpl):
+        assert tpl.jinja_env.cache.capacity == 7
+
+    @pytest.mark.parametrize('production', [True, False])
+    def test_cache_stats(self, testapp_base_dir, production):
+        """Reports template cache hits, misses and compiles."""
+        tpl = templates.TemplateRenderer(
+            template_dir=os.path.join(testapp_base_dir, 'templates'),
+            production=production,
+            )
+        tpl.render_template('text.txt')
+        tpl.render_template('text.txt')
+        stats = tpl.cache_stats()
+
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['compiles'] == 1
+        assert stats['compile_time'] > 0
+
+
+class TestStreaming(object):
+    def test_render_stream(self, tpl):
+        """Can render a template as a streamed response."""
+        resp = tpl.render_stream('text.txt', mimetype='text/plain')
+
+        assert resp.is_streamed
+        assert resp.mimetype == 'text/plain'
+        assert resp.data == 'Lorem ipsum dolor sit amet.'
+
+    @pytest.mark.tpl_kwargs(
+        {'context_processors': [lambda req: {'flash': req.flash_messages}]})
+    def test_render_stream_context_processors(self, tpl):
+        """Streamed render uses context processors."""
+        req = stub(flash_messages=iter([{'message': 'yay for you.'}]))
+        resp = tpl.render(req, 'flash.html', stream=True)
+
+        assert resp.is_streamed
+        assert resp.data == '\n  yay for you.\n'
+
+    def test_head_not_rendered(self, tpl):
+        """For HEAD requests with known validators, no render."""
+        messages = Messages()
+        resp = tpl.render(
+            stub(method='HEAD', validators={'ETag': '"abc"'}),
+            'flash.html',
+            {'flash': messages},
+            )
+        environ = EnvironBuilder(method='HEAD').get_environ()
+        body = resp(environ, lambda status, headers: None)
+
+        assert resp.is_streamed
+        assert list(body) == []
+        assert messages.iterated is False
+
+    def test_head_rendered(self, tpl):
+        """HEAD requests without known validators are rendered as for GET."""
+        resp = tpl.render(stub(method='HEAD'), 'flash.html', {'flash': []})
+
+        assert not resp.is_streamed
+
+    def test_generators_consumed(self, tpl):
+        """Generators in the context are consumed before streaming starts."""
+        consumed = []
+
+        def messages():
+            consumed.append(True)
+            yield {'message': 'hi'}
+
+        tpl.render_stream('flash.html', {'flash': messages()})
+
+        assert consumed
+
+    @pytest.mark.parametrize('buffer_size,num_chunks', [(0, 10), (5, 2)])
+    def test_chunk_buffering(self, testapp_base_dir, buffer_size, num_chunks):
+        """Stream is buffered into chunks of configurable size."""
+        tpl = templates.TemplateRenderer(
+            template_dir=os.path.join(testapp_base_dir, 'templates'),
+            stream_buffer_size=buffer_size,
+            )
+        flash = [{'message': str(i)} for i in range(10)]
+        resp = tpl.render_stream('flash.html', {'flash': flash})
+        chunks = list(resp.response)
+
+        assert ''.join(chunks) == ''.join(
+            '\n  %s\n' % i for i in range(10))
+        assert len(chunks) == num_chunks
+
+
+@pytest.fixture
+def lazy_tpl(request, tmpdir):
+    """Renderer for a template tree with inheritance and includes."""
+    tmpdir.join('base.html').write(
+        '{% block content %}{% endblock %}{{ footer }}')
+    tmpdir.join('page.html').write(
+        '{% extends "base.html" %}'
+        '{% block content %}{% include "nav.html" %}{% endblock %}')
+    tmpdir.join('nav.html').write('{{ nav }}')
+    tmpdir.join('plain.html').write('{{ title }}')
+    tmpdir.join('dynamic.html').write('{% include name %}')
+    tmpdir.join('optional.html').write(
+        '{% include "missing.html" ignore missing %}'
+        '{% include ["nope.html", "nav.html"] %}{{ footer }}')
+    calls = []
+
+    def make_processor(name):
+        @templates.provides(name)
+        def processor(req):
+            calls.append(name)
+            return {name: name.upper()}
+
+        processor.__name__ = name
+        return processor
+
+    renderer = templates.TemplateRenderer(
+        template_dir=str(tmpdir),
+        context_processors=[
+            make_processor('nav'),
+            make_processor('footer'),
+            make_processor('flash'),
+            ],
+        )
+    renderer.calls = calls
+    return renderer
+
+
+class TestLazyContextProcessors(object):
+    def test_template_variables(self, lazy_tpl):
+        """Finds variables used by a template and those it references."""
+        assert lazy_tpl.template_variables('page.html') == frozenset(
+            ['nav', 'footer'])
+        assert lazy_tpl.template_variables('dynamic.html') is None
+
+    def test_missing_references(self, lazy_tpl):
+        """Missing optional templates make variables unknown, not errors."""
+        resp = lazy_tpl.render(None, 'optional.html')
+
+        assert resp.data == 'NAVFOOTER'
+        assert lazy_tpl.template_variables('optional.html') is None
+
+    def test_missing_references_production(self, lazy_tpl):
+        """Without auto-reloading, missing optional templates are skipped."""
+        lazy_tpl.jinja_env.auto_reload = False
+        resp = lazy_tpl.render(None, 'optional.html')
+
+        assert resp.data == 'NAVFOOTER'
+        assert lazy_tpl.template_variables('optional.html') == frozenset(
+            ['nav', 'footer'])
+        assert lazy_tpl.calls == ['nav', 'footer']
+
+    def test_only_needed_processors_called(self, lazy_tpl):
+        """Context processors providing unused variables aren't called."""
+        resp = lazy_tpl.render(None, 'page.html')
+
+        assert resp.data == 'NAVFOOTER'
+        assert lazy_tpl.calls == ['nav', 'footer']
+        assert lazy_tpl.processor_stats['flash']['skipped'] == 1
+        assert lazy_tpl.processor_stats['nav']['calls'] == 1
+
+    def test_dynamic_reference_calls_all(self, lazy_tpl):
+        """If referenced templates can't be known, all processors run."""
+        lazy_tpl.render(None, 'dynamic.html', {'name': 'plain.html'})
+
+        assert lazy_tpl.calls == ['nav', 'footer', 'flash']
+
+    def test_undeclared_processors_always_called(self, tpl):
+        """Context processors without ``provides`` are always called."""
+        tpl.context_processors = [lambda req: {'title': 'x'}]
+
+        tpl.render(None, 'text.txt')
+
+        assert tpl.processor_stats['<lambda>']['calls'] == 1
+
+    def test_variables_cached(self, lazy_tpl):
+        """Template variables are only found once per template."""
+        lazy_tpl.template_variables('page.html')
+        with mock.patch.object(lazy_tpl.jinja_env, 'parse') as mock_parse:
+            lazy_tpl.template_variables('page.html')
+
+        assert mock_parse.call_count == 0
+
+    def test_variables_refreshed_on_change(self, lazy_tpl, tmpdir):
+        """Changed templates are re-analyzed when auto-reloading."""
+        lazy_tpl.template_variables('plain.html')
+        plain = tmpdir.join('plain.html')
+        plain.write('{{ flash }}')
+        plain.setmtime(plain.mtime() + 10)
+
+        assert lazy_tpl.template_variables('plain.html') == frozenset(
+            ['flash'])
+
+
+class TestFragmentCache(object):
+    @pytest.mark.tpl_kwargs({'fragment_cache': FragmentCache()})
+    def test_cache_fragment(self, tpl):
+        """Can cache fragments from Python."""
+        assert tpl.cache_fragment('a', [1], lambda: 'x') == 'x'
+        assert tpl.cache_fragment('a', [1], lambda: 'y') == 'x'
+
+    def test_cache_fragment_no_cache(self, tpl):
+        """Without a fragment cache, just renders."""
+        assert tpl.cache_fragment('a', [1], lambda: 'x') == 'x'
+        assert tpl.cache_fragment('a', [1], lambda: 'y') == 'y'
+
+    @pytest.mark.tpl_kwargs({'fragment_cache': FragmentCache()})
+    def test_cache_tag(self, tpl):
+        """Templates can use the ``cache`` tag."""
+        source = '{% cache "a" %}{{ n }}{% endcache %}'
+        tpl.jinja_env.from_string(source).render(n=1)
+
+        assert tpl.jinja_env.from_string(source).render(n=2) == '1'
@@ -1,4 +1,6 @@
-from gurtel.util import Url
+from werkzeug.wrappers import Request, Response
+
+from gurtel.util import Client, Url
 
 
 class TestUrl(object):
@@ -33,3 +35,62 @@ class TestUrl(object):
         assert self.equal(
             repr(Url("http://fake.base/path/?foo=bar")),
             "Url(http://fake.base/path/?foo=bar)")
+
+
+class TestClient(object):
+    def make_client(self):
+        def app(environ, start_response):
+            request = Request(environ)
+            response = Response(
+                '%s %s %s %s %s' % (
+                    request.method,
+                    request.path,
+                    request.args.get('q'),
+                    request.form.get('f'),
+                    request.cookies.get('c'),
+                    ))
+            if 'set' in request.args:
+                response.set_cookie('c', request.args['set'])
+            if 'del' in request.args:
+                response.delete_cookie('c')
+            return response(environ, start_response)
+
+        return Client(app)
+
+    def test_get(self):
+        """Makes requests with path and query string."""
+        resp = self.make_client().get('/foo%20bar/?q=1')
+
+        assert resp.status_code == 200
+        assert resp.data == 'GET /foo bar/ 1 None None'
+
+    def test_post_form(self):
+        """Can post form data."""
+        resp = self.make_client().post('/', data={'f': 'val'})
+
+        assert resp.data == 'POST / None val None'
+
+    def test_headers(self):
+        """Can send extra headers."""
+        resp = self.make_client().get('/', headers={'Cookie': 'c=hdr'})
+
+        assert resp.data.endswith(' hdr')
+
+    def test_content_type_header(self):
+        """A Content-Type header is sent as CONTENT_TYPE, as per CGI."""
+        resp = self.make_client().post(
+            '/',
+            data='f=hdr',
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            )
+
+        assert resp.data == 'POST / None hdr None'
+
+    def test_cookies(self):
+        """Keeps cookies set by responses, and forgets deleted ones."""
+        client = self.make_client()
+        client.get('/?set=yum')
+
+        assert client.get('/').data.endswith(' yum')
+        client.get('/?del=1')
+        assert client.cookies == {}
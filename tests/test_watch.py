@@ -0,0 +1,89 @@
+import os
+import threading
+
+import pytest
+
+from gurtel import watch
+
+
+def write(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+@pytest.fixture
+def watched(tmpdir):
+    path = str(tmpdir.join('config.ini'))
+    write(path, 'a')
+    return path
+
+
+def test_check(watched):
+    """``check`` calls callback only if a file changed."""
+    calls = []
+    watcher = watch.FileWatcher([watched], lambda: calls.append(1))
+
+    assert not watcher.check()
+    write(watched, 'changed')
+
+    assert watcher.check()
+    assert not watcher.check()
+    assert calls == [1]
+
+
+def test_check_deleted(watched):
+    """Deleting a watched file is a change."""
+    calls = []
+    watcher = watch.FileWatcher([watched], lambda: calls.append(1))
+    os.remove(watched)
+
+    assert watcher.check()
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_thread(watched, monkeypatch, inotify):
+    """Watcher thread notices changes, via inotify or polling."""
+    if not inotify:
+        monkeypatch.setattr(watch, 'inotify_watch', lambda dirs: None)
+    changed = threading.Event()
+    watcher = watch.FileWatcher([watched], changed.set, interval=0.05)
+    watcher.start()
+    try:
+        write(watched, 'changed')
+
+        assert changed.wait(5)
+        assert watcher.inotify == inotify
+    finally:
+        watcher.stop()
+
+
+def test_callback_errors_logged(watched, monkeypatch):
+    """Errors in the callback are logged and don't stop the watcher."""
+    errors = []
+    monkeypatch.setattr(
+        watch.logger, 'exception', lambda *a: errors.append(a))
+    calls = []
+
+    def callback():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError()
+
+    watcher = watch.FileWatcher([watched], callback, interval=0.05)
+    watcher.start()
+    try:
+        write(watched, 'changed')
+        for i in range(100):
+            if errors:
+                break
+            threading.Event().wait(0.05)
+        write(watched, 'changed again')
+        for i in range(100):
+            if len(calls) == 2:
+                break
+            threading.Event().wait(0.05)
+    finally:
+        watcher.stop()
+
+    assert len(errors) == 1
+    assert len(calls) == 2